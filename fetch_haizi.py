@@ -1,24 +1,61 @@
 """
 海子诗歌提取脚本
 从本地 haizi_repo 目录提取诗歌文本
+
+增量提取：清单文件（MANIFEST_PATH）记录每个 HTML 文件的大小、修改时间、内容哈希和提取结果，
+再次运行时只重新解析有变化的文件，其余直接复用清单中的结果；需要解析的文件较多时在进程池中并行。
+默认只提取短诗（01、03 目录），02、04、05 目录用 --include 或 --all 选择加入：
+
+    python fetch_haizi.py                       # 01 + 03
+    python fetch_haizi.py --include 02 04       # 再加上 02、04
+    python fetch_haizi.py --all --workers 0     # 全部目录，使用全部 CPU 核心
 """
 
 import os
 import re
+import sys
 import glob
+import json
+import hashlib
+import argparse
 from html.parser import HTMLParser
+from concurrent.futures import ProcessPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BASE_DIR, "haizi_repo")
+OUTPUT_PATH = os.path.join(BASE_DIR, "corpus", "haizi_full.txt")
+MANIFEST_PATH = os.path.join(BASE_DIR, "cache", "haizi_manifest.json")
+
+# 目录 -> 说明；DEFAULT_DIRS 之外的目录需要选择加入
+SOURCE_DIRS = {
+    "01": "短诗 1983-1986",
+    "02": "长诗 1984-1985",
+    "03": "短诗 1987-1989",
+    "04": "太阳·七部书 1986-1988",
+    "05": "文论",
+}
+DEFAULT_DIRS = ("01", "03")
+
+# 提取逻辑（PoemExtractor / clean_text）变化时递增，清单中的旧结果随之失效
+EXTRACTOR_VERSION = 2
+MIN_POEM_CHARS = 30         # 短于此的提取结果视为空页，不写入语料
+PARALLEL_MIN_FILES = 8      # 需要解析的文件少于此数时不启动进程池
+
+SKIP_MARKERS = ('〖', '〗', '&gt;', '——————', '————————', '*')
+# 数字、英文标点和中文括号（日期、注释编号等），一次删除
+_STRIP_CHARS = re.compile(r'[\d.?!,;:\'\"\(\)\[\]{}（）【】]+')
 
 
 class PoemExtractor(HTMLParser):
     """从 HTML 中提取诗歌文本"""
-    
+
     def __init__(self):
         super().__init__()
         self.text_parts = []
         self.in_blockquote = False
         self.in_p = False
         self.depth = 0
-    
+
     def handle_starttag(self, tag, attrs):
         if tag == 'blockquote':
             self.in_blockquote = True
@@ -27,7 +64,7 @@ class PoemExtractor(HTMLParser):
             self.in_p = True
         elif tag == 'br':
             self.text_parts.append('\n')
-    
+
     def handle_endtag(self, tag):
         if tag == 'blockquote':
             self.depth -= 1
@@ -37,32 +74,35 @@ class PoemExtractor(HTMLParser):
         elif tag == 'p':
             self.in_p = False
             self.text_parts.append('\n')
-    
+
     def handle_data(self, data):
         if self.in_blockquote:
             text = data.strip()
-            if text:
-                # 过滤掉一些不需要的内容
-                if not any(skip in text for skip in ['〖', '〗', '&gt;', '——————', '————————', '*']):
-                    self.text_parts.append(text)
-    
+            # 过滤掉一些不需要的内容
+            if text and not any(skip in text for skip in SKIP_MARKERS):
+                self.text_parts.append(text)
+
     def get_text(self):
-        result = ''.join(self.text_parts)
-        # 清理
-        result = re.sub(r'　+', '', result)  # 移除全角空格
-        result = re.sub(r'\n\s*\n\s*\n+', '\n\n', result)  # 合并多余空行
-        result = re.sub(r'^\s+', '', result, flags=re.MULTILINE)  # 移除行首空白
-        
-        # 过滤数字和英文标点
-        result = re.sub(r'\d+', '', result)  # 移除所有数字
-        result = re.sub(r'[.?!,;:\'\"\(\)\[\]{}]+', '', result)  # 移除英文标点
-        result = re.sub(r'[（）【】]+', '', result)  # 移除中文括号
-        
-        # 移除日期行（如 "1984.10" 变成空行后的残留）
-        result = re.sub(r'^\s*$', '', result, flags=re.MULTILINE)  # 移除空行
-        result = re.sub(r'\n\n+', '\n\n', result)  # 合并多余空行
-        
-        return result.strip()
+        return clean_text(''.join(self.text_parts))
+
+
+def clean_text(text):
+    """
+    清理提取出的文本，逐行一遍完成：
+    移除全角空格、空行和行首空白，删除数字、英文标点和中文括号（如日期 "1984.10"），
+    删除后变空的行在诗节之间最多保留一个空行
+    """
+    lines = []
+    for line in text.replace('　', '').split('\n'):
+        line = line.lstrip()
+        if not line:
+            continue
+        line = _STRIP_CHARS.sub('', line)
+        if line.strip():
+            lines.append(line)
+        elif lines and lines[-1]:
+            lines.append('')
+    return '\n'.join(lines).strip()
 
 
 def extract_poem_from_file(filepath):
@@ -70,7 +110,7 @@ def extract_poem_from_file(filepath):
     try:
         with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
             content = f.read()
-        
+
         parser = PoemExtractor()
         parser.feed(content)
         return parser.get_text()
@@ -79,61 +119,154 @@ def extract_poem_from_file(filepath):
         return ""
 
 
-def main():
+def _file_digest(filepath):
+    with open(filepath, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _extract_task(filepath):
+    """进程池入口：返回 (内容哈希, 诗歌文本)"""
+    return _file_digest(filepath), extract_poem_from_file(filepath)
+
+
+def find_sources(base_dir, dirs):
+    """按目录顺序收集诗歌 HTML 文件（02、04 目录下还有一层子目录）"""
+    htm_files = []
+    for name in dirs:
+        htm_files.extend(sorted(glob.glob(os.path.join(base_dir, name, "**", "*.htm"), recursive=True)))
+    return htm_files
+
+
+def load_manifest(path):
+    """读取清单，不存在、损坏或提取逻辑版本不同时返回空清单"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get("version") == EXTRACTOR_VERSION:
+            return manifest["files"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    return {}
+
+
+def save_manifest(path, files):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"version": EXTRACTOR_VERSION, "files": files}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def extract_incremental(htm_files, base_dir, manifest, workers=1):
+    """
+    提取 htm_files 中的诗歌，清单中大小和修改时间未变的文件直接复用上次的结果；
+    变化了的文件先比较内容哈希（只是被 touch 过时仍然复用），确实修改过的才重新解析
+    返回 (poems, new_manifest, parsed)，poems 与 htm_files 一一对应，parsed 为重新解析的文件列表
+    """
+    entries = {}
+    stale = []
+    for filepath in htm_files:
+        key = os.path.relpath(filepath, base_dir).replace(os.sep, '/')
+        stat = os.stat(filepath)
+        entry = manifest.get(key)
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            entries[key] = entry
+        else:
+            stale.append((filepath, key, stat))
+
+    to_parse = []
+    for filepath, key, stat in stale:
+        entry = manifest.get(key)
+        if entry and entry["size"] == stat.st_size and entry["sha256"] == _file_digest(filepath):
+            entries[key] = dict(entry, mtime_ns=stat.st_mtime_ns)
+        else:
+            to_parse.append((filepath, key, stat))
+
+    paths = [filepath for filepath, _, _ in to_parse]
+    # 与 src.utils.resolve_workers 相同；不导入 src（会连带导入 jieba），启动更快
+    workers = min(workers if workers and workers > 0 else os.cpu_count() or 1, len(paths))
+    if workers > 1 and len(paths) >= PARALLEL_MIN_FILES:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_extract_task, paths, chunksize=4))
+    else:
+        results = list(map(_extract_task, paths))
+    for (filepath, key, stat), (digest, poem) in zip(to_parse, results):
+        entries[key] = {
+            "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest, "poem": poem,
+        }
+
+    keys = [os.path.relpath(f, base_dir).replace(os.sep, '/') for f in htm_files]
+    poems = [entries[key]["poem"] for key in keys]
+    return poems, entries, paths
+
+
+def write_if_changed(path, text):
+    """内容与现有文件相同时不重写，返回是否写入"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            if f.read() == text:
+                return False
+    except OSError:
+        pass
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="从本地 haizi_repo 提取海子诗歌到语料文件")
+    parser.add_argument("--include", nargs="+", default=[], choices=sorted(SOURCE_DIRS),
+                        metavar="DIR", help="额外提取的目录（02、04、05）")
+    parser.add_argument("--all", action="store_true", help="提取全部目录")
+    parser.add_argument("--workers", type=int, default=1, help="解析进程数（0 = 全部 CPU 核心）")
+    parser.add_argument("--force", action="store_true", help="忽略清单，重新解析全部文件")
+    parser.add_argument("-o", "--output", default=OUTPUT_PATH, help="输出语料文件")
+    args = parser.parse_args(argv)
+
     print("=" * 50)
     print("海子诗歌提取脚本 (本地版)")
     print("=" * 50)
-    
-    base_dir = os.path.join(os.path.dirname(__file__), "haizi_repo")
-    
-    if not os.path.exists(base_dir):
+
+    if not os.path.exists(REPO_DIR):
         print("错误: haizi_repo 目录不存在，请先运行:")
         print("  git clone https://github.com/haitai/haizi.git haizi_repo")
-        return
-    
+        return 1
+
+    dirs = sorted(SOURCE_DIRS) if args.all else sorted(set(DEFAULT_DIRS) | set(args.include))
+    print("提取目录: " + "、".join(f"{name} ({SOURCE_DIRS[name]})" for name in dirs))
+
     # 收集所有诗歌 HTML 文件
-    htm_files = []
-    
-    # 短诗 1983-1986 (01 目录)
-    htm_files.extend(sorted(glob.glob(os.path.join(base_dir, "01", "*.htm"))))
-    
-    # 短诗 1987-1989 (03 目录)
-    htm_files.extend(sorted(glob.glob(os.path.join(base_dir, "03", "*.htm"))))
-    
+    htm_files = find_sources(REPO_DIR, dirs)
     print(f"找到 {len(htm_files)} 个诗歌文件\n")
-    
-    all_poems = []
-    
-    for i, filepath in enumerate(htm_files, 1):
-        filename = os.path.basename(filepath)
-        print(f"[{i}/{len(htm_files)}] 提取: {filename}")
-        
-        poem = extract_poem_from_file(filepath)
-        if poem and len(poem) > 30:
-            all_poems.append(poem)
-            print(f"  ✓ 提取 {len(poem)} 字符")
-        else:
-            print(f"  - 内容太短或为空，跳过")
-    
+
+    manifest = {} if args.force else load_manifest(MANIFEST_PATH)
+    poems, entries, parsed = extract_incremental(htm_files, REPO_DIR, manifest, args.workers)
+    # 清单保留未选中目录的记录，之后加入这些目录时同样可以复用
+    save_manifest(MANIFEST_PATH, dict(manifest, **entries))
+
+    results = dict(zip(htm_files, poems))
+    for filepath in parsed:
+        poem = results[filepath]
+        status = f"✓ 提取 {len(poem)} 字符" if len(poem) > MIN_POEM_CHARS else "- 内容太短或为空，跳过"
+        print(f"解析: {os.path.relpath(filepath, REPO_DIR)}  {status}")
+    print(f"重新解析 {len(parsed)} 个文件，其余 {len(htm_files) - len(parsed)} 个复用清单中的结果")
+
+    all_poems = [poem for poem in poems if poem and len(poem) > MIN_POEM_CHARS]
+
     print("\n" + "=" * 50)
     print(f"提取完成！成功: {len(all_poems)}/{len(htm_files)}")
-    
-    # 保存到 corpus 目录
-    output_path = os.path.join(os.path.dirname(__file__), "corpus", "haizi_full.txt")
-    
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write('\n\n'.join(all_poems))
-    
+
+    # 保存到 corpus 目录（内容不变时不重写）
+    written = write_if_changed(args.output, '\n\n'.join(all_poems))
+
     total_chars = sum(len(p) for p in all_poems)
-    print(f"已保存到: {output_path}")
+    print(f"{'已保存到' if written else '内容无变化'}: {args.output}")
     print(f"总诗歌数: {len(all_poems)}")
     print(f"总字符数: {total_chars}")
-    
-    # 删除临时仓库 (可选)
-    # import shutil
-    # shutil.rmtree(base_dir)
-    # print("已清理临时文件")
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
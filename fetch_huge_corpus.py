@@ -1,73 +1,239 @@
-import json
+"""
+Builds a plain-text corpus from a dump of poems in JSON.
+
+Each source file is either a JSON array of poem objects (as in
+China-modern-poetry) or JSON lines, one poem object per line. Files are
+parsed incrementally, one poem at a time, and every worker process writes
+its poems straight to a part file, so memory stays bounded by the largest
+single poem however big the dump is. The parts are then concatenated, in
+source order, into the output corpus (poems separated by a blank line).
+
+    python fetch_huge_corpus.py path/to/contemporary -o corpus/modern_huge.txt --workers 0
+"""
+
 import os
+import sys
+import json
 import glob
-from pathlib import Path
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 # Configuration
-SOURCE_DIR = r"d:\study\口订\modern_poem_generator\temp_corpus_src\yuxqiu_modern\China-modern-poetry\contemporary"
-OUTPUT_FILE = r"d:\study\口订\modern_poem_generator\corpus\modern_huge.txt"
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+OUTPUT_FILE = os.path.join(CORPUS_DIR, "modern_huge.txt")
+SOURCE_PATTERNS = ("*.json", "*.jsonl", "*.ndjson")
 
+READ_SIZE = 1 << 16             # bytes read from a source file at a time
+MAX_RECORD_SIZE = 64 << 20      # a single poem larger than this is treated as corrupt input
 
-def fetch_huge_corpus():
-    print(f"Searching for JSON files in: {SOURCE_DIR}")
-    json_files = glob.glob(os.path.join(SOURCE_DIR, "*.json"))
+_decoder = json.JSONDecoder()
 
-    if not json_files:
-        print("No JSON files found! Please check the directory path.")
-        return
 
-    print(f"Found {len(json_files)} JSON files.")
+class SourceError(Exception):
+    """Raised when a source file is not valid JSON / JSON lines."""
 
-    total_poems = 0
-    total_lines = 0
-    all_content = []
 
-    for json_file in json_files:
-        print(f"Processing: {os.path.basename(json_file)}...")
-        try:
-            with open(json_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
+def iter_json_records(f, read_size=READ_SIZE, max_record_size=MAX_RECORD_SIZE):
+    """
+    Yields the records of a JSON array or of JSON lines from text file f.
 
-            if not isinstance(data, list):
-                print(f"Skipping {json_file}: Content is not a list.")
+    Top-level values are separated by whitespace or newlines, optionally
+    with a single comma between two of them; a top-level array is descended
+    into and its elements, which must be comma-separated, yielded one by one.
+    A comma anywhere else (leading, doubled or trailing) is malformed input.
+    Only the unparsed remainder of the buffer is kept, so memory is bounded
+    by the largest record (max_record_size) rather than by the file.
+    Raises SourceError on malformed input.
+    """
+    buffer = ""
+    pos = 0
+    offset = 0          # characters of the file dropped from the front of buffer
+    depth = 0           # 1 inside the top-level array
+    after_value = False     # a record (or the whole array) was just read: a comma may follow
+    need_value = False      # a comma was just read: a record must follow
+    eof = False
+    while True:
+        while pos < len(buffer) and buffer[pos].isspace():
+            pos += 1
+        if pos < len(buffer):
+            char = buffer[pos]
+            if char == ",":
+                if not after_value:
+                    raise SourceError(f"unexpected ',' at character {offset + pos}")
+                after_value, need_value = False, True
+                pos += 1
+                continue
+            if char == "[" and depth == 0:
+                depth, pos = 1, pos + 1
+                after_value = need_value = False
                 continue
+            if char == "]" and depth == 1:
+                if need_value:
+                    raise SourceError(f"trailing ',' before character {offset + pos}")
+                depth, pos = 0, pos + 1
+                after_value = True
+                continue
+            if after_value and depth == 1:
+                raise SourceError(f"expected ',' or ']' at character {offset + pos}")
+            try:
+                record, end = _decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                if eof:
+                    raise SourceError(f"invalid JSON at character {offset + e.pos}: {e.msg}") from e
+                if len(buffer) - pos > max_record_size:
+                    raise SourceError(f"record longer than {max_record_size} characters")
+            else:
+                # A number cut off at the end of the buffer would decode as a shorter one
+                if end < len(buffer) or eof or isinstance(record, (dict, list, str)):
+                    yield record
+                    pos = end
+                    after_value, need_value = True, False
+                    continue
+        elif eof:
+            if depth:
+                raise SourceError("unterminated JSON array")
+            if need_value:
+                raise SourceError("trailing ',' at end of input")
+            return
+
+        # Need more input: drop what has been consumed and read the next block
+        buffer = buffer[pos:]
+        offset += pos
+        pos = 0
+        # Reading at least as much as is buffered doubles the buffer each time a
+        # large record is still incomplete, so re-parsing it stays linear overall
+        block = f.read(max(read_size, len(buffer)))
+        if block:
+            buffer += block
+        else:
+            eof = True
+
+
+def poem_text(poem):
+    """
+    Returns (text, line count) of a poem object, or (None, 0) if it has no
+    usable "paragraphs" (a list of lines or a single string).
+    """
+    if not isinstance(poem, dict):
+        return None, 0
+    paragraphs = poem.get("paragraphs")
+    if isinstance(paragraphs, list):
+        lines = [p.strip() for p in paragraphs if isinstance(p, str) and p.strip()]
+        if lines:
+            return "\n".join(lines), len(paragraphs)
+    elif isinstance(paragraphs, str) and paragraphs.strip():
+        return paragraphs.strip(), 1
+    return None, 0
+
+
+def extract_file(task):
+    """
+    Streams the poems of one source file into part_path.
+    Returns (source, poems, lines, error); the part file is not used on error.
+    """
+    source, part_path = task
+    poems = lines = 0
+    try:
+        with open(source, "r", encoding="utf-8") as f, \
+                open(part_path, "w", encoding="utf-8") as out:
+            for record in iter_json_records(f):
+                text, n_lines = poem_text(record)
+                if text is None:
+                    continue
+                if poems:
+                    out.write("\n\n")
+                out.write(text)
+                poems += 1
+                lines += n_lines
+    except (OSError, UnicodeDecodeError, SourceError) as e:
+        return source, 0, 0, str(e)
+    return source, poems, lines, None
+
+
+def find_sources(paths, patterns=SOURCE_PATTERNS):
+    """Source files in the given order: files as is, directories searched recursively."""
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = set()
+            for pattern in patterns:
+                found.update(glob.glob(os.path.join(path, "**", pattern), recursive=True))
+            sources.extend(sorted(found))
+        else:
+            sources.append(path)
+    return sources
+
+
+def fetch_huge_corpus(paths, output=OUTPUT_FILE, workers=1, verbose=True):
+    """
+    Converts the JSON sources in paths into a corpus file at output.
+    workers: number of processes parsing files in parallel, <= 0 for all cores
+    Returns (poems, lines); the output is replaced only once it is complete.
+    """
+    log = print if verbose else (lambda *args, **kwargs: None)
+    sources = find_sources(paths)
+    if not sources:
+        log("No JSON files found! Please check the source path.")
+        return 0, 0
+    log(f"Found {len(sources)} source files.")
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    tmp_path = f"{output}.{os.getpid()}.tmp"
+    parts = [f"{tmp_path}.part{i}" for i in range(len(sources))]
+    tasks = list(zip(sources, parts))
+
+    total_poems = total_lines = 0
+    try:
+        # Same as src.utils.resolve_workers, inlined: importing src also imports jieba
+        workers = min(workers if workers and workers > 0 else os.cpu_count() or 1, len(tasks))
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(extract_file, tasks))
+        else:
+            results = list(map(extract_file, tasks))
+
+        with open(tmp_path, "w", encoding="utf-8") as out:
+            for (source, poems, lines, error), part in zip(results, parts):
+                if error:
+                    log(f"Error processing {source}: {error}")
+                    continue
+                log(f"Processed {os.path.basename(source)}: {poems} poems")
+                if not poems:
+                    continue
+                if total_poems:
+                    out.write("\n\n")
+                with open(part, "r", encoding="utf-8") as f:
+                    shutil.copyfileobj(f, out)
+                total_poems += poems
+                total_lines += lines
+
+        log(f"\nExtracted {total_poems} poems with approx {total_lines} lines.")
+        if total_poems:
+            os.replace(tmp_path, output)
+            log(f"Saved to {output}")
+        else:
+            log("No content extracted.")
+    finally:
+        for path in parts + [tmp_path]:
+            if os.path.exists(path):
+                os.remove(path)
+    return total_poems, total_lines
+
 
-            for poem in data:
-                paragraphs = poem.get("paragraphs")
-                if paragraphs:
-                    # paragraphs is typically a list of strings
-                    if isinstance(paragraphs, list):
-                        poem_text = "\n".join(
-                            [p.strip() for p in paragraphs if p.strip()]
-                        )
-                        if poem_text:
-                            all_content.append(poem_text)
-                            total_poems += 1
-                            total_lines += len(paragraphs)
-                    elif isinstance(paragraphs, str):
-                        if paragraphs.strip():
-                            all_content.append(paragraphs.strip())
-                            total_poems += 1
-                            total_lines += 1
-
-        except Exception as e:
-            print(f"Error processing {json_file}: {e}")
-
-    print(f"\nExtracted {total_poems} poems with approx {total_lines} lines.")
-
-    # Save to output file
-    if all_content:
-        print(f"Saving to {OUTPUT_FILE}...")
-        try:
-            with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-                # Join poems with double newline
-                f.write("\n\n".join(all_content))
-            print("Successfully saved modern_huge.txt")
-        except Exception as e:
-            print(f"Error saving file: {e}")
-    else:
-        print("No content extracted.")
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build a text corpus from JSON / JSON-lines poem dumps")
+    parser.add_argument("sources", nargs="+",
+                        help="JSON / JSON-lines files, or directories searched recursively for "
+                             + ", ".join(SOURCE_PATTERNS))
+    parser.add_argument("-o", "--output", default=OUTPUT_FILE,
+                        help="output corpus file (default: corpus/modern_huge.txt)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of parsing processes (0 = all CPU cores)")
+    args = parser.parse_args(argv)
+    poems, _ = fetch_huge_corpus(args.sources, args.output, args.workers)
+    return 0 if poems else 1
 
 
 if __name__ == "__main__":
-    fetch_huge_corpus()
+    sys.exit(main())
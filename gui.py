@@ -5,10 +5,10 @@
 
 import os
 import time
+import argparse
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
-from src.utils import load_corpus, clean_and_tokenize, extract_imagery_and_connectors
-from src.model import MarkovChain, ImageryChain, StructuredPoemGenerator
+from src import pipeline
 
 # 路径配置
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -18,7 +18,7 @@ os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 
 class PoemGeneratorApp:
-    def __init__(self, root):
+    def __init__(self, root, segment_workers=1):
         self.root = root
         self.root.title("现代诗生成器 - 海子风格")
         self.root.geometry("700x600")
@@ -34,14 +34,12 @@ class PoemGeneratorApp:
         self.model = None
         self.imagery_model = None  # 意象模型
         self.structured_model = None  # 结构化模型
-        self.tokens = None
-        self.token_data = None  # 词性标注数据
-        self.raw_lines = []  # 原始诗行
         self.current_corpus = tk.StringVar(value="haizi.txt")
         self.poem_length = tk.IntVar(value=4)
         self.markov_order = tk.IntVar(value=2)
         self.generation_mode = tk.StringVar(value="structured")  # 默认结构化模式
         self.last_poem = ""
+        self.segment_workers = segment_workers  # 分词进程数
         
         # 创建界面
         self.create_widgets()
@@ -95,7 +93,7 @@ class PoemGeneratorApp:
                                     state="readonly", width=5)
         order_combo['values'] = [1, 2, 3]
         order_combo.pack(side="left", padx=(0, 10))
-        order_combo.bind("<<ComboboxSelected>>", lambda e: self.load_model())
+        order_combo.bind("<<ComboboxSelected>>", lambda e: self.change_order())
         
         ttk.Label(row3, text="(1=最随机, 2=平衡, 3=最连贯) - 仅 markov 模式生效", 
                   foreground="gray").pack(side="left")
@@ -165,36 +163,16 @@ class PoemGeneratorApp:
         
         try:
             filepath = os.path.join(CORPUS_DIR, corpus_file)
-            text = load_corpus(filepath)
-            
-            if text is None:
-                messagebox.showerror("错误", f"无法加载语料库: {corpus_file}")
-                return
-            
-            # 保存原始诗行（用于结构化模型）
-            self.raw_lines = [line.strip() for line in text.split('\n') if line.strip()]
-            
-            # 普通分词（用于马尔可夫模型）
-            self.tokens = clean_and_tokenize(text)
-            if not self.tokens:
-                messagebox.showerror("错误", "语料库为空或分词失败")
+            loaded, source, error = pipeline.load_models(
+                filepath, order, workers=self.segment_workers
+            )
+            if error:
+                messagebox.showerror("错误", f"{error}: {corpus_file}")
                 return
             
-            # 训练马尔可夫模型
-            self.model = MarkovChain(order=order)
-            self.model.train(self.tokens)
-            
-            # 提取意象和连接词（用于意象模型）
-            imagery, connectors, token_data = extract_imagery_and_connectors(text)
-            self.token_data = token_data
-            
-            # 训练意象模型
-            self.imagery_model = ImageryChain()
-            self.imagery_model.train(token_data)
-            
-            # 训练结构化模型
-            self.structured_model = StructuredPoemGenerator()
-            self.structured_model.train(token_data, self.raw_lines)
+            self.model = loaded["markov"]  # 马尔可夫模型
+            self.imagery_model = loaded["imagery"]  # 意象模型
+            self.structured_model = loaded["structured"]  # 结构化模型
             
             # 显示统计信息
             stats = self.structured_model.get_stats()
@@ -205,6 +183,15 @@ class PoemGeneratorApp:
             messagebox.showerror("错误", f"加载失败: {str(e)}")
             self.status_var.set("加载失败")
     
+    def change_order(self):
+        """切换马尔可夫阶数：n 元组树已包含 1..max_order 阶，不需要重新训练"""
+        order = self.markov_order.get()
+        if self.model is None or order > self.model.max_order:
+            self.load_model()
+            return
+        self.model = self.model.with_order(order)
+        self.status_var.set(f"已切换到 {order} 阶")
+    
     def generate_poem(self):
         """生成诗歌"""
         mode = self.generation_mode.get()
@@ -297,6 +284,11 @@ class PoemGeneratorApp:
 
 
 def main():
+    parser = argparse.ArgumentParser(description="现代诗生成器 GUI")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="分词进程数（默认 1，0 表示使用全部核心）")
+    args = parser.parse_args()
+
     root = tk.Tk()
     
     # 设置 DPI 感知（Windows 10+）
@@ -306,7 +298,7 @@ def main():
     except:
         pass
     
-    app = PoemGeneratorApp(root)
+    app = PoemGeneratorApp(root, segment_workers=args.workers)
     root.mainloop()
 
 
@@ -1,7 +1,12 @@
 import os
+import sys
+import json
 import time
-from src.utils import load_corpus, clean_and_tokenize, extract_imagery_and_connectors
-from src.model import MarkovChain, StructuredPoemGenerator
+import argparse
+import multiprocessing
+from src import pipeline
+from src.model import MarkovChain
+from src.snapshot import SnapshotError
 
 CORPUS_DIR = os.path.join(os.path.dirname(__file__), "corpus")
 OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "output")
@@ -9,6 +14,11 @@ OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "output")
 # 确保输出目录存在
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# generate 子命令
+BATCH_MODES = ("structured", "imagery", "markov", "backoff")
+BATCH_CHUNK = 256       # 每次生成并写出的诗数
+_batch_models = None    # fork 之前设置，生成进程直接继承已加载的模型
+
 
 def clear_screen():
     os.system("cls" if os.name == "nt" else "clear")
@@ -19,49 +29,39 @@ def list_corpora():
     return files
 
 
-def main():
+def main(workers=1):
     # Defaults
     current_corpus = "haizi_full.txt"  # 默认使用扩展语料
     poem_length = 4
     markov_order = 2  # 马尔可夫阶数 (1-3)
-    generation_mode = "structured"  # structured, markov
+    generation_mode = "structured"  # structured, markov, backoff
     model = None
     structured_model = None
     last_poem = None
 
     def load_models(corpus_file, order):
-        """加载语料并训练模型"""
+        """加载语料并训练模型（存在有效快照时直接加载快照）"""
         nonlocal model, structured_model
-        text = load_corpus(os.path.join(CORPUS_DIR, corpus_file))
-        if text is None:
-            return None, "无法加载语料库"
-        
-        tokens = clean_and_tokenize(text)
-        if not tokens:
-            return None, "语料库为空或分词失败"
-        
-        # 马尔可夫模型
-        model = MarkovChain(order=order)
-        model.train(tokens)
-        
-        # 结构化模型
-        raw_lines = [line.strip() for line in text.split('\n') if line.strip()]
-        _, _, token_data = extract_imagery_and_connectors(text)
-        structured_model = StructuredPoemGenerator()
-        structured_model.train(token_data, raw_lines)
-        
-        return tokens, None
+        loaded, source, error = pipeline.load_models(
+            os.path.join(CORPUS_DIR, corpus_file), order, workers=workers
+        )
+        if error:
+            return None, error
+
+        model = loaded["markov"]
+        structured_model = loaded["structured"]
+        return source, None
 
     # Init Load
     print(f"正在加载 {current_corpus}...")
-    tokens, error = load_models(current_corpus, markov_order)
+    source, error = load_models(current_corpus, markov_order)
     if error:
         print(f"错误: {error}")
         return
 
     while True:
         clear_screen()
-        mode_names = {"structured": "结构化", "markov": "马尔可夫"}
+        mode_names = {"structured": "结构化", "markov": "马尔可夫", "backoff": "马尔可夫回退"}
         print("======== 现代诗生成器 (Modern Poem Generator) ========")
         print(f"当前风格 (Current Style): [{current_corpus}]")
         print(f"生成模式 (Mode): [{mode_names.get(generation_mode, generation_mode)}]")
@@ -93,7 +93,7 @@ def main():
                 if 0 <= sel < len(files):
                     current_corpus = files[sel]
                     print(f"正在加载 {current_corpus}...")
-                    tokens, error = load_models(current_corpus, markov_order)
+                    source, error = load_models(current_corpus, markov_order)
                     if error:
                         print(f"错误: {error}")
                         time.sleep(1)
@@ -111,14 +111,18 @@ def main():
             print("\n生成模式:")
             print("  1. structured - 结构化 (状语+展开+结尾)")
             print("  2. markov - 马尔可夫链 (经典随机游走)")
+            print("  3. backoff - 马尔可夫回退 (上下文没见过时退到更短的上下文)")
             try:
-                mode_sel = input("选择模式 (1/2): ").strip()
+                mode_sel = input("选择模式 (1/2/3): ").strip()
                 if mode_sel == "1":
                     generation_mode = "structured"
                     print("已切换到结构化模式")
                 elif mode_sel == "2":
                     generation_mode = "markov"
                     print("已切换到马尔可夫模式")
+                elif mode_sel == "3":
+                    generation_mode = "backoff"
+                    print("已切换到马尔可夫回退模式")
                 else:
                     print("无效选择")
                 time.sleep(1)
@@ -146,9 +150,12 @@ def main():
                 new_order = int(input("请选择阶数 (1-3): "))
                 if 1 <= new_order <= 3:
                     markov_order = new_order
-                    # 重新训练模型
-                    print(f"正在以 {markov_order} 阶重新训练模型...")
-                    tokens, _ = load_models(current_corpus, markov_order)
+                    # n 元组树已包含 1..max_order 阶，切换阶数不需要重新训练
+                    if markov_order <= model.max_order:
+                        model = model.with_order(markov_order)
+                    else:
+                        print(f"正在以 {markov_order} 阶重新训练模型...")
+                        source, _ = load_models(current_corpus, markov_order)
                     print("模型已更新!")
                     time.sleep(1)
                 else:
@@ -164,6 +171,9 @@ def main():
             if generation_mode == "structured":
                 last_poem = structured_model.generate(expansion_count=poem_length)
                 mode_label = "结构化"
+            elif generation_mode == "backoff":
+                last_poem = model.generate(poem_length, backoff=True)
+                mode_label = f"马尔可夫回退-{markov_order}阶"
             else:
                 last_poem = model.generate(poem_length)
                 mode_label = f"马尔可夫-{markov_order}阶"
@@ -191,5 +201,184 @@ def main():
             break
 
 
+def build_snapshots(corpus_files, orders, workers=1, flat=False, shards=1):
+    """离线构建快照（命令行 snapshot 子命令）"""
+    if not corpus_files:
+        corpus_files = list_corpora()
+    for corpus_file in corpus_files:
+        corpus_path = resolve_corpus(corpus_file)
+        for order in orders:
+            start = time.time()
+            try:
+                path = pipeline.build_snapshot(
+                    corpus_path, order, workers=workers, flat=flat, shards=shards
+                )
+            except SnapshotError as e:
+                print(f"✗ {e}")
+                continue
+            print(f"✓ {os.path.basename(corpus_path)} ({order}阶) -> {path} "
+                  f"[{time.time() - start:.1f}s]")
+
+
+def merge_snapshots(paths, output, corpus_file=None, flat=False):
+    """归并分片快照（命令行 merge 子命令），返回退出码"""
+    start = time.time()
+    try:
+        path = pipeline.merge_snapshots(
+            paths, output, corpus_path=resolve_corpus(corpus_file) if corpus_file else None, flat=flat
+        )
+    except SnapshotError as e:
+        print(f"✗ {e}")
+        return 1
+    print(f"✓ {len(paths)} 个分片 -> {path} [{time.time() - start:.1f}s]")
+    return 0
+
+
+def resolve_corpus(corpus_file):
+    """命令行给出的语料：既可以是路径，也可以是 corpus/ 下的文件名"""
+    if os.path.exists(corpus_file):
+        return corpus_file
+    return os.path.join(CORPUS_DIR, corpus_file)
+
+
+def _generate_chunk(task):
+    """
+    生成一块诗，返回 (诗列表, 种子列表)
+    指定基准种子时第 i 首诗的种子为 base_seed + i，否则用 generate_batch 向量化生成
+    """
+    mode, num_lines, start, n, base_seed = task
+    models = _batch_models
+    if base_seed is not None:
+        seeds = list(range(base_seed + start, base_seed + start + n))
+        return [pipeline.generate_poem(models, mode, num_lines, seed) for seed in seeds], seeds
+    return pipeline.generate_poems(models, mode, num_lines, n), [None] * n
+
+
+def batch_generate(corpus_file, mode="structured", order=2, count=100, num_lines=4,
+                   seed=None, gen_workers=1, fmt="jsonl", output=None, workers=1):
+    """
+    非交互批量生成（命令行 generate 子命令），返回退出码
+    存在快照时直接加载快照；诗按块生成并立即写出，内存占用与 count 无关
+    gen_workers > 1 时用 fork 出的进程并行生成，输出顺序不变
+    """
+    global _batch_models
+    corpus_path = resolve_corpus(corpus_file)
+    start = time.time()
+    models, source, error = pipeline.load_models(corpus_path, order, workers=workers)
+    if error:
+        print(f"✗ {error}: {corpus_file}", file=sys.stderr)
+        return 1
+    print(f"✓ 已加载 {os.path.basename(corpus_path)} ({order}阶, {source}) "
+          f"[{time.time() - start:.1f}s]", file=sys.stderr)
+    _batch_models = models
+
+    tasks = [
+        (mode, num_lines, i, min(BATCH_CHUNK, count - i), seed)
+        for i in range(0, count, BATCH_CHUNK)
+    ]
+    pool = None
+    if gen_workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+        pool = multiprocessing.get_context("fork").Pool(gen_workers)
+        results = pool.imap(_generate_chunk, tasks)
+    else:
+        results = map(_generate_chunk, tasks)
+
+    out = open(output, "w", encoding="utf-8") if output else sys.stdout
+    start = time.time()
+    index = 0
+    try:
+        for poems, seeds in results:
+            for poem, poem_seed in zip(poems, seeds):
+                if fmt == "jsonl":
+                    record = {"index": index, "poem": poem, "seed": poem_seed}
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                else:
+                    out.write(f"{poem}\n--------------------\n")
+                index += 1
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if out is not sys.stdout:
+            out.close()
+        else:
+            out.flush()
+
+    elapsed = max(time.time() - start, 1e-9)
+    print(f"✓ 生成 {index} 首诗，耗时 {elapsed:.2f}s ({index / elapsed:.0f} 首/秒)", file=sys.stderr)
+    return 0
+
+
+def parse_args(argv=None):
+    """解析命令行参数；取值不合法时由 argparse 报错退出"""
+    parser = argparse.ArgumentParser(description="现代诗生成器 (Modern Poem Generator)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="分词进程数（默认 1，0 表示使用全部核心）")
+    subparsers = parser.add_subparsers(dest="command")
+
+    snapshot_parser = subparsers.add_parser("snapshot", help="离线训练并保存模型快照")
+    snapshot_parser.add_argument("corpus", nargs="*",
+                                 help="语料文件（默认 corpus/ 下全部 .txt）")
+    snapshot_parser.add_argument("--order", type=int, nargs="+", default=[2],
+                                 help="马尔可夫阶数，可指定多个（默认 2）")
+    snapshot_parser.add_argument("--flat", action="store_true",
+                                 help="保存为可 mmap 的扁平模型文件（多进程共享内存）")
+    snapshot_parser.add_argument("--shards", type=int, default=1,
+                                 help="把语料切成多片分别训练再归并（用 --workers 个进程，默认 1 片）")
+
+    merge_parser = subparsers.add_parser("merge", help="把在语料各分片上构建的快照归并成一个")
+    merge_parser.add_argument("snapshots", nargs="+", help="各分片的快照文件（按分片顺序）")
+    merge_parser.add_argument("-o", "--output", required=True, help="输出的快照文件")
+    merge_parser.add_argument("--corpus", default=None,
+                              help="分片拼接成的完整语料，记录其内容哈希以便加载该语料时直接使用")
+    merge_parser.add_argument("--flat", action="store_true", help="输出为扁平模型文件")
+
+    generate_parser = subparsers.add_parser("generate", help="非交互批量生成，输出 JSONL 或纯文本")
+    generate_parser.add_argument("corpus", nargs="?", default="haizi_full.txt",
+                                 help="语料文件（默认 haizi_full.txt）")
+    generate_parser.add_argument("--mode", choices=BATCH_MODES, default="structured",
+                                 help="生成模式（默认 structured）")
+    generate_parser.add_argument("--order", type=int, default=2, help="马尔可夫阶数（默认 2）")
+    generate_parser.add_argument("-n", "--count", type=int, default=100, help="生成的诗数（默认 100）")
+    generate_parser.add_argument("--lines", type=int, default=4, help="每首诗的行数（默认 4）")
+    generate_parser.add_argument("--seed", type=int, default=None,
+                                 help="基准种子，第 i 首诗使用 seed + i（默认不固定）")
+    generate_parser.add_argument("--gen-workers", type=int, default=1,
+                                 help="并行生成的进程数（默认 1）")
+    generate_parser.add_argument("--format", choices=("jsonl", "text"), default="jsonl",
+                                 help="输出格式（默认 jsonl）")
+    generate_parser.add_argument("-o", "--output", default=None, help="输出文件（默认标准输出）")
+
+    args = parser.parse_args(argv)
+    if args.command == "snapshot":
+        for order in args.order:
+            if not 1 <= order <= MarkovChain.MAX_ORDER:
+                parser.error(f"--order 必须在 1～{MarkovChain.MAX_ORDER} 之间")
+        if args.shards < 1:
+            parser.error("--shards 必须大于等于 1")
+    if args.command == "generate":
+        if args.count < 1:
+            parser.error("--count 必须大于等于 1")
+        if args.lines < 1:
+            parser.error("--lines 必须大于等于 1")
+        if args.gen_workers < 1:
+            parser.error("--gen-workers 必须大于等于 1")
+        if not 1 <= args.order <= MarkovChain.MAX_ORDER:
+            parser.error(f"--order 必须在 1～{MarkovChain.MAX_ORDER} 之间")
+    return args
+
+
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    if args.command == "snapshot":
+        build_snapshots(args.corpus, args.order, workers=args.workers, flat=args.flat,
+                        shards=args.shards)
+    elif args.command == "merge":
+        sys.exit(merge_snapshots(args.snapshots, args.output, args.corpus, flat=args.flat))
+    elif args.command == "generate":
+        sys.exit(batch_generate(
+            args.corpus, mode=args.mode, order=args.order, count=args.count,
+            num_lines=args.lines, seed=args.seed, gen_workers=args.gen_workers,
+            fmt=args.format, output=args.output, workers=args.workers,
+        ))
+    else:
+        main(workers=args.workers)
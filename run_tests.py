@@ -1,12 +1,42 @@
 import unittest
 import os
 import sys
+import random
+import shutil
+import tempfile
+import multiprocessing
+import time
 
 # Add project root to path so we can import src
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from src.model import MarkovChain, StructuredPoemGenerator
-from src.utils import clean_and_tokenize, extract_imagery_and_connectors
+from src.model import MarkovChain, ImageryChain, StructuredPoemGenerator
+from src import flatmodel, jobs, pipeline, pool, registry, snapshot, tables, workers
+from src import utils
+from src.utils import clean_and_tokenize, extract_imagery_and_connectors, segment_corpus, token_words
+
+
+def _pid_generate(bundle, mode, num_lines, seed):
+    """GenerationPool 测试用的生成函数（模块级，可以发给工作进程）：mode 为 "empty" 时返回空诗"""
+    if mode == "empty":
+        return "" if multiprocessing.parent_process() is not None else "local"
+    return f"{os.getpid()}:" + bundle.markov.generate(num_lines, seed=seed)
+
+
+
+_test_cache_dir = None
+
+
+def setUpModule():
+    """分词缓存写到临时目录（训练任务等子进程通过环境变量继承），不写入仓库的 cache/segments"""
+    global _test_cache_dir
+    _test_cache_dir = tempfile.mkdtemp()
+    os.environ["SEGMENT_CACHE_DIR"] = _test_cache_dir
+    utils.SEGMENT_CACHE_DIR = _test_cache_dir
+
+
+def tearDownModule():
+    shutil.rmtree(_test_cache_dir, ignore_errors=True)
 
 
 class TestPoemGenerator(unittest.TestCase):
@@ -25,6 +55,51 @@ class TestPoemGenerator(unittest.TestCase):
         tokens = clean_and_tokenize(text)
         self.assertIn("\n", tokens)
 
+    def test_segment_corpus_matches_tokenize(self):
+        """Single-pass segmentation yields the same Markov tokens as clean_and_tokenize"""
+        text = "面朝大海，春暖花开\n\n从明天起，做一个幸福的人\r\n喂马、劈柴，周游世界"
+        token_data = segment_corpus(text)
+        self.assertEqual(token_words(token_data), clean_and_tokenize(text))
+        self.assertIn(("\n", "x", False), token_data)
+        self.assertTrue(any(is_imagery for _, _, is_imagery in token_data))
+
+    def test_segment_corpus_imagery_set(self):
+        """Out-of-dictionary fragments are tagged in context and do not become imagery"""
+        text = "爱你成病\n不停用白围裙\n磨过森林的古鹿之唇\n我们双膝如木\n亚洲铜，亚洲铜\n祖父死在这里"
+        token_data = segment_corpus(text, use_cache=False)
+        self.assertEqual(token_words(token_data), clean_and_tokenize(text))
+        imagery = {word for word, _, is_imagery in token_data if is_imagery}
+        self.assertEqual(imagery, {"亚洲", "古鹿", "围裙", "森林", "祖父", "铜"})
+
+    def test_segment_cache_roundtrip(self):
+        """Segmentation cache returns the same stream and is keyed by content"""
+        cache_dir = tempfile.mkdtemp()
+        old_dir = utils.SEGMENT_CACHE_DIR
+        utils.SEGMENT_CACHE_DIR = cache_dir
+        try:
+            # 含按上下文标注的词典外的词：同一个词（风上）在两行中的词性不同
+            text = "爱你成病\n不停用白围裙\n磨过森林的古鹿之唇\n我们双膝如木\n亚洲铜，亚洲铜\n祖父死在这里\n在风上相爱\n风吹在村庄的风上"
+            first = segment_corpus(text)
+            self.assertEqual(len({pos for word, pos, _ in first if word == "风上"}), 2)
+            path = utils.segment_cache_path(text)
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(utils.read_segment_cache(path), first)
+            self.assertEqual(segment_corpus(text), first)
+            # 内容变化后缓存键也随之变化
+            self.assertNotEqual(utils.segment_cache_path(text + "\n远方"), path)
+        finally:
+            utils.SEGMENT_CACHE_DIR = old_dir
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_segment_parallel_matches_serial(self):
+        """Parallel segmentation split on blank lines is identical to the serial path"""
+        text = "面朝大海\n春暖花开\n\n从明天起\n做一个幸福的人\n\n喂马劈柴\n周游世界"
+        chunks = utils.split_on_blank_lines(text, 3)
+        self.assertEqual("\n".join(chunks), text)
+        serial = segment_corpus(text, use_cache=False)
+        parallel = segment_corpus(text, use_cache=False, workers=2)
+        self.assertEqual(parallel, serial)
+
     def test_markov_train_and_generate(self):
         """Test the core chain logic with a deterministic pattern"""
         # Pattern: A -> B -> C -> A ...
@@ -39,6 +114,9 @@ class TestPoemGenerator(unittest.TestCase):
         self.assertIn(("A",), model.chain)
         # 由于训练数据中 A->B 出现两次，所以 chain 中会有两个 "B"
         self.assertEqual(model.chain[("A",)], ["B", "B"])
+        # 内部按计数存储：重复的后继只存一次
+        self.assertEqual(model.successors(("A",)), {"B": 2})
+        self.assertEqual(model.successors(("C",)), {"A": 1})
 
         # Test Generation
         # It should generate a sequence of A B C ...
@@ -54,6 +132,73 @@ class TestPoemGenerator(unittest.TestCase):
         )
         self.assertTrue(len(line) > 3)
 
+    def test_markov_switch_order(self):
+        """One trie serves every order up to max_order; switching does not retrain"""
+        tokens = clean_and_tokenize("在北方的夜晚\n我看见了星星\n大地沉默\n远方的灯火\n星星照着大地")
+        model = MarkovChain(order=1)
+        model.train(tokens)
+        for order in (2, 3):
+            switched = model.with_order(order)
+            self.assertIs(switched.trie, model.trie)
+            trained = MarkovChain(order=order)
+            trained.train(tokens)
+            self.assertEqual(dict(switched.chain), dict(trained.chain))
+            self.assertEqual(list(switched.start_cum), list(trained.start_cum))
+            self.assertEqual(switched.generate(seed=3), trained.generate(seed=3))
+        with self.assertRaises(ValueError):
+            model.with_order(model.max_order + 1)
+
+        bundle = registry.ModelBundle.from_models(
+            pipeline.train_models("在北方的夜晚\n大地沉默", order=1), "tiny.txt", 1
+        )
+        self.assertIs(bundle.with_order(2), bundle.with_order(2))
+        self.assertIs(bundle.with_order(2).with_order(1), bundle)
+        self.assertIs(bundle.with_order(2).imagery, bundle.imagery)
+        self.assertEqual(bundle.with_order(3).markov_order, 3)
+        self.assertEqual(sorted(bundle.variants), [1, 2, 3])
+
+    def test_markov_backoff(self):
+        """Backoff mode keeps walking through contexts the plain chain cannot continue"""
+        # (B, D) 只在结尾出现，没有后继，普通 2 阶链走到这里就停止
+        tokens = ["A", "B", "C", "A", "B", "D"]
+        model = MarkovChain(order=2)
+        model.train(tokens)
+        self.assertEqual(model.successors(("B", "D")), {})
+        for seed in range(20):
+            plain = model.generate_line(seed=seed)
+            line = model.generate_line(seed=seed, backoff=True)
+            self.assertTrue(plain.endswith("D") or len(plain) == 22)
+            self.assertEqual(len(line), 22)
+            self.assertTrue(set(line) <= set("ABCD"))
+        self.assertEqual(model.generate(seed=4, backoff=True), model.generate(seed=4, backoff=True))
+
+    def test_imagery_chain_tables(self):
+        """ImageryChain compiles transitions into count tables over word ids"""
+        token_data = [
+            ("月亮", "n", True), ("照着", "v", False), ("麦地", "n", True), ("\n", "x", False),
+            ("月亮", "n", True), ("照着", "v", False), ("村庄", "n", True), ("\n", "x", False),
+        ]
+        chain = ImageryChain()
+        chain.train(token_data)
+        vocab = chain.vocab
+        moon, shine = vocab.get("月亮"), vocab.get("照着")
+        self.assertEqual(chain.imagery_to_connector.successors(moon), {shine: 2})
+        self.assertEqual(
+            chain.connector_to_imagery.successors(shine),
+            {vocab.get("麦地"): 1, vocab.get("村庄"): 1},
+        )
+        self.assertEqual(len(chain.line_starters), 1)
+        line = chain.generate_line()
+        self.assertIn(line, ("月亮照着麦地", "月亮照着村庄"))
+
+        # 再次 train() 从头训练，不残留上一次的意象词和连接词
+        retrain = [("雪", "n", True), ("落在", "v", False), ("山岗", "n", True), ("\n", "x", False)]
+        chain.train(retrain)
+        fresh = ImageryChain()
+        fresh.train(retrain)
+        self.assertEqual(chain.to_state(), fresh.to_state())
+        self.assertEqual(chain.imagery, {"雪", "山岗"})
+
     def test_generation_safety(self):
         """Test generation on empty model shouldn't crash"""
         model = MarkovChain()
@@ -61,6 +206,592 @@ class TestPoemGenerator(unittest.TestCase):
         # generate() 默认生成5行，每行都是 "Model not trained."
         self.assertIn("Model not trained.", res)
 
+    def test_generate_batch(self):
+        """generate_batch returns n poems per model and is reproducible with a seed"""
+        text = "在北方的夜晚\n我看见了星星\n大地沉默\n远方的灯火"
+        models = pipeline.train_models(text, order=1)
+        for model in models.values():
+            poems = model.generate_batch(20, seed=7)
+            self.assertEqual(len(poems), 20)
+            self.assertEqual(poems, model.generate_batch(20, seed=7))
+            self.assertTrue(all(isinstance(poem, str) and poem for poem in poems))
+
+        # 每首诗的每一行都是一次独立的随机游走
+        for poem in models["markov"].generate_batch(10, num_lines=3, seed=1):
+            lines = poem.split("\n")
+            self.assertEqual(len(lines), 3)
+            self.assertTrue(all(line.strip() for line in lines))
+
+    def test_seeded_generation(self):
+        """The same seed (int or random.Random) always gives the same poem"""
+        text = "在北方的夜晚\n我看见了星星\n大地沉默\n远方的灯火\n星星照着大地"
+        models = pipeline.train_models(text, order=1)
+        for model in models.values():
+            self.assertEqual(model.generate(seed=123), model.generate(seed=123))
+            self.assertEqual(
+                model.generate(seed=random.Random(5)), model.generate(seed=random.Random(5))
+            )
+
+    def test_registry_publishes_bundle(self):
+        """ModelRegistry publishes a complete, immutable bundle in one swap"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "tiny.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("在北方的夜晚\n我看见了星星\n大地沉默\n远方的灯火")
+            reg = registry.ModelRegistry()
+            self.assertIsNone(reg.current)
+
+            thread = reg.load_in_background(path, order=1, use_snapshot=False)
+            thread.join()
+            bundle = reg.current
+            self.assertEqual((bundle.corpus, bundle.markov_order), ("tiny.txt", 1))
+            self.assertTrue(bundle.markov.is_trained())
+            with self.assertRaises(AttributeError):
+                bundle.markov = None
+
+            # 加载失败时继续使用原来的模型
+            _, error = reg.load(os.path.join(tmp_dir, "missing.txt"))
+            self.assertIsNotNone(error)
+            self.assertIs(reg.current, bundle)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_registry_lru_eviction(self):
+        """Bundles are cached per (corpus, order) and evicted LRU, never the current one"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            paths = []
+            for name, text in (("a", "在北方的夜晚\n大地沉默"), ("b", "我看见了星星\n远方的灯火"),
+                               ("c", "面朝大海\n春暖花开")):
+                paths.append(os.path.join(tmp_dir, f"{name}.txt"))
+                with open(paths[-1], "w", encoding="utf-8") as f:
+                    f.write(text)
+            a, b, c = paths
+
+            # 预算只够一组：每次放入新的模型组都会淘汰其它非默认的
+            reg = registry.ModelRegistry(max_bytes=1)
+            current, _ = reg.load(a, order=1, use_snapshot=False)
+            bundle_b, _ = reg.get_or_load(b, order=1, use_snapshot=False)
+            self.assertIs(reg.get_or_load(b, order=1)[0], bundle_b)
+            self.assertIsNotNone(reg.get_or_load(c, order=1, use_snapshot=False)[0])
+            self.assertIsNone(reg.get(b, 1))
+            self.assertIs(reg.get(a, 1), current)
+            self.assertIs(reg.current, current)
+            self.assertGreater(current.size_bytes, 0)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_training_job_progress(self):
+        """Training jobs run in a worker process, report progress and publish when done"""
+        tmp_dir = tempfile.mkdtemp()
+        old_dir = utils.SEGMENT_CACHE_DIR
+        utils.SEGMENT_CACHE_DIR = tmp_dir
+        try:
+            path = os.path.join(tmp_dir, "tiny.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("在北方的夜晚\n我看见了星星\n大地沉默\n远方的灯火")
+            reg = registry.ModelRegistry()
+            manager = jobs.JobManager(reg)
+            # 多线程的服务进程中不 fork 训练进程
+            self.assertNotEqual(utils.process_context().get_start_method(), "fork")
+
+            job = manager.submit(path, order=1, use_snapshot=False)
+            self.assertIs(manager.get(job.id), job)
+            self.assertTrue(job.wait(60))
+            self.assertEqual(job.to_dict()["status"], "done", job.error)
+            self.assertEqual(job.to_dict()["progress"], 100.0)
+            self.assertEqual((reg.current.corpus, reg.current.markov_order), ("tiny.txt", 1))
+            self.assertTrue(reg.current.markov.is_trained())
+
+            failed = manager.submit(os.path.join(tmp_dir, "missing.txt"), order=1)
+            self.assertTrue(failed.wait(60))
+            self.assertEqual(failed.status, "failed")
+            self.assertIsNotNone(failed.error)
+            self.assertEqual(reg.current.corpus, "tiny.txt")
+        finally:
+            utils.SEGMENT_CACHE_DIR = old_dir
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_poem_pool(self):
+        """The poem pool refills in the background and drops poems of a replaced bundle"""
+        text = "在北方的夜晚\n我看见了星星\n大地沉默\n远方的灯火"
+        bundle = registry.ModelBundle.from_models(pipeline.train_models(text, order=1), "tiny.txt", 1)
+        poems = pool.PoemPool(
+            lambda b, mode, num_lines, n: b.markov.generate_batch(n, num_lines), high_water=8
+        )
+        self.assertIsNone(poems.get(bundle, "markov", 3))  # 第一次未命中，触发补充
+        for _ in range(100):
+            if poems.stats()["refills"]:
+                break
+            time.sleep(0.05)
+        poem = poems.get(bundle, "markov", 3)
+        self.assertEqual(len(poem.split("\n")), 3)
+        self.assertEqual((poems.metrics["hits"], poems.metrics["misses"]), (1, 1))
+
+        # 同一语料的模型组被替换后，旧模型生成的诗不再取出
+        retrained = registry.ModelBundle.from_models(pipeline.train_models(text, order=1), "tiny.txt", 1)
+        poems.invalidate(retrained)
+        self.assertEqual(poems.stats()["pools"], [])
+        self.assertIsNone(poems.get(retrained, "markov", 3))
+
+        # 补充失败时记录到日志和 stats()，不打印到标准输出
+        def fail(b, mode, num_lines, n):
+            raise RuntimeError("boom")
+
+        failing = pool.PoemPool(fail, high_water=4)
+        with self.assertLogs("src.pool", level="ERROR"):
+            failing.get(bundle, "markov", 3)
+            for _ in range(100):
+                if failing.stats()["errors"]:
+                    break
+                time.sleep(0.05)
+        self.assertIn("boom", failing.stats()["last_error"])
+
+    def test_generation_pool(self):
+        """Worker processes receive the default bundle and generate the same seeded poems"""
+        text = "在北方的夜晚\n我看见了星星\n大地沉默\n远方的灯火"
+        reg = registry.ModelRegistry()
+        bundle = registry.ModelBundle.from_models(pipeline.train_models(text, order=1), "tiny.txt", 1)
+        reg.publish(bundle, "tiny.txt")
+
+        gen_pool = workers.GenerationPool(reg, _pid_generate, workers=1)
+        gen_pool.start()
+        try:
+            pid, poem = gen_pool.generate_poem(bundle, "markov", 3, 42).split(":", 1)
+            self.assertNotEqual(int(pid), os.getpid())
+            self.assertEqual(poem, bundle.markov.generate(3, seed=42))
+            # 工作进程生成的空诗也直接返回，不在当前进程重新生成
+            self.assertEqual(gen_pool.generate_poem(bundle, "empty", 3, 42), "")
+            # 进程池创建之后才加载的模型组在当前进程中生成
+            later = registry.ModelBundle.from_models(pipeline.train_models(text, order=1), "later.txt", 1)
+            pid, _ = gen_pool.generate_poem(later, "markov", 3, 42).split(":", 1)
+            self.assertEqual(int(pid), os.getpid())
+        finally:
+            gen_pool.shutdown()
+
+        # 默认模型组连续被替换时进程池只在 restart_delay 之后重建一次，期间新模型组在当前进程生成
+        gen_pool = workers.GenerationPool(reg, _pid_generate, workers=1, restart_delay=1.0)
+        gen_pool.start()
+        reg.add_listener(gen_pool.restart)
+        starts = []
+        start = gen_pool.start
+        gen_pool.start = lambda: (start(), starts.append(reg.current))
+        try:
+            for _ in range(3):
+                bundle = bundle.appended("远方的灯火", "tiny.txt")
+                reg.replace("tiny.txt", bundle)
+            pid, _ = gen_pool.generate_poem(bundle, "markov", 3, 42).split(":", 1)
+            self.assertEqual(int(pid), os.getpid())
+            for _ in range(100):
+                if starts:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(starts, [bundle])
+            pid, _ = gen_pool.generate_poem(bundle, "markov", 3, 42).split(":", 1)
+            self.assertNotEqual(int(pid), os.getpid())
+        finally:
+            gen_pool.shutdown()
+
+        # 工作进程加载不了的模型组记录到日志并跳过（请求退回当前进程生成）
+        payload = dict(workers.bundle_payload(bundle), model_file=("/nonexistent/tiny.flat", 0))
+        with self.assertLogs("src.workers", level="ERROR"):
+            workers._init_worker(_pid_generate, [payload])
+        self.assertIsNone(workers._find_bundle(bundle.corpus, bundle.created_at, 1))
+
+    def test_iter_lines_matches_generate(self):
+        """Streaming generation yields, line by line, the same poem generate() returns"""
+        text = "在北方的夜晚\n我看见了星星\n大地沉默\n远方的灯火"
+        models = pipeline.train_models(text, order=1)
+        for seed in range(5):
+            self.assertEqual("\n".join(models["markov"].iter_lines(4, seed=seed)), models["markov"].generate(4, seed=seed))
+            self.assertEqual(
+                "\n".join(models["markov"].iter_lines(4, seed=seed, backoff=True)),
+                models["markov"].generate(4, seed=seed, backoff=True),
+            )
+            self.assertEqual("\n".join(models["imagery"].iter_lines(4, seed=seed)), models["imagery"].generate(4, seed=seed))
+            lines = list(models["structured"].iter_lines(3, seed=seed))
+            self.assertEqual(lines[1], "")
+            self.assertEqual("\n".join(lines), models["structured"].generate(3, seed=seed))
+        self.assertEqual(list(ImageryChain().iter_lines(3)), ["模型未训练"])
+
+    def test_generate_batch_ndjson(self):
+        """The bulk endpoint streams one JSON poem per line; seeded poems match /api/generate"""
+        import json
+        import web_app
+
+        text = "在北方的夜晚\n我看见了星星\n大地沉默\n远方的灯火"
+        bundle = registry.ModelBundle.from_models(pipeline.train_models(text, order=1), "tiny.txt", 1)
+        web_app.registry.publish(bundle, "tiny.txt")
+        client = web_app.app.test_client()
+        count = web_app.BATCH_CHUNK + 3
+        response = client.post("/api/generate/batch", json={"mode": "markov", "count": count, "seed": 10})
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([row["index"] for row in rows], list(range(count)))
+        single = client.post("/api/generate", json={"mode": "markov", "seed": rows[-1]["seed"]}).get_json()
+        self.assertEqual(single["poem"], rows[-1]["poem"])
+        for body in ({"count": 0}, {"count": "9"}, {"seed": "x"}, {"mode": "sonnet"}):
+            response = client.post("/api/generate/batch", json=body)
+            self.assertEqual(response.status_code, 400, body)
+            self.assertFalse(response.get_json()["success"])
+        for body in ({"seed": "x"}, {"seed": True}, {"mode": "sonnet"}):
+            response = client.post("/api/generate", json=body)
+            self.assertEqual(response.status_code, 400, body)
+            self.assertFalse(response.get_json()["success"])
+        stream = client.get("/api/generate/stream?mode=sonnet").get_data(as_text=True)
+        self.assertTrue(stream.startswith("event: error"))
+
+    def test_generate_num_lines_validation(self):
+        """num_lines must be a non-negative integer (400 otherwise) and is clamped to MAX_NUM_LINES"""
+        import json
+        import web_app
+
+        text = "在北方的夜晚\n我看见了星星\n大地沉默\n远方的灯火"
+        bundle = registry.ModelBundle.from_models(pipeline.train_models(text, order=1), "tiny.txt", 1)
+        web_app.registry.publish(bundle, "tiny.txt")
+        client = web_app.app.test_client()
+        for url in ("/api/generate", "/api/generate/batch"):
+            for bad in (-1, "many", 2.5, True, None):
+                response = client.post(url, json={"mode": "markov", "num_lines": bad})
+                self.assertEqual(response.status_code, 400, (url, bad))
+                self.assertFalse(response.get_json()["success"])
+        poem = client.post("/api/generate", json={"mode": "markov", "num_lines": 10**9, "seed": 1}).get_json()["poem"]
+        self.assertEqual(poem, bundle.markov.generate(web_app.MAX_NUM_LINES, seed=1))
+        response = client.post("/api/generate/batch", json={"mode": "markov", "num_lines": 10**9, "count": 2, "seed": 1})
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(rows[0]["poem"], poem)
+        stream = client.get("/api/generate/stream?mode=markov&num_lines=-3").get_data(as_text=True)
+        self.assertTrue(stream.startswith("event: error"))
+
+    def test_order_validation(self):
+        """Orders outside 1..MarkovChain.MAX_ORDER are rejected with 400 before any model is built"""
+        import web_app
+
+        text = "在北方的夜晚\n我看见了星星\n大地沉默\n远方的灯火"
+        bundle = registry.ModelBundle.from_models(pipeline.train_models(text, order=1), "tiny.txt", 1)
+        web_app.registry.publish(bundle, "tiny.txt")
+        client = web_app.app.test_client()
+        for bad in (0, 1000, "x", 2.5, True):
+            for url, body in (
+                ("/api/generate", {"mode": "markov"}),
+                ("/api/generate/batch", {"mode": "markov", "count": 1}),
+                ("/api/corpus/append", {"text": "大地沉默", "save": False}),
+                ("/api/corpus/load", {"corpus": "tiny.txt"}),
+            ):
+                response = client.post(url, json=dict(body, order=bad))
+                self.assertEqual(response.status_code, 400, (url, bad))
+                self.assertFalse(response.get_json()["success"])
+        stream = client.get("/api/generate/stream?order=1000").get_data(as_text=True)
+        self.assertTrue(stream.startswith("event: error"))
+        self.assertEqual(web_app.parse_order(str(MarkovChain.MAX_ORDER)), (MarkovChain.MAX_ORDER, None))
+
+    def test_cli_batch_generate(self):
+        """main.py generate writes one JSON poem per line, reproducible from the base seed"""
+        import json
+        import main
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            corpus = os.path.join(tmp_dir, "tiny_cli.txt")
+            with open(corpus, "w", encoding="utf-8") as f:
+                f.write("在北方的夜晚\n我看见了星星\n大地沉默\n远方的灯火")
+            out = os.path.join(tmp_dir, "poems.jsonl")
+            count = main.BATCH_CHUNK + 2
+            code = main.batch_generate(corpus, mode="markov", order=1, count=count, seed=3, output=out)
+            self.assertEqual(code, 0)
+            with open(out, encoding="utf-8") as f:
+                rows = [json.loads(line) for line in f]
+            self.assertEqual(len(rows), count)
+            self.assertEqual(rows[-1]["seed"], 3 + count - 1)
+            self.assertEqual(rows[-1]["poem"], pipeline.generate_poem(main._batch_models, "markov", 4, rows[-1]["seed"]))
+            # 命令行与 web_app 用同一个生成函数：模型组与模型字典得到相同的诗
+            bundle = registry.ModelBundle.from_models(main._batch_models, corpus, 1)
+            for mode in ("structured", "imagery", "backoff", "markov"):
+                self.assertEqual(
+                    pipeline.generate_poem(bundle, mode, 4, 7),
+                    pipeline.generate_poem(main._batch_models, mode, 4, 7),
+                )
+            self.assertEqual(main.batch_generate(os.path.join(tmp_dir, "missing.txt")), 1)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_cli_generate_rejects_bad_counts(self):
+        """main.py generate rejects --count / --lines / --gen-workers below 1 and unsupported orders"""
+        import io
+        import contextlib
+        import main
+
+        self.assertEqual(main.parse_args(["generate", "-n", "5", "--lines", "2"]).count, 5)
+        for argv in (["-n", "0"], ["-n", "-3"], ["--lines", "0"], ["--gen-workers", "0"], ["--order", "9"]):
+            with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+                main.parse_args(["generate"] + argv)
+        self.assertEqual(main.parse_args(["snapshot", "--order", "1", "3"]).order, [1, 3])
+        for argv in (["--order", "0"], ["--order", "2", "9"], ["--shards", "0"]):
+            with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+                main.parse_args(["snapshot"] + argv)
+
+    def test_train_incremental_matches_retrain(self):
+        """Appending text incrementally gives the same models as training on the whole corpus"""
+        old = "在北方的夜晚\n我看见了星星\n大地沉默"
+        new = "远方的灯火照着大地\n黑夜给了我黑色的眼睛\n我看见了远方"
+        base = pipeline.train_models(old, order=2)
+        before = base["markov"].generate(seed=1)
+        updated = pipeline.append_models(base, new)
+        full = pipeline.train_models(old + "\n" + new, order=2)
+        for name in ("markov", "imagery", "structured"):
+            for seed in range(5):
+                self.assertEqual(updated[name].generate(seed=seed), full[name].generate(seed=seed))
+        self.assertEqual(updated["markov"].trie.to_state(), full["markov"].trie.to_state())
+        self.assertEqual(updated["markov"].vocab.words, full["markov"].vocab.words)
+        self.assertEqual(updated["imagery"].to_state(), full["imagery"].to_state())
+        self.assertEqual(updated["structured"].get_stats(), full["structured"].get_stats())
+        # 原来的模型不受影响
+        self.assertEqual(base["markov"].generate(seed=1), before)
+        self.assertNotIn("灯火", base["markov"].vocab.words)
+
+        # 模型组的内存占用由旧模型组推算，不再遍历整个模型
+        from unittest import mock
+
+        bundle = registry.ModelBundle.from_models(base, "tiny.txt", 2)
+        with mock.patch.object(MarkovChain, "to_state", side_effect=AssertionError("full walk")):
+            appended = bundle.appended(new, "tiny.txt")
+        self.assertGreater(appended.size_bytes, bundle.size_bytes)
+        self.assertEqual(appended.markov.generate(seed=1), full["markov"].generate(seed=1))
+        self.assertEqual(bundle.markov.generate(seed=1), before)
+
+    def test_structured_incremental_copy_on_write(self):
+        """Repeated appends match a retrain; only the containers the new lines touch are copied"""
+        import copy
+
+        parts = ["在北方的夜晚\n我看见了星星\n大地沉默", "黑夜给了我黑色的眼睛\n我看见了远方", "像一只鸟飞过天空\n我看见了远方"]
+        base = pipeline.train_models(parts[0], order=1)["structured"]
+        state = copy.deepcopy(base.to_state())
+        model = base
+        for part in parts[1:]:
+            model = copy.copy(model).train_incremental(part)
+        full = pipeline.train_models("\n".join(parts), order=1)["structured"]
+        self.assertEqual(model.to_state(), full.to_state())
+        self.assertEqual(model._line_index, {line: i for i, line in enumerate(full.lines)})
+        self.assertEqual(base.to_state(), state)
+        # 新文本只有一行重复的诗行、没有新词：行表、词集合和未涉及的角度都与原模型共用
+        again = copy.copy(model).train_incremental("像一只鸟飞过天空")
+        self.assertIs(again.lines, model.lines)
+        self.assertIs(again.imagery, model.imagery)
+        self.assertIs(again.phrase_ids["否定"], model.phrase_ids["否定"])
+        self.assertIsNot(again.phrase_ids["方式"], model.phrase_ids["方式"])
+        self.assertEqual(len(again.phrase_ids["方式"]), len(model.phrase_ids["方式"]) + 1)
+        self.assertEqual(model.to_state(), full.to_state())
+
+    def test_sharded_training_merges_exactly(self):
+        """Models trained on corpus shards merge into the single-pass model"""
+        text = "在北方的夜晚\n我看见了星星\n\n大地沉默\n远方的灯火\n\n黑夜给了我黑色的眼睛\n我看见了远方"
+        full = pipeline.train_models(text, order=2)
+        cached = set(os.listdir(utils.SEGMENT_CACHE_DIR))
+        merged = pipeline.train_sharded(text, order=2, shards=3)
+        # 分片的分词结果不写入缓存
+        self.assertEqual(set(os.listdir(utils.SEGMENT_CACHE_DIR)), cached)
+        self.assertEqual(merged["markov"].trie.to_state(), full["markov"].trie.to_state())
+        self.assertEqual(list(merged["markov"].start_cum), list(full["markov"].start_cum))
+        self.assertEqual(merged["imagery"].to_state(), full["imagery"].to_state())
+        self.assertEqual(merged["structured"].to_state(), full["structured"].to_state())
+        for name in ("markov", "imagery", "structured"):
+            self.assertEqual(merged[name].generate(seed=2), full[name].generate(seed=2))
+        with self.assertRaises(ValueError):
+            MarkovChain.merge([MarkovChain(order=2), MarkovChain(order=2, max_order=4)])
+
+    def test_streaming_training_matches_whole_corpus(self):
+        """Training on a corpus read in chunks gives the single-pass models"""
+        text = "在北方的夜晚\n我看见了星星\n\n大地沉默\n远方的灯火\n\n黑夜给了我黑色的眼睛\n我看见了远方\n"
+        full = pipeline.train_models(text, order=2)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "stream.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+            self.assertEqual(utils.corpus_digest(path), snapshot.text_digest(text))
+            self.assertEqual("".join(utils.iter_corpus(path, chunk_lines=2)), text)
+            cached = set(os.listdir(utils.SEGMENT_CACHE_DIR))
+            streamed = pipeline.train_stream(utils.iter_corpus(path, chunk_lines=2), order=2)
+            # 各块的分词结果不写入缓存
+            self.assertEqual(set(os.listdir(utils.SEGMENT_CACHE_DIR)), cached)
+            self.assertEqual(streamed["markov"].trie.to_state(), full["markov"].trie.to_state())
+            self.assertEqual(streamed["imagery"].to_state(), full["imagery"].to_state())
+            self.assertEqual(streamed["structured"].to_state(), full["structured"].to_state())
+            for name in ("markov", "imagery", "structured"):
+                self.assertEqual(streamed[name].generate(seed=2), full[name].generate(seed=2))
+            self.assertIsNone(utils.corpus_digest(os.path.join(tmp_dir, "missing.txt")))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_streaming_single_chunk_uses_workers(self):
+        """A corpus smaller than one chunk is still segmented by all workers, with progress"""
+        poems = ["在北方的夜晚\n我看见了星星", "大地沉默\n远方的灯火", "黑夜给了我黑色的眼睛\n我看见了远方"]
+        text = "\n\n".join(poems * 4) + "\n"
+        tmp_dir = tempfile.mkdtemp()
+        old_dir, old_parallel = utils.SEGMENT_CACHE_DIR, utils._segment_parallel
+        calls, reports = [], []
+
+        def segment_parallel(text, workers, progress=None):
+            calls.append(workers)
+            return old_parallel(text, workers, progress)
+
+        utils.SEGMENT_CACHE_DIR = tmp_dir
+        utils._segment_parallel = segment_parallel
+        try:
+            path = os.path.join(tmp_dir, "stream.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+            self.assertEqual(len(list(utils.iter_corpus(path))), 1)
+            streamed = pipeline.train_stream(
+                utils.iter_corpus(path), order=2, workers=2,
+                progress=lambda stage, fraction: reports.append((stage, fraction)),
+            )
+            # 只有一块时这一块就是整个语料，照常写入分词缓存
+            self.assertTrue(os.path.exists(utils.segment_cache_path(text)))
+        finally:
+            utils.SEGMENT_CACHE_DIR = old_dir
+            utils._segment_parallel = old_parallel
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.assertEqual(calls, [2])
+        fractions = [fraction for _, fraction in reports]
+        self.assertTrue(any(0 < fraction < 1 for fraction in fractions), reports)
+        self.assertEqual(fractions, sorted(fractions))
+        self.assertEqual(fractions[-1], 1.0)
+        full = pipeline.train_models(text, order=2)
+        self.assertEqual(streamed["structured"].to_state(), full["structured"].to_state())
+        self.assertEqual(streamed["markov"].generate(seed=2), full["markov"].generate(seed=2))
+
+    def test_fetch_huge_corpus_streams_json(self):
+        """JSON arrays and JSON lines are parsed incrementally into one corpus file"""
+        import io
+        import json
+        import fetch_huge_corpus
+
+        poems = [{"paragraphs": [f"第{i}行", "  ", f"远方{i}"]} for i in range(20)]
+        poems += [{"paragraphs": "单行诗"}, {"title": "无正文"}]
+        records = list(fetch_huge_corpus.iter_json_records(
+            io.StringIO(json.dumps(poems, ensure_ascii=False, indent=1)), read_size=7
+        ))
+        self.assertEqual(records, poems)
+        with self.assertRaises(fetch_huge_corpus.SourceError):
+            list(fetch_huge_corpus.iter_json_records(io.StringIO('[{"paragraphs": ["a"]}, {"par')))
+        # 逗号只能出现在两条记录之间
+        lines = '{"a": 1},\n{"a": 2}\n{"a": 3}\n'
+        self.assertEqual(len(list(fetch_huge_corpus.iter_json_records(io.StringIO(lines)))), 3)
+        for malformed in (',{"a": 1}', '[,{"a": 1}]', '{"a": 1},,{"a": 2}', '[{"a": 1},]',
+                          '{"a": 1},', '[{"a": 1} {"a": 2}]', '[]\n,'):
+            with self.assertRaises(fetch_huge_corpus.SourceError, msg=malformed):
+                list(fetch_huge_corpus.iter_json_records(io.StringIO(malformed), read_size=3))
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmp_dir, "src", "sub"))
+            with open(os.path.join(tmp_dir, "src", "a.json"), "w", encoding="utf-8") as f:
+                json.dump(poems[:10], f, ensure_ascii=False)
+            with open(os.path.join(tmp_dir, "src", "sub", "b.jsonl"), "w", encoding="utf-8") as f:
+                for poem in poems[10:]:
+                    f.write(json.dumps(poem, ensure_ascii=False) + "\n")
+            output = os.path.join(tmp_dir, "out.txt")
+            count, _ = fetch_huge_corpus.fetch_huge_corpus(
+                [os.path.join(tmp_dir, "src")], output, workers=2, verbose=False
+            )
+            self.assertEqual(count, 21)
+            with open(output, encoding="utf-8") as f:
+                text = f.read()
+            expected = [f"第{i}行\n远方{i}" for i in range(20)] + ["单行诗"]
+            self.assertEqual(text, "\n\n".join(expected))
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ["out.txt", "src"])
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_fetch_haizi_incremental_manifest(self):
+        """Only HTML files changed since the manifest was written are parsed again"""
+        import fetch_haizi
+
+        self.assertEqual(
+            fetch_haizi.clean_text("　亚洲铜\n  亚洲铜，亚洲铜 (1984.10)\n\n 1986\n\n\n【注】祖父死在这里"),
+            "亚洲铜\n亚洲铜，亚洲铜 \n\n注祖父死在这里",
+        )
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmp_dir, "01"))
+            paths = []
+            for name, line in (("001.htm", "亚洲铜"), ("002.htm", "阿尔的太阳")):
+                paths.append(os.path.join(tmp_dir, "01", name))
+                with open(paths[-1], "w", encoding="utf-8") as f:
+                    f.write(f"<blockquote><p>{line}<br>1984.10</p></blockquote>")
+            self.assertEqual(fetch_haizi.find_sources(tmp_dir, ["01", "02"]), paths)
+
+            poems, manifest, parsed = fetch_haizi.extract_incremental(paths, tmp_dir, {})
+            self.assertEqual(poems, ["亚洲铜", "阿尔的太阳"])
+            self.assertEqual(parsed, paths)
+            _, _, parsed = fetch_haizi.extract_incremental(paths, tmp_dir, manifest)
+            self.assertEqual(parsed, [])
+
+            with open(paths[1], "w", encoding="utf-8") as f:
+                f.write("<blockquote><p>阿尔的太阳<br>一位是燃烧的</p></blockquote>")
+            os.utime(paths[0])
+            poems, _, parsed = fetch_haizi.extract_incremental(paths, tmp_dir, manifest)
+            self.assertEqual(parsed, [paths[1]])
+            self.assertEqual(poems, ["亚洲铜", "阿尔的太阳\n一位是燃烧的"])
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_snapshot_roundtrip(self):
+        """Snapshots restore all three models and reject stale corpora"""
+        text = "在北方的夜晚\n我看见了星星\n大地沉默\n远方的灯火"
+        models = pipeline.train_models(text, order=1)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "test.snap")
+            snapshot.save_snapshot(path, models, {"corpus_sha256": snapshot.text_digest(text)})
+            loaded, meta = snapshot.load_snapshot(path, expected_digest=snapshot.text_digest(text))
+            self.assertEqual(loaded["markov"].chain, models["markov"].chain)
+            self.assertEqual(loaded["imagery"].to_state(), models["imagery"].to_state())
+            self.assertEqual(loaded["structured"].endings, models["structured"].endings)
+            with self.assertRaises(snapshot.SnapshotError):
+                snapshot.load_snapshot(path, expected_digest=snapshot.text_digest(text + "!"))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_flat_model_roundtrip(self):
+        """Memory-mapped flat models generate the same seeded poems as the trained ones"""
+        text = "在北方的夜晚\n我看见了星星\n大地沉默\n远方的灯火\n黑夜给了我黑色的眼睛"
+        models = pipeline.train_models(text, order=2)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "test.flat")
+            flatmodel.save_flat(path, models, {"corpus_sha256": snapshot.text_digest(text)})
+            loaded, meta = flatmodel.load_flat(path, expected_digest=snapshot.text_digest(text))
+            self.assertIsInstance(loaded["markov"].vocab.words, tables.StringTable)
+            for name in ("markov", "imagery", "structured"):
+                for seed in range(5):
+                    self.assertEqual(loaded[name].generate(seed=seed), models[name].generate(seed=seed))
+            self.assertEqual(
+                loaded["markov"].with_order(1).generate(seed=3), models["markov"].with_order(1).generate(seed=3)
+            )
+            self.assertEqual(loaded["structured"].get_stats(), models["structured"].get_stats())
+            with self.assertRaises(snapshot.SnapshotError):
+                flatmodel.load_flat(path, expected_digest=snapshot.text_digest(text + "!"))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_structured_phrase_index(self):
+        """Lines are classified once and stored as index arrays into a deduplicated table"""
+        lines = ["如果黎明不再来临", "面朝大海春暖花开", "如果黎明不再来临", "你好吗朋友", "直到天亮了", "短"]
+        gen = StructuredPoemGenerator()
+        gen._learn_phrases_from_lines(lines)
+        # 与逐个关键词做子串查找的结果一致
+        for category, keywords in gen.PHRASE_KEYWORDS.items():
+            expected = [line for line in lines if len(line) >= 4 and any(k in line for k in keywords)]
+            self.assertEqual(list(gen.learned_phrases[category]), expected, category)
+        self.assertEqual(list(gen.endings), ["直到天亮了"])
+        # 重复的行在行表中只存一份，未归类的行不存
+        self.assertEqual(gen.lines.count("如果黎明不再来临"), 1)
+        self.assertNotIn("你好吗朋友", gen.lines)
+        self.assertEqual(list(gen.phrase_ids["条件"]), [0, 0])
+
     def test_structured_generator(self):
         """Test StructuredPoemGenerator with sample data"""
         # 准备测试数据
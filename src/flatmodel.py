@@ -0,0 +1,217 @@
+"""
+扁平模型文件：三个模型的数据按原始字节平铺在一个文件里，加载时直接 mmap，不反序列化
+
+与 pickle 快照（src/snapshot.py）相比，加载几乎不花时间也不占用进程私有内存：
+计数数组是 mmap 上的只读 memoryview，词表等字符串列表是按需解码的 StringTable。
+多个进程（gunicorn worker、生成进程池）映射同一个文件时共享操作系统的页缓存，
+物理内存中只有一份模型
+
+文件布局:
+    魔数 FLAT_MAGIC
+    格式版本 (uint16) + 保留 (uint16) + 目录长度 (uint32)，little-endian
+    目录: UTF-8 编码的 JSON，{"meta": {...}, "byteorder": ..., "models": {...}}
+        models 为三个模型的 to_state() 结果，其中的大块数据替换为引用:
+        {"$array": [typecode, offset, length]}          整数数组
+        {"$strings": [blob, offsets, order]}            字符串列表（三个 $array 引用）
+        {"$set": [blob, offsets, order]}                字符串集合（排序后按列表保存）
+        {"$ragged": [strings, offsets]}                 字符串列表的列表
+    数据区: 各数组的原始字节，每段按 8 字节对齐，offset 从数据区起点算起
+
+模型结构变化时与 SNAPSHOT_VERSION 一起递增 FLAT_VERSION
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+from array import array
+from collections.abc import Sequence
+
+import numpy as np
+
+from src.tables import StringTable
+from src.snapshot import MODEL_CLASSES, SNAPSHOT_DIR, SnapshotError
+
+FLAT_MAGIC = b"MPGFLAT\n"
+FLAT_VERSION = 1
+
+_HEADER = struct.Struct("<HHI")
+_ALIGN = 8
+
+
+def flat_path(corpus_file, order, snapshot_dir=None):
+    """语料文件 + 马尔可夫阶数对应的默认扁平模型文件路径（与快照放在同一目录）"""
+    name = os.path.splitext(os.path.basename(corpus_file))[0]
+    return os.path.join(snapshot_dir or SNAPSHOT_DIR, f"{name}.order{order}.flat")
+
+
+class RaggedStrings(Sequence):
+    """只读的字符串列表的列表：所有字符串放在一个 StringTable 中，offsets 划分各组"""
+
+    def __init__(self, strings, offsets):
+        self.strings = strings
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return self.strings[self.offsets[i]:self.offsets[i + 1]]
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+def _is_strings(value):
+    return all(isinstance(item, str) for item in value)
+
+
+class _Writer:
+    """把 to_state() 的结果拆成 JSON 目录与数据区"""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def _add(self, data):
+        padding = -self.size % _ALIGN
+        if padding:
+            self.chunks.append(b"\0" * padding)
+            self.size += padding
+        offset = self.size
+        self.chunks.append(data)
+        self.size += len(data)
+        return offset
+
+    def array(self, typecode, values):
+        data = np.ascontiguousarray(values, dtype=np.dtype(typecode)).tobytes()
+        return {"$array": [typecode, self._add(data), len(values)]}
+
+    def strings(self, strings):
+        table = strings if isinstance(strings, StringTable) else StringTable.from_strings(strings)
+        return [
+            self.array("B", np.frombuffer(table.blob, dtype=np.uint8)),
+            self.array("q", table.offsets),
+            self.array("i", table.order),
+        ]
+
+    def encode(self, value):
+        if isinstance(value, (array, memoryview)):
+            typecode = value.typecode if isinstance(value, array) else value.format
+            return self.array(typecode, value)
+        if isinstance(value, StringTable):
+            return {"$strings": self.strings(value)}
+        if isinstance(value, (set, frozenset)) and _is_strings(value):
+            return {"$set": self.strings(sorted(value))}
+        if isinstance(value, RaggedStrings):
+            value = list(value)
+        if isinstance(value, Sequence) and not isinstance(value, str):
+            if value and _is_strings(value):
+                return {"$strings": self.strings(value)}
+            if value and all(isinstance(item, list) and _is_strings(item) for item in value):
+                offsets = np.zeros(len(value) + 1, dtype=np.int64)
+                np.cumsum([len(item) for item in value], out=offsets[1:])
+                return {"$ragged": [
+                    self.strings([s for item in value for s in item]),
+                    self.array("q", offsets),
+                ]}
+            return [self.encode(item) for item in value]
+        if isinstance(value, dict):
+            if any(not isinstance(k, str) or k.startswith("$") for k in value):
+                raise TypeError("扁平模型文件只支持不以 $ 开头的字符串键")
+            return {k: self.encode(v) for k, v in value.items()}
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        raise TypeError(f"扁平模型文件不支持的类型: {type(value).__name__}")
+
+
+def _decode(value, data):
+    """把目录中的引用换成 data（数据区的 memoryview）上的视图"""
+    if isinstance(value, list):
+        return [_decode(item, data) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if "$array" in value:
+        typecode, offset, length = value["$array"]
+        end = offset + length * struct.calcsize(typecode)
+        return data[offset:end].cast(typecode)
+    if "$strings" in value:
+        return StringTable(*_decode(value["$strings"], data))
+    if "$set" in value:
+        return StringTable(*_decode(value["$set"], data))
+    if "$ragged" in value:
+        strings, offsets = value["$ragged"]
+        return RaggedStrings(StringTable(*_decode(strings, data)), _decode(offsets, data))
+    return {k: _decode(v, data) for k, v in value.items()}
+
+
+def save_flat(path, models, meta):
+    """
+    保存扁平模型文件
+    models / meta: 同 snapshot.save_snapshot
+    """
+    writer = _Writer()
+    directory = {
+        "meta": dict(meta, created_at=time.time()),
+        "byteorder": sys.byteorder,
+        "models": {name: writer.encode(models[name].to_state()) for name in MODEL_CLASSES},
+    }
+    directory = json.dumps(directory, ensure_ascii=False).encode("utf-8")
+    # 数据区也按 8 字节对齐，mmap 上 cast 出的数组才是对齐的
+    header_size = len(FLAT_MAGIC) + _HEADER.size + len(directory)
+    directory += b" " * (-header_size % _ALIGN)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(FLAT_MAGIC)
+        f.write(_HEADER.pack(FLAT_VERSION, 0, len(directory)))
+        f.write(directory)
+        for chunk in writer.chunks:
+            f.write(chunk)
+    os.replace(tmp_path, path)
+
+
+def load_flat(path, expected_digest=None):
+    """
+    以只读 mmap 加载扁平模型文件
+    expected_digest: 同 snapshot.load_snapshot
+    返回 (models, meta)，出错时抛出 SnapshotError
+    """
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < len(FLAT_MAGIC) + _HEADER.size:
+                raise SnapshotError(f"不是扁平模型文件: {path}")
+            # 映射建立后即可关闭文件，映射本身由各数组视图保持
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError as e:
+        raise SnapshotError(f"无法读取扁平模型文件: {e}") from e
+
+    try:
+        if buffer[:len(FLAT_MAGIC)] != FLAT_MAGIC:
+            raise SnapshotError(f"不是扁平模型文件: {path}")
+        version, _, directory_size = _HEADER.unpack_from(buffer, len(FLAT_MAGIC))
+        if version != FLAT_VERSION:
+            raise SnapshotError(
+                f"扁平模型文件版本不兼容: {version} (当前 {FLAT_VERSION})，请重新构建"
+            )
+        start = len(FLAT_MAGIC) + _HEADER.size
+        directory = json.loads(bytes(buffer[start:start + directory_size]).decode("utf-8"))
+        meta = directory["meta"]
+        if directory["byteorder"] != sys.byteorder:
+            raise SnapshotError(f"扁平模型文件的字节序与本机不同: {path}")
+        if expected_digest is not None and meta.get("corpus_sha256") != expected_digest:
+            raise SnapshotError(f"扁平模型文件已过期（语料已修改）: {path}")
+
+        data = memoryview(buffer)[start + directory_size:]
+        states = _decode(directory["models"], data)
+        models = {name: cls.from_state(states[name]) for name, cls in MODEL_CLASSES.items()}
+    except (ValueError, KeyError, TypeError, struct.error) as e:
+        raise SnapshotError(f"扁平模型文件已损坏: {e}") from e
+    return models, meta
@@ -0,0 +1,199 @@
+"""
+后台训练任务：加载语料（分词、训练）在单独的进程中完成，Web 请求提交后立即返回任务 ID
+
+子进程通过队列汇报进度 ("progress", stage, fraction)，结束时发回
+("done", states, source) 或 ("error", message)；主进程中的监视线程据此更新任务状态，
+成功时用 from_state() 重建模型并发布到 ModelRegistry。发布之前旧的模型组照常提供服务。
+加载的是扁平模型文件时 states 为 None，由主进程自己 mmap 该文件（不经过队列拷贝）
+"""
+
+import os
+import time
+import uuid
+import queue
+import threading
+from collections import OrderedDict
+
+from src import pipeline
+from src.flatmodel import flat_path, load_flat
+from src.registry import ModelBundle
+from src.snapshot import MODEL_CLASSES
+from src.utils import process_context
+
+# 最多保留的已结束任务数（更早的任务会被清除）
+MAX_FINISHED_JOBS = 50
+
+# 监视线程等待子进程消息的间隔（秒）
+POLL_INTERVAL = 0.2
+
+
+def _train_worker(messages, corpus_path, order, workers, use_snapshot):
+    """子进程入口：加载模型，并把结果以 to_state() 的形式发回主进程"""
+    def progress(stage, fraction):
+        messages.put(("progress", stage, fraction))
+
+    try:
+        models, source, error = pipeline.load_models(
+            corpus_path, order, workers=workers, use_snapshot=use_snapshot, progress=progress
+        )
+        if error:
+            messages.put(("error", error))
+        elif source == "mmap":
+            messages.put(("done", None, source))
+        else:
+            states = {name: model.to_state() for name, model in models.items()}
+            messages.put(("done", states, source))
+    except Exception as e:
+        messages.put(("error", f"加载失败: {str(e)}"))
+
+
+class TrainingJob:
+    """一次后台加载任务的状态，由监视线程更新"""
+
+    def __init__(self, corpus_path, order):
+        self.id = uuid.uuid4().hex[:12]
+        self.corpus_path = corpus_path
+        self.corpus = os.path.basename(corpus_path)
+        self.order = order
+        self.status = "pending"     # pending / running / done / failed
+        self.stage = "等待中"
+        self.progress = 0.0         # 当前阶段的完成比例
+        self.source = None          # 完成后为 "mmap"、"snapshot"、"trained" 或 "cached"
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._version = None        # ModelRegistry.begin_load() 返回的版本号
+        self._done = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    def wait(self, timeout=None):
+        """等待任务结束，返回是否已结束"""
+        return self._done.wait(timeout)
+
+    def _finish(self, error=None):
+        self.error = error
+        self.status = "failed" if error else "done"
+        self.stage = "加载失败" if error else "已完成"
+        self.finished_at = time.time()
+        self._done.set()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "corpus": self.corpus,
+            "order": self.order,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": round(self.progress * 100, 1),
+            "source": self.source,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """提交并跟踪后台训练任务，任务完成后把模型组发布到 registry 并设为默认"""
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._jobs = OrderedDict()   # 任务 ID -> TrainingJob（按提交顺序）
+        self._lock = threading.Lock()
+
+    def get(self, job_id):
+        """按 ID 取任务，不存在时返回 None"""
+        return self._jobs.get(job_id)
+
+    def submit(self, corpus_path, order=2, workers=1, use_snapshot=True):
+        """
+        提交加载任务，立即返回 TrainingJob
+        同一语料和阶数已有未结束的任务时返回该任务（并让它完成后成为默认模型组）
+        """
+        with self._lock:
+            for job in self._jobs.values():
+                if not job.finished and job.corpus_path == corpus_path and job.order == order:
+                    job._version = self.registry.begin_load()
+                    return job
+
+            job = TrainingJob(corpus_path, order)
+            job._version = self.registry.begin_load()
+            self._jobs[job.id] = job
+            self._prune()
+
+        thread = threading.Thread(
+            target=self._run, args=(job, workers, use_snapshot),
+            name=f"train-job-{job.id}", daemon=True,
+        )
+        thread.start()
+        return job
+
+    def _prune(self):
+        """清除最早结束的任务（调用方需持有 self._lock）"""
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def _run(self, job, workers, use_snapshot):
+        """监视线程：训练（或复用缓存）后发布"""
+        job.status = "running"
+        try:
+            # 已缓存的模型组直接发布，不必启动子进程
+            bundle = self.registry.get(job.corpus_path, job.order) if use_snapshot else None
+            if bundle is not None:
+                job.source = "cached"
+            else:
+                bundle, error = self._train_in_process(job, workers, use_snapshot)
+                if error:
+                    job._finish(error)
+                    return
+                job.source = bundle.source
+
+            job.stage, job.progress = "发布模型", 1.0
+            _, error = self.registry.finish_load(job._version, job.corpus_path, bundle)
+            job._finish(error)
+        except Exception as e:
+            job._finish(f"加载失败: {str(e)}")
+
+    def _train_in_process(self, job, workers, use_snapshot):
+        """在子进程中训练，转发进度，返回 (bundle, error)"""
+        # 不从多线程的 Web 服务中 fork（见 utils.process_context）
+        ctx = process_context()
+        messages = ctx.Queue()
+        process = ctx.Process(
+            target=_train_worker,
+            args=(messages, job.corpus_path, job.order, workers, use_snapshot),
+            name=f"train-job-{job.id}",
+        )
+        process.start()
+        try:
+            while True:
+                # 先判断进程是否存活再取消息：进程退出前发出的消息此时一定已可读
+                alive = process.is_alive()
+                try:
+                    message = messages.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    if not alive:
+                        return None, f"训练进程意外退出 (exit code {process.exitcode})"
+                    continue
+
+                kind = message[0]
+                if kind == "progress":
+                    job.stage, job.progress = message[1], message[2]
+                elif kind == "error":
+                    return None, message[1]
+                else:
+                    _, states, source = message
+                    if states is None:
+                        models, _ = load_flat(flat_path(job.corpus_path, job.order))
+                    else:
+                        models = {
+                            name: MODEL_CLASSES[name].from_state(state)
+                            for name, state in states.items()
+                        }
+                    bundle = ModelBundle.from_models(models, job.corpus_path, job.order, source)
+                    return bundle, None
+        finally:
+            process.join()
@@ -1,85 +1,556 @@
 import random
+from array import array
+from bisect import bisect_right
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+from src.tables import (
+    Distribution,
+    NGramTrie,
+    StringTable,
+    TransitionTable,
+    Vocabulary,
+    as_numpy,
+)
+
+
+def make_rng(seed=None):
+    """
+    Resolves a generate() seed to a random source.
+
+    None -> the shared `random` module (non-reproducible, as before),
+    a random.Random instance (or the module itself) is used as is,
+    anything else seeds a new random.Random, so the same seed always
+    gives the same poem.
+    """
+    if seed is None:
+        return random
+    if seed is random or isinstance(seed, random.Random):
+        return seed
+    return random.Random(seed)
+
+
+def make_numpy_rng(seed=None):
+    """Same as make_rng() for the numpy Generator used by generate_batch()"""
+    if seed is random or isinstance(seed, random.Random):
+        seed = seed.getrandbits(64)
+    return np.random.default_rng(seed)
 
 
 class MarkovChain:
-    def __init__(self, order=2):
+    """
+    n-gram Markov chain over integer-encoded tokens.
+
+    Storage is count-aggregated: the vocabulary maps each word to an int and
+    every context / successor pair is a node in an array-backed NGramTrie
+    holding its count, so repeated successors are stored once. Sampling a
+    successor is a binary search over cumulative counts, which draws from the
+    same distribution as picking from the full list of observed successors.
+
+    The trie holds every n-gram up to max_order + 1, so it serves all orders
+    1..max_order: with_order() returns a model sharing the vocabulary and
+    trie that only rebuilds the (small) table of line starts.
+    """
+
+    NEWLINE = "\n"
+    # Orders that can be switched to without retraining, unless the
+    # requested order is higher
+    MAX_ORDER = 3
+    # Backoff mode only uses contexts seen at least this many times
+    BACKOFF_MIN_COUNT = 2
+
+    def __init__(self, order=2, max_order=None):
         self.order = order
-        self.chain = {}
-        self.starts = []  # Keys that can start a line
+        self.max_order = max(order, self.MAX_ORDER if max_order is None else max_order)
+        self.vocab = Vocabulary()
+        self.trie = NGramTrie(self.max_order + 1)
+        # First and last max_order + 1 token ids of the training stream, to
+        # rebuild the line starts of any order
+        self.head = array("i")
+        self.tail = array("i")
+        # Contexts that can start a line: trie nodes at level `order`,
+        # cumulative start counts and the token ids of each start context
+        self.start_nodes = array("q")
+        self.start_cum = array("q")
+        self.start_contexts = array("i")
 
     def train(self, tokens):
         """
         Builds the Markov Chain from a list of tokens.
+
+        Even a stream shorter than the order keeps its vocabulary, head and
+        tail, so that merging it with the neighbouring shards stays exact.
         """
-        if len(tokens) < self.order:
+        if not tokens:
             return
 
-        # Record the first key as a valid start
-        first_key = tuple(tokens[: self.order])
-        self.starts.append(first_key)
-
-        for i in range(len(tokens) - self.order):
-            # Current state (tuple of length 'order')
-            current = tuple(tokens[i : i + self.order])
-            # Next token
-            next_token = tokens[i + self.order]
-
-            # Add to chain
-            if current not in self.chain:
-                self.chain[current] = []
-            self.chain[current].append(next_token)
-
-            # If the current state ends with a newline, the NEXT state is a start of a new line
-            # logic: if tokens[i] was '\n', then tokens[i+1]... starts a line?
-            # Actually simplest way: if the token *before* the current key was \n, then this key is a start.
-            # But here we are iterating i.
-            # If tokens[i-1] was \n, then tokens[i:i+order] is a start.
-            if i > 0 and tokens[i - 1] == "\n":
-                self.starts.append(current)
-
-    def generate_line(self):
-        """Generates a single line of poetry"""
-        if not self.chain:
+        ids = self.vocab.encode(tokens)
+        self.trie = NGramTrie.build(ids, self.max_order + 1)
+        self.head = array("i", ids[:self.max_order + 1])
+        self.tail = array("i", ids[-(self.max_order + 1):])
+        self._build_starts()
+
+    @classmethod
+    def merge(cls, models):
+        """
+        Merges models trained on consecutive shards of a corpus into the
+        model of the whole corpus, as if trained in one pass.
+
+        Vocabularies are merged in order and every trie is remapped onto the
+        merged ids and summed. The n-grams spanning the boundary between two
+        shards all lie within the tail of the stream so far followed by the
+        head of the next shard, so they are added as ngrams(tail + head)
+        minus ngrams(tail) and ngrams(head). All models must share max_order.
+        """
+        if len({model.max_order for model in models}) > 1:
+            raise ValueError("models must have the same max_order")
+        merged = cls(models[0].order, models[0].max_order)
+        depth = merged.max_order + 1
+
+        parts = []
+        head, tail = [], []
+        for model in models:
+            remap = merged.vocab.merge(model.vocab.words)
+            parts.append((model.trie, remap, 1))
+            shard_head = remap[as_numpy(model.head)].tolist()
+            shard_tail = remap[as_numpy(model.tail)].tolist()
+            if tail and shard_head:
+                parts.append((NGramTrie.build(tail + shard_head, depth), None, 1))
+                parts.append((NGramTrie.build(tail, depth), None, -1))
+                parts.append((NGramTrie.build(shard_head, depth), None, -1))
+            head = (head + shard_head)[:depth]
+            tail = (tail + shard_tail)[-depth:]
+
+        merged.trie = NGramTrie.merge(parts)
+        merged.head = array("i", head)
+        merged.tail = array("i", tail)
+        merged._build_starts()
+        return merged
+
+    def train_incremental(self, new_text, token_data=None):
+        """
+        Adds new_text to the trained model without going over the old corpus.
+
+        Only the new text is segmented and counted: the n-grams of the old
+        stream's tail followed by the new tokens, minus those of the tail
+        alone, are exactly the n-grams the new text adds, so merging them
+        into the trie gives the same model as training on the old corpus
+        followed by new_text. Counting scales with new_text; the merge is
+        still one vectorized pass over the existing trie, which is stored as
+        flat sorted arrays and has no cheaper way to take in new n-grams.
+        token_data: segment_corpus(new_text), if it is already segmented
+        The vocabulary and tables are replaced, never modified in place, so
+        a shallow copy of a model that is serving requests can be updated.
+        Returns self.
+        """
+        from src.utils import segment_corpus, token_words
+
+        if token_data is None:
+            token_data = segment_corpus(new_text, use_cache=False)
+        tokens = token_words(token_data)
+        if not tokens:
+            return self
+
+        vocab = Vocabulary(list(self.vocab.words))
+        new_ids = vocab.encode(tokens)
+        tail = list(self.tail)
+        depth = self.max_order + 1
+        self.trie = NGramTrie.merge([
+            (self.trie, None, 1),
+            (NGramTrie.build(tail + new_ids, depth), None, 1),
+            (NGramTrie.build(tail, depth), None, -1),
+        ])
+        self.vocab = vocab
+        self.head = array("i", (list(self.head) + new_ids)[:depth])
+        self.tail = array("i", (tail + new_ids)[-depth:])
+        self._build_starts()
+        return self
+
+    def with_order(self, order):
+        """
+        Returns this model at another order without retraining: the
+        vocabulary and trie are shared, only the line starts are rebuilt.
+        Raises ValueError if order is outside 1..max_order.
+        """
+        if not 1 <= order <= self.max_order:
+            raise ValueError(f"order must be between 1 and {self.max_order}")
+        if order == self.order:
+            return self
+        model = MarkovChain(order, self.max_order)
+        model.vocab = self.vocab
+        model.trie = self.trie
+        model.head = self.head
+        model.tail = self.tail
+        model._build_starts()
+        return model
+
+    def _build_starts(self):
+        """
+        Collects the line starts for the current order from the trie.
+
+        A key is a valid start if it opens the token stream, or follows a
+        newline and is itself followed by at least one token. The keys
+        following a newline are the suffix links of the (newline, key)
+        nodes, which form one contiguous run of level order + 1.
+        """
+        order = self.order
+        trie = self.trie
+        nodes = np.zeros(0, dtype=np.int64)
+        counts = np.zeros(0, dtype=np.int64)
+
+        newline = self.vocab.get(self.NEWLINE)
+        first = trie.find_child(0, 0, newline) if newline is not None else -1
+        if first >= 0:
+            lo, hi = first, first + 1
+            for d in range(1, order + 1):
+                offsets = trie.first_child[d]
+                lo, hi = offsets[lo], offsets[hi]
+            cum = as_numpy(trie.cum[order + 1])
+            nodes = as_numpy(trie.suffix_link[order + 1])[lo:hi].astype(np.int64)
+            counts = np.diff(cum[lo - 1:hi]) if lo > 0 else np.diff(cum[:hi], prepend=0)
+            # The stream may end right after (newline, key)
+            tail = self.tail[-(order + 1):]
+            if len(tail) == order + 1 and tail[0] == newline:
+                counts[trie.find(tail) - lo] -= 1
+
+        # The opening key of the stream is always a start
+        if len(self.head) >= order:
+            nodes = np.append(nodes, trie.find(self.head[:order]))
+            counts = np.append(counts, 1)
+
+        # Keys are sorted by their trie node, i.e. by context
+        nodes, inverse = np.unique(nodes, return_inverse=True)
+        counts = np.bincount(inverse, weights=counts, minlength=len(nodes)).astype(np.int64)
+        nodes = nodes[counts > 0]
+        counts = counts[counts > 0]
+
+        # Token ids of each start context, walking up from level `order`
+        contexts = np.empty((len(nodes), order), dtype=np.int32)
+        level_nodes = nodes
+        for d in range(order, 0, -1):
+            contexts[:, d - 1] = as_numpy(trie.tokens[d])[level_nodes]
+            level_nodes = np.searchsorted(
+                as_numpy(trie.first_child[d - 1]), level_nodes, side="right"
+            ) - 1
+
+        self.start_nodes = array("q", nodes.tolist())
+        self.start_contexts = array("i", contexts.ravel().tolist())
+        self.start_cum = array("q", np.cumsum(counts).tolist())
+
+    @property
+    def chain(self):
+        """Read-only view {context tuple: [successor, ...]} for inspection"""
+        return _ChainView(self)
+
+    def is_trained(self):
+        """True if at least one transition has been learned"""
+        return self.trie.num_nodes(self.order + 1) > 0
+
+    def successors(self, context):
+        """Returns {successor word: count} for a tuple of context words"""
+        node = self._find_words(context)
+        if node < 0:
+            return {}
+        lo, hi = self.trie.child_range(self.order, node)
+        words = self.vocab.words
+        tokens = self.trie.tokens[self.order + 1]
+        return {words[tokens[j]]: self.trie.count(self.order + 1, j) for j in range(lo, hi)}
+
+    def _find_words(self, context):
+        if len(context) != self.order:
+            return -1
+        ids = []
+        for word in context:
+            word_id = self.vocab.get(word)
+            if word_id is None:
+                return -1
+            ids.append(word_id)
+        return self.trie.find(ids)
+
+    def _pick_start(self, rng):
+        """Returns (node, context ids) of a random line start"""
+        # The opening key of the token stream is always recorded, so a
+        # trained model has at least one start
+        total = self.start_cum[-1]
+        k = bisect_right(self.start_cum, rng.randrange(total))
+        context = list(self.start_contexts[k * self.order : (k + 1) * self.order])
+        return self.start_nodes[k], context
+
+    def to_state(self):
+        """Returns a plain-data snapshot of the trained model"""
+        return {
+            "order": self.order,
+            "max_order": self.max_order,
+            "words": self.vocab.words,
+            "trie": self.trie.to_state(),
+            "head": self.head,
+            "tail": self.tail,
+            "start_nodes": self.start_nodes,
+            "start_cum": self.start_cum,
+            "start_contexts": self.start_contexts,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """Rebuilds a model from to_state() output"""
+        model = cls(order=state["order"], max_order=state["max_order"])
+        model.vocab = Vocabulary(state["words"])
+        model.trie = NGramTrie.from_state(state["trie"])
+        model.head = state["head"]
+        model.tail = state["tail"]
+        model.start_nodes = state["start_nodes"]
+        model.start_cum = state["start_cum"]
+        model.start_contexts = state["start_contexts"]
+        return model
+
+    def generate_line(self, seed=None, backoff=False):
+        """
+        Generates a single line of poetry.
+        seed: int or random.Random for reproducible output (see make_rng)
+        backoff: fall back to shorter contexts instead of stopping at an
+        unseen one (see _walk_backoff)
+        """
+        if not self.is_trained():
             return "Model not trained."
 
+        rng = make_rng(seed)
+
         # Pick a random starting point
-        if self.starts:
-            current = random.choice(self.starts)
-        else:
-            current = random.choice(list(self.chain.keys()))
+        node, context = self._pick_start(rng)
 
-        words = list(current)
+        vocab_words = self.vocab.words
+        newline = self.vocab.get(self.NEWLINE)
+        words = [vocab_words[t] for t in context]
 
-        # Walk the chain
         # Safety break to prevent infinite lines if \n is missing
         max_words = 20
+
+        if backoff:
+            words.extend(vocab_words[t] for t in self._walk_backoff(node, rng, newline, max_words))
+            return "".join(words)
+
+        trie = self.trie
+        offsets = trie.first_child[self.order]
+        cum = trie.cum[self.order + 1]
+        successor_tokens = trie.tokens[self.order + 1]
+        # Successor node j = (w1..wn, w); its suffix link is the next state (w2..wn, w)
+        next_state = trie.suffix_link[self.order + 1]
+
+        # Walk the chain
         count = 0
 
         while count < max_words:
-            if current not in self.chain:
+            lo = offsets[node]
+            hi = offsets[node + 1]
+            if lo == hi:
                 break
 
-            next_word = random.choice(self.chain[current])
+            if hi - lo == 1:
+                j = lo
+            else:
+                base = cum[lo - 1] if lo > 0 else 0
+                j = bisect_right(cum, base + rng.randrange(cum[hi - 1] - base), lo, hi)
 
-            if next_word == "\n":
+            next_id = successor_tokens[j]
+            if next_id == newline:
                 break
 
-            words.append(next_word)
-            # Shift window: (1, 2) -> (2, 3)
-            current = tuple(words[-self.order :])
+            words.append(vocab_words[next_id])
+            node = next_state[j]
             count += 1
 
         return "".join(words)
 
-    def generate(self, num_lines=5):
-        """Generates a poem with num_lines"""
-        poem = []
+    def _walk_backoff(self, node, rng, newline, max_words):
+        """
+        Variable-order walk from a start node at level `order`.
+
+        The context is the deepest trie node of the walk so far. When it has
+        been seen fewer than BACKOFF_MIN_COUNT times or has no successors,
+        its suffix link drops the first word, down to the unigram root. After
+        each step the context grows by one word until it is `order` words
+        long. Each step is O(order) array lookups and allocates no tuples.
+        Returns the generated token ids, stopping at a newline.
+        """
+        trie = self.trie
+        order = self.order
+        first_child = trie.first_child
+        suffix_link = trie.suffix_link
+        min_count = self.BACKOFF_MIN_COUNT
+        level = order
+        ids = []
+
+        while len(ids) < max_words:
+            # Back off to the longest usable context
+            while level > 0:
+                offsets = first_child[level]
+                if offsets[node] < offsets[node + 1] and trie.count(level, node) >= min_count:
+                    break
+                node = suffix_link[level][node] if level > 1 else 0
+                level -= 1
+
+            j = trie.sample_child(level, node, rng)
+            next_id = trie.tokens[level + 1][j]
+            if next_id == newline:
+                break
+            ids.append(next_id)
+
+            if level < order:
+                node, level = j, level + 1
+            else:
+                node = suffix_link[order + 1][j]
+
+        return ids
+
+    def iter_lines(self, num_lines=5, seed=None, backoff=False):
+        """
+        Yields the lines of a poem one at a time, as soon as each is generated.
+        Arguments and output are the same as generate(), which joins these lines.
+        """
+        rng = make_rng(seed)
         for _ in range(num_lines):
-            line = self.generate_line()
+            line = self.generate_line(rng, backoff)
             # Avoid empty lines
             if line.strip():
-                poem.append(line)
-        return "\n".join(poem)
+                yield line
+
+    def generate(self, num_lines=5, seed=None, backoff=False):
+        """
+        Generates a poem with num_lines.
+        seed: int or random.Random; the same seed gives the same poem
+        backoff: see generate_line
+        """
+        return "\n".join(self.iter_lines(num_lines, seed, backoff))
+
+    def generate_batch(self, n, num_lines=5, seed=None):
+        """
+        Generates n poems at once and returns them as a list.
+
+        All n * num_lines lines are independent random walks, so they are
+        advanced together: each step samples one successor for every live
+        walk with numpy over the trie arrays. Same distribution as calling
+        generate() n times; the same seed gives the same poems.
+        """
+        if not self.is_trained():
+            return [self.generate(num_lines) for _ in range(n)]
+
+        pad = -2
+        rng = make_numpy_rng(seed)
+        walks = n * num_lines
+        order = self.order
+        trie = self.trie
+
+        # Pick a random starting point for every line
+        start_cum = as_numpy(self.start_cum)
+        k = np.searchsorted(start_cum, rng.integers(0, start_cum[-1], walks), side="right")
+        nodes = as_numpy(self.start_nodes)[k]
+
+        newline = self.vocab.get(self.NEWLINE, pad)
+        successor_tokens = as_numpy(trie.tokens[order + 1])
+        next_state = as_numpy(trie.suffix_link[order + 1])
+
+        # Walk all chains together. Each row is one line: start context,
+        # generated ids, `pad` after the walk stopped, and a final -1 that
+        # decodes to the newline separating it from the next line.
+        # `live` holds the rows still walking and `nodes` their states
+        max_words = 20
+        line_ids = np.full((walks, order + max_words + 1), pad, dtype=np.int32)
+        line_ids[:, :order] = as_numpy(self.start_contexts).reshape(-1, order)[k]
+        line_ids[:, -1] = -1
+        live = np.arange(walks)
+
+        for step in range(order, order + max_words):
+            j = trie.sample_child_array(order, nodes, rng)
+            next_ids = successor_tokens[j]
+            keep = (j >= 0) & (next_ids != newline)
+            live = live[keep]
+            if not len(live):
+                break
+            j = j[keep]
+            line_ids[live, step] = next_ids[keep]
+            nodes = next_state[j]
+
+        # Avoid empty lines: only a line whose start context is blank can be
+        # blank, so check the whole row for those few
+        visible = self.vocab.visible_mask()
+        blank = np.flatnonzero(~visible[line_ids[:, :order]].any(axis=1))
+        if len(blank):
+            rows = line_ids[blank]
+            has_text = (visible[np.maximum(rows, 0)] & (rows >= 0)).any(axis=1)
+            line_ids[blank[~has_text]] = pad
+
+        # Decode every poem at once and drop its trailing newline
+        keep = line_ids != pad
+        bounds = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(keep.sum(axis=1).reshape(n, num_lines).sum(axis=1), out=bounds[1:])
+        return [poem[:-1] for poem in self.vocab.join_rows(line_ids[keep], bounds)]
+
+
+class _ChainView(Mapping):
+    """Decodes MarkovChain's count tables back to {context: [successors...]}"""
+
+    def __init__(self, model):
+        self._model = model
+
+    def __getitem__(self, context):
+        successors = self._model.successors(context)
+        if not successors:
+            raise KeyError(context)
+        return [word for word, count in successors.items() for _ in range(count)]
+
+    def __iter__(self):
+        model = self._model
+        words = model.vocab.words
+        for node, path in model.trie.iter_nodes(model.order):
+            lo, hi = model.trie.child_range(model.order, node)
+            if lo < hi:
+                yield tuple(words[t] for t in path)
+
+    def __len__(self):
+        offsets = self._model.trie.first_child[self._model.order]
+        return sum(1 for j in range(len(offsets) - 1) if offsets[j] < offsets[j + 1])
+
+
+def _sorted_pool(words):
+    """词语集合 -> 排序后的可下标序列"""
+    if isinstance(words, StringTable):
+        return words
+    return tuple(sorted(words))
+
+
+def _extend_ids(ids, new_ids, copy_on_write=False):
+    """
+    把 new_ids 追加到下标数组 ids 后返回结果；没有新下标时原样返回，
+    copy_on_write 为真或 ids 只读（来自扁平模型文件）时追加到副本上
+    """
+    if not len(new_ids):
+        return ids
+    if copy_on_write or not isinstance(ids, array):
+        ids = array("i", ids)
+    ids.extend(new_ids.tolist())
+    return ids
+
+
+class _LineView(Sequence):
+    """StructuredPoemGenerator 的短语库 / 结尾句：行表下标数组 -> 诗行的只读序列"""
+
+    def __init__(self, lines, ids):
+        self._lines = lines
+        self._ids = ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._lines[j] for j in self._ids[i]]
+        return self._lines[self._ids[i]]
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return list(self) == list(other)
 
 
 class ImageryChain:
@@ -90,28 +561,35 @@ class ImageryChain:
     - 意象词（名词）作为诗歌的核心锚点
     - 连接词（动词、形容词等）将意象串联起来
     - 学习 意象→连接→意象 的转移模式
+
+    所有词语按词表编码为整数，转移关系在训练结束时编译成 TransitionTable
+    （去重后的目标 + 累积计数），生成时每次抽样都是一次二分
     """
     
     def __init__(self):
+        self.vocab = Vocabulary()      # 词语 <-> 编号
         self.imagery = set()           # 所有意象词
         self.connectors = set()        # 所有连接词
+        self.imagery_ids = array("i")  # 意象词编号（升序，用于均匀抽样）
         
         # 转移概率表
-        self.imagery_to_connector = {} # 意象 -> [可能的连接词...]
-        self.connector_to_imagery = {} # 连接词 -> [可能的意象...]
-        self.imagery_to_imagery = {}   # 意象 -> [可能的下一个意象...] (直接相邻的情况)
+        self.imagery_to_connector = TransitionTable() # 意象 -> 连接词
+        self.connector_to_imagery = TransitionTable() # 连接词 -> 意象
+        self.imagery_to_imagery = TransitionTable()   # 意象 -> 下一个意象 (直接相邻的情况)
         
         # 句首意象
-        self.line_starters = []
+        self.line_starters = Distribution()
         
         # 连接词序列（多个连接词连续出现的情况）
-        self.connector_sequences = {}  # 连接词 -> [下一个连接词...]
+        self.connector_sequences = TransitionTable()  # 连接词 -> 下一个连接词
     
     def train(self, token_data):
         """
-        训练模型
+        训练模型（从头训练：先清空已有的全部状态；追加语料请用 train_incremental）
         token_data: list of (word, pos, is_imagery) from extract_imagery_and_connectors
         """
+        # 词表、意象/连接词集合与各转移表一起重置，避免与上一次训练的结果混在一起
+        self.__init__()
         if not token_data:
             return
         
@@ -124,123 +602,295 @@ class ImageryChain:
             else:
                 self.connectors.add(word)
         
+        ids = self.vocab.encode([word for word, pos, is_imagery in token_data])
+        newline = self.vocab.get("\n")
+        
+        # 四类转移关系的 (源, 目标) 编号序列
+        pairs = {
+            "imagery_to_connector": ([], []),
+            "connector_to_imagery": ([], []),
+            "imagery_to_imagery": ([], []),
+            "connector_sequences": ([], []),
+        }
+        starters = []
+        
         # 构建转移关系
-        prev_word = None
+        prev_id = None
         prev_is_imagery = None
         is_line_start = True
         
-        for word, pos, is_imagery in token_data:
-            if word == "\n":
+        for word_id, (word, pos, is_imagery) in zip(ids, token_data):
+            if word_id == newline:
                 is_line_start = True
-                prev_word = None
+                prev_id = None
                 prev_is_imagery = None
                 continue
             
             # 记录句首意象
             if is_line_start and is_imagery:
-                self.line_starters.append(word)
+                starters.append(word_id)
             is_line_start = False
             
             # 建立转移关系
-            if prev_word is not None:
+            if prev_id is not None:
                 if prev_is_imagery and not is_imagery:
-                    # 意象 -> 连接词
-                    if prev_word not in self.imagery_to_connector:
-                        self.imagery_to_connector[prev_word] = []
-                    self.imagery_to_connector[prev_word].append(word)
-                    
+                    relation = "imagery_to_connector"   # 意象 -> 连接词
                 elif not prev_is_imagery and is_imagery:
-                    # 连接词 -> 意象
-                    if prev_word not in self.connector_to_imagery:
-                        self.connector_to_imagery[prev_word] = []
-                    self.connector_to_imagery[prev_word].append(word)
-                    
+                    relation = "connector_to_imagery"   # 连接词 -> 意象
                 elif prev_is_imagery and is_imagery:
-                    # 意象 -> 意象 (直接相邻)
-                    if prev_word not in self.imagery_to_imagery:
-                        self.imagery_to_imagery[prev_word] = []
-                    self.imagery_to_imagery[prev_word].append(word)
-                    
+                    relation = "imagery_to_imagery"     # 意象 -> 意象 (直接相邻)
                 else:
-                    # 连接词 -> 连接词
-                    if prev_word not in self.connector_sequences:
-                        self.connector_sequences[prev_word] = []
-                    self.connector_sequences[prev_word].append(word)
+                    relation = "connector_sequences"    # 连接词 -> 连接词
+                sources, targets = pairs[relation]
+                sources.append(prev_id)
+                targets.append(word_id)
             
-            prev_word = word
+            prev_id = word_id
             prev_is_imagery = is_imagery
+        
+        # 编译抽样表
+        n_words = len(self.vocab)
+        for relation, (sources, targets) in pairs.items():
+            setattr(self, relation, TransitionTable.build(sources, targets, n_words))
+        self.line_starters = Distribution.build(starters)
+        self.imagery_ids = array("i", sorted(self.vocab.ids[word] for word in self.imagery))
+
+    @classmethod
+    def merge(cls, models):
+        """
+        合并多个模型，相当于按给定顺序拼接它们的语料后一次训练：
+        词表按顺序合并（新词依次追加），各计数表换算到合并后的编号再相加。
+        转移关系不跨行，所以结果与用拼接后的语料训练得到的模型完全相同
+        """
+        merged = cls()
+        remaps = [merged.vocab.merge(model.vocab.words) for model in models]
+        n_words = len(merged.vocab)
+        for name in cls.TABLE_FIELDS:
+            setattr(merged, name, TransitionTable.merge(
+                [(getattr(model, name), remap, 1) for model, remap in zip(models, remaps)],
+                n_words,
+            ))
+        merged.line_starters = Distribution.merge(
+            [(model.line_starters, remap, 1) for model, remap in zip(models, remaps)]
+        )
+        for model in models:
+            merged.imagery.update(model.imagery)
+            merged.connectors.update(model.connectors)
+        merged.imagery_ids = array("i", sorted(merged.vocab.ids[word] for word in merged.imagery))
+        return merged
+
+    def train_incremental(self, new_text, token_data=None):
+        """
+        把新文本并入已训练的模型：只对新文本分词、训练，再与已有的计数表合并（见 merge）
+        合并仍要整体过一遍已有的计数表（扁平数组，无法原地插入），耗时与模型大小成正比
+        token_data: 已分好词的 segment_corpus(new_text)，可省去重复分词
+        各计数表被整体替换而不是原地修改，正在提供服务的模型的浅拷贝可以安全地更新
+        返回 self
+        """
+        from src.utils import segment_corpus
+
+        if token_data is None:
+            token_data = segment_corpus(new_text, use_cache=False)
+        delta = ImageryChain()
+        delta.train(token_data)
+        if not delta.vocab.words:
+            return self
+        vars(self).update(vars(ImageryChain.merge([self, delta])))
+        return self
     
-    def generate_line(self, max_imagery=3):
+    # 快照中保存的转移表
+    TABLE_FIELDS = (
+        "imagery_to_connector", "connector_to_imagery", "imagery_to_imagery",
+        "connector_sequences",
+    )
+
+    def to_state(self):
+        """导出训练结果（纯数据，用于快照）"""
+        state = {name: getattr(self, name).to_state() for name in self.TABLE_FIELDS}
+        state.update(
+            words=self.vocab.words,
+            imagery=self.imagery,
+            connectors=self.connectors,
+            imagery_ids=self.imagery_ids,
+            line_starters=self.line_starters.to_state(),
+        )
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        """从 to_state() 的结果恢复模型"""
+        model = cls()
+        for name in cls.TABLE_FIELDS:
+            setattr(model, name, TransitionTable.from_state(state[name]))
+        model.vocab = Vocabulary(state["words"])
+        model.imagery = state["imagery"]
+        model.connectors = state["connectors"]
+        model.imagery_ids = state["imagery_ids"]
+        model.line_starters = Distribution.from_state(state["line_starters"])
+        return model
+
+    def _random_imagery(self, rng):
+        """均匀随机选一个意象词编号"""
+        return self.imagery_ids[rng.randrange(len(self.imagery_ids))]
+
+    def generate_line(self, max_imagery=3, seed=None):
         """
         生成一行诗
         max_imagery: 一行最多包含几个意象
+        seed: 整数或 random.Random，用于复现结果（见 make_rng）
         """
         if not self.imagery:
             return "模型未训练"
         
+        rng = make_rng(seed)
+        words = self.vocab.words
+        
         # 选择起始意象
         if self.line_starters:
-            current_imagery = random.choice(self.line_starters)
+            current_imagery = self.line_starters.sample(rng)
         else:
-            current_imagery = random.choice(list(self.imagery))
+            current_imagery = self._random_imagery(rng)
         
-        line_parts = [current_imagery]
+        line_parts = [words[current_imagery]]
         imagery_count = 1
         
+        # sample() 在没有后继时返回 -1，因此不必先判断 in 再抽样
         while imagery_count < max_imagery:
             # 尝试找连接词
-            connector_seq = []
-            
-            if current_imagery in self.imagery_to_connector:
-                connector = random.choice(self.imagery_to_connector[current_imagery])
-                connector_seq.append(connector)
+            connector = self.imagery_to_connector.sample(current_imagery, rng)
+            if connector >= 0:
+                line_parts.append(words[connector])
                 
                 # 可能有连续的连接词
-                while connector in self.connector_sequences and random.random() < 0.6:
-                    next_conn = random.choice(self.connector_sequences[connector])
-                    connector_seq.append(next_conn)
+                while True:
+                    next_conn = self.connector_sequences.sample(connector, rng)
+                    if next_conn < 0 or rng.random() >= 0.6:
+                        break
+                    line_parts.append(words[next_conn])
                     connector = next_conn
                 
-                line_parts.extend(connector_seq)
-                
                 # 找下一个意象
-                last_connector = connector_seq[-1]
-                if last_connector in self.connector_to_imagery:
-                    next_imagery = random.choice(self.connector_to_imagery[last_connector])
-                    line_parts.append(next_imagery)
-                    current_imagery = next_imagery
-                    imagery_count += 1
-                else:
+                next_imagery = self.connector_to_imagery.sample(connector, rng)
+                if next_imagery < 0:
                     # 没有对应意象，随机选一个
-                    if random.random() < 0.5 and self.imagery:
-                        next_imagery = random.choice(list(self.imagery))
-                        line_parts.append(next_imagery)
-                        current_imagery = next_imagery
-                        imagery_count += 1
+                    if rng.random() < 0.5 and self.imagery:
+                        next_imagery = self._random_imagery(rng)
                     else:
                         break
-                        
-            elif current_imagery in self.imagery_to_imagery:
-                # 意象直接相邻
-                next_imagery = random.choice(self.imagery_to_imagery[current_imagery])
-                line_parts.append(next_imagery)
+                line_parts.append(words[next_imagery])
                 current_imagery = next_imagery
                 imagery_count += 1
             else:
-                # 没有后续，结束
-                break
+                # 意象直接相邻
+                next_imagery = self.imagery_to_imagery.sample(current_imagery, rng)
+                if next_imagery < 0:
+                    # 没有后续，结束
+                    break
+                line_parts.append(words[next_imagery])
+                current_imagery = next_imagery
+                imagery_count += 1
         
         return "".join(line_parts)
     
-    def generate(self, num_lines=5, max_imagery_per_line=3):
-        """生成多行诗"""
-        poem = []
+    def iter_lines(self, num_lines=5, max_imagery_per_line=3, seed=None):
+        """逐行生成诗（每生成一行就产出一行），参数与结果同 generate"""
+        rng = make_rng(seed)
+        produced = False
         for _ in range(num_lines):
-            line = self.generate_line(max_imagery=max_imagery_per_line)
+            line = self.generate_line(max_imagery=max_imagery_per_line, seed=rng)
             if line.strip() and line != "模型未训练":
-                poem.append(line)
-        return "\n".join(poem) if poem else "模型未训练"
-    
+                produced = True
+                yield line
+        if not produced:
+            yield "模型未训练"
+
+    def generate(self, num_lines=5, max_imagery_per_line=3, seed=None):
+        """
+        生成多行诗
+        seed: 整数或 random.Random，相同的种子生成相同的诗
+        """
+        return "\n".join(self.iter_lines(num_lines, max_imagery_per_line, seed))
+
+    def generate_batch(self, n, num_lines=5, max_imagery_per_line=3, seed=None):
+        """
+        一次生成 n 首诗，返回列表
+        n * num_lines 行同时推进：每一步对所有未结束的行用 numpy 在转移表上批量抽样，
+        与逐行调用 generate_line() 的分布相同；相同的 seed 生成相同的结果
+        """
+        if not self.imagery:
+            return ["模型未训练"] * n
+
+        rng = make_numpy_rng(seed)
+        walks = n * num_lines
+        imagery_ids = as_numpy(self.imagery_ids).astype(np.int64)
+
+        # 选择起始意象
+        if self.line_starters:
+            current = self.line_starters.sample_array(walks, rng)
+        else:
+            current = imagery_ids[rng.integers(0, len(imagery_ids), walks)]
+
+        # 按时间顺序记录 (行号, 词编号)，最后按行号稳定排序即得到每一行
+        rows = [np.arange(walks)]
+        parts = [current.copy()]
+        imagery_count = np.ones(walks, dtype=np.int64)
+        live = np.arange(walks)
+
+        while len(live):
+            live = live[imagery_count[live] < max_imagery_per_line]
+            connector = self.imagery_to_connector.sample_array(current[live], rng)
+
+            # 有连接词的行：连接词 (-> 连续的连接词) -> 下一个意象
+            has_conn = connector >= 0
+            linked, connector = live[has_conn], connector[has_conn]
+            rows.append(linked)
+            parts.append(connector.copy())
+
+            chained = np.arange(len(linked))
+            while len(chained):
+                next_conn = self.connector_sequences.sample_array(connector[chained], rng)
+                go = (next_conn >= 0) & (rng.random(len(chained)) < 0.6)
+                chained, next_conn = chained[go], next_conn[go]
+                rows.append(linked[chained])
+                parts.append(next_conn)
+                connector[chained] = next_conn
+
+            next_imagery = self.connector_to_imagery.sample_array(connector, rng)
+            # 没有对应意象，随机选一个
+            fallback = (next_imagery < 0) & (rng.random(len(linked)) < 0.5)
+            next_imagery[fallback] = imagery_ids[
+                rng.integers(0, len(imagery_ids), np.count_nonzero(fallback))
+            ]
+
+            # 没有连接词的行：意象直接相邻
+            direct = live[~has_conn]
+            direct_next = self.imagery_to_imagery.sample_array(current[direct], rng)
+
+            # 没有后续的行结束
+            advanced = np.concatenate([linked, direct])
+            next_imagery = np.concatenate([next_imagery, direct_next])
+            ok = next_imagery >= 0
+            live, next_imagery = advanced[ok], next_imagery[ok]
+            rows.append(live)
+            parts.append(next_imagery)
+            current[live] = next_imagery
+            imagery_count[live] += 1
+
+        # 每行末尾追加编号 -1（解码为换行符）
+        rows.append(np.arange(walks))
+        parts.append(np.full(walks, -1, dtype=np.int64))
+        rows = np.concatenate(rows)
+        perm = np.argsort(rows, kind="stable")
+        rows, ids = rows[perm], np.concatenate(parts)[perm]
+
+        # 去掉空白行后整首解码，并去掉末尾的换行符
+        visible = self.vocab.visible_mask()[ids]
+        keep = (np.bincount(rows, weights=visible, minlength=walks) > 0)[rows]
+        bounds = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[keep] // num_lines, minlength=n), out=bounds[1:])
+        poems = self.vocab.join_rows(ids[keep], bounds)
+        return [poem[:-1] if poem else "模型未训练" for poem in poems]
+
     def get_stats(self):
         """返回模型统计信息"""
         return {
@@ -248,7 +898,7 @@ class ImageryChain:
             "连接词数量": len(self.connectors),
             "意象→连接 关系": len(self.imagery_to_connector),
             "连接→意象 关系": len(self.connector_to_imagery),
-            "句首意象数量": len(set(self.line_starters)),
+            "句首意象数量": len(self.line_starters),
         }
 
 
@@ -278,6 +928,25 @@ class StructuredPoemGenerator:
         "情况": ["于是……", "就这样……", "因此……", "然而……", "但是……"],
     }
     
+    # 从语料中学习各角度短语时使用的关键词（诗行包含任一关键词即归入该角度）
+    PHRASE_KEYWORDS = {
+        "时间": ("夜", "晨", "黎明", "黄昏", "春", "夏", "秋", "冬", "今", "昨", "明", "月", "日", "年", "时"),
+        "处所": ("在", "从", "向", "里", "中", "上", "下", "旁", "边", "处", "乡", "城", "山", "海", "河", "天", "地"),
+        "方式": ("像", "如", "仿佛", "似", "般", "地"),
+        "条件": ("如果", "假如", "只要", "除非", "若"),
+        "程度": ("更", "最", "多么", "如此", "这般", "无比", "极"),
+        "范围": ("所有", "一切", "唯有", "只有", "全部", "每"),
+        "肯定": ("是", "正是", "必然", "一定", "终将", "就是"),
+        "否定": ("不", "没", "无", "非", "莫", "勿", "别"),
+        "对象": ("给", "向", "对", "为", "关于", "属于"),
+        "情况": ("于是", "就这样", "因此", "然而", "但是", "所以", "却"),
+    }
+
+    # 结尾句：包含结尾关键词，或较短且以有终结感的字结尾
+    ENDING_KEYWORDS = ("而我", "只剩", "这就是", "从此", "永远", "直到", "最后", "终于", "就这样")
+    ENDING_SUFFIXES = ("了", "去", "来", "着")
+    ENDING_MAX_LEN = 15
+
     # 结尾模式
     ENDING_PATTERNS = [
         "而我……",
@@ -294,25 +963,20 @@ class StructuredPoemGenerator:
         self.imagery = set()
         self.connectors = set()
         
-        # 从语料中学习的短语库
-        self.learned_phrases = {
-            "时间": [],
-            "处所": [],
-            "方式": [],
-            "条件": [],
-            "程度": [],
-            "范围": [],
-            "肯定": [],
-            "否定": [],
-            "对象": [],
-            "情况": [],
-        }
+        # 从语料中学习的诗行（去重后的行表），短语库和结尾句都是指向它的下标数组，
+        # 同一行在多个角度中只存一份；重复出现的行对应重复的下标，保持抽样概率不变
+        self.lines = []
+        self.phrase_ids = {category: array("i") for category in self.PHRASE_KEYWORDS}
+        self.ending_ids = array("i")
+        # 行 -> 行表下标，第一次追加诗行时建立，之后随行表一起更新（不放进快照）
+        self._line_index = None
         
         # 学习的意象组合
         self.imagery_combinations = []
         
-        # 学习的结尾句
-        self.endings = []
+        # 意象词 / 连接词的抽样池（训练结束时由集合生成，排序保证顺序稳定）
+        self.imagery_pool = ()
+        self.connector_pool = ()
     
     def train(self, token_data, raw_lines):
         """
@@ -336,96 +1000,228 @@ class StructuredPoemGenerator:
         
         # 学习意象组合
         self._learn_imagery_combinations(token_data)
-    
-    def _learn_phrases_from_lines(self, lines):
-        """从诗行中学习不同类型的短语"""
-        
-        time_keywords = ["夜", "晨", "黎明", "黄昏", "春", "夏", "秋", "冬", "今", "昨", "明", "月", "日", "年", "时"]
-        place_keywords = ["在", "从", "向", "里", "中", "上", "下", "旁", "边", "处", "乡", "城", "山", "海", "河", "天", "地"]
-        manner_keywords = ["像", "如", "仿佛", "似", "般", "地"]
-        condition_keywords = ["如果", "假如", "只要", "除非", "若"]
-        degree_keywords = ["更", "最", "多么", "如此", "这般", "无比", "极"]
-        scope_keywords = ["所有", "一切", "唯有", "只有", "全部", "每"]
-        positive_keywords = ["是", "正是", "必然", "一定", "终将", "就是"]
-        negative_keywords = ["不", "没", "无", "非", "莫", "勿", "别"]
-        object_keywords = ["给", "向", "对", "为", "关于", "属于"]
-        situation_keywords = ["于是", "就这样", "因此", "然而", "但是", "所以", "却"]
         
+        self._build_sampling_pools()
+
+    @classmethod
+    def merge(cls, models):
+        """
+        合并多个模型，相当于按给定顺序拼接它们的语料后一次训练：
+        行表按顺序合并，各角度的短语下标换算到合并后的行表再拼接，意象组合依次拼接
+        """
+        merged = cls()
+        index = {}
+        for model in models:
+            merged.imagery.update(model.imagery)
+            merged.connectors.update(model.connectors)
+            line_map = []
+            for line in model.lines:
+                i = index.get(line)
+                if i is None:
+                    i = index[line] = len(merged.lines)
+                    merged.lines.append(line)
+                line_map.append(i)
+            line_map = np.asarray(line_map, dtype=np.int64)
+            for category, ids in model.phrase_ids.items():
+                merged.phrase_ids[category].extend(line_map[as_numpy(ids)].tolist())
+            merged.ending_ids.extend(line_map[as_numpy(model.ending_ids)].tolist())
+            merged.imagery_combinations.extend(list(c) for c in model.imagery_combinations)
+        merged._line_index = index
+        merged._build_sampling_pools()
+        return merged
+
+    def train_incremental(self, new_text, token_data=None):
+        """
+        把新文本并入已训练的模型：只对新文本分词、学习，追加到已有的短语库和意象组合中，
+        结果与用旧语料 + 新文本一次训练相同
+        token_data: 已分好词的 segment_corpus(new_text)，可省去重复分词
+        写时复制：只有新文本确实改动了的容器（某个角度的下标数组、行表和行索引、词集合等）
+        才复制后再追加，其余与原模型共用，不修改原来的对象，正在提供服务的模型的浅拷贝
+        可以安全地更新；耗时取决于新文本和被改动的容器，不必重建整个行索引
+        返回 self
+        """
+        from src.utils import segment_corpus
+
+        if token_data is None:
+            token_data = segment_corpus(new_text, use_cache=False)
+        raw_lines = [line.strip() for line in new_text.split("\n") if line.strip()]
+
+        new_imagery, new_connectors = set(), set()
+        for word, pos, is_imagery in token_data:
+            if word == "\n":
+                continue
+            if is_imagery:
+                if word not in self.imagery:
+                    new_imagery.add(word)
+            elif word not in self.connectors:
+                new_connectors.add(word)
+
+        self._learn_phrases_from_lines(raw_lines, copy_on_write=True)
+        self._learn_imagery_combinations(token_data, copy_on_write=True)
+
+        # 词集合只在出现新词时复制并重建抽样池
+        if new_imagery:
+            self.imagery = set(self.imagery) | new_imagery
+            self.imagery_pool = _sorted_pool(self.imagery)
+        if new_connectors:
+            self.connectors = set(self.connectors) | new_connectors
+            self.connector_pool = _sorted_pool(self.connectors)
+        return self
+    
+    def _build_sampling_pools(self):
+        """
+        把意象词 / 连接词集合转成元组，生成时 O(1) 抽样而不必每次 list(set)
+        从扁平模型文件加载时它们已是排序好的 StringTable，直接使用，不解码成元组
+        """
+        self.imagery_pool = _sorted_pool(self.imagery)
+        self.connector_pool = _sorted_pool(self.connectors)
+    
+    @property
+    def learned_phrases(self):
+        """各角度学到的短语 {角度: 短语序列}（只读视图）"""
+        return {
+            category: _LineView(self.lines, ids) for category, ids in self.phrase_ids.items()
+        }
+
+    @property
+    def endings(self):
+        """学到的结尾句（只读视图）"""
+        return _LineView(self.lines, self.ending_ids)
+
+    def _learn_phrases_from_lines(self, lines, copy_on_write=False):
+        """
+        从诗行中学习不同类型的短语
+        每个不同的诗行只分类一次：keyword_masks 一次扫描给所有行打上角度 / 结尾关键词的位掩码，
+        各角度只记录行表中的下标
+        copy_on_write: 为真时不修改已有的容器，只复制要追加内容的行表 / 行索引 / 下标数组
+        """
+        from src.utils import keyword_masks
+
+        candidates = []
         for line in lines:
             line = line.strip()
             if not line or len(line) < 4:
                 continue
-            
-            # 检测并分类短语
-            if any(k in line for k in time_keywords):
-                self.learned_phrases["时间"].append(line)
-            if any(k in line for k in place_keywords):
-                self.learned_phrases["处所"].append(line)
-            if any(k in line for k in manner_keywords):
-                self.learned_phrases["方式"].append(line)
-            if any(k in line for k in condition_keywords):
-                self.learned_phrases["条件"].append(line)
-            if any(k in line for k in degree_keywords):
-                self.learned_phrases["程度"].append(line)
-            if any(k in line for k in scope_keywords):
-                self.learned_phrases["范围"].append(line)
-            if any(k in line for k in positive_keywords):
-                self.learned_phrases["肯定"].append(line)
-            if any(k in line for k in negative_keywords):
-                self.learned_phrases["否定"].append(line)
-            if any(k in line for k in object_keywords):
-                self.learned_phrases["对象"].append(line)
-            if any(k in line for k in situation_keywords):
-                self.learned_phrases["情况"].append(line)
-            
-            # 学习结尾（较短的、有终结感的句子）
-            ending_keywords = ["而我", "只剩", "这就是", "从此", "永远", "直到", "最后", "终于", "就这样"]
-            if any(k in line for k in ending_keywords) or (len(line) < 15 and line.endswith(("了", "去", "来", "着"))):
-                self.endings.append(line)
+            candidates.append(line)
+        if not candidates:
+            return
+
+        # 检测并分类短语：每个不同的行只匹配一次
+        unique = list(dict.fromkeys(candidates))
+        keyword_sets = list(self.PHRASE_KEYWORDS.values()) + [self.ENDING_KEYWORDS]
+        masks = keyword_masks(unique, keyword_sets)
+        ending_bit = 1 << len(self.PHRASE_KEYWORDS)
+        # 学习结尾（较短的、有终结感的句子）
+        short_endings = np.array([
+            len(line) < self.ENDING_MAX_LEN and line.endswith(self.ENDING_SUFFIXES)
+            for line in unique
+        ], dtype=bool)
+        masks[short_endings] |= ending_bit
+
+        # 只有归入了某个角度或结尾的行才放进行表；行索引保存在模型上，不必每次重建
+        if self._line_index is None:
+            self._line_index = {line: i for i, line in enumerate(self.lines)}
+        index = self._line_index
+        unique_ids = np.full(len(unique), -1, dtype=np.int64)
+        added = []
+        for k in np.flatnonzero(masks).tolist():
+            line = unique[k]
+            i = index.get(line)
+            if i is None:
+                i = len(self.lines) + len(added)
+                added.append(line)
+            unique_ids[k] = i
+        if added:
+            if copy_on_write or not isinstance(self.lines, list):
+                self.lines = list(self.lines)
+                self._line_index = index = dict(index)
+            for line in added:
+                index[line] = len(self.lines)
+                self.lines.append(line)
+
+        # 展开回每次出现（重复的行保留重复的下标）
+        position = {line: k for k, line in enumerate(unique)}
+        occurrences = np.fromiter(
+            (position[line] for line in candidates), dtype=np.int64, count=len(candidates)
+        )
+        ids = unique_ids[occurrences]
+        masks = masks[occurrences]
+        if copy_on_write:
+            self.phrase_ids = dict(self.phrase_ids)
+        for bit, category in enumerate(self.PHRASE_KEYWORDS):
+            self.phrase_ids[category] = _extend_ids(
+                self.phrase_ids[category], ids[(masks >> bit) & 1 == 1], copy_on_write
+            )
+        self.ending_ids = _extend_ids(self.ending_ids, ids[masks & ending_bit != 0], copy_on_write)
     
-    def _learn_imagery_combinations(self, token_data):
-        """学习意象组合模式"""
+    def _learn_imagery_combinations(self, token_data, copy_on_write=False):
+        """学习意象组合模式（copy_on_write 同 _learn_phrases_from_lines）"""
+        combinations = []
         current_combination = []
         
         for word, pos, is_imagery in token_data:
             if word == "\n":
                 if len(current_combination) >= 2:
-                    self.imagery_combinations.append(current_combination.copy())
+                    combinations.append(current_combination.copy())
                 current_combination = []
             elif is_imagery:
                 current_combination.append(word)
+
+        if combinations:
+            if copy_on_write:
+                self.imagery_combinations = list(self.imagery_combinations)
+            self.imagery_combinations.extend(combinations)
     
-    def generate_opening(self):
-        """生成开篇状语短语"""
-        # 优先从时间、处所、方式中选择
-        opening_types = ["时间", "处所", "方式"]
-        
-        for t in opening_types:
-            if self.learned_phrases[t]:
-                return random.choice(self.learned_phrases[t])
+    # 快照中保存的字段
+    STATE_FIELDS = ("imagery", "connectors", "lines", "phrase_ids", "ending_ids", "imagery_combinations")
+
+    def to_state(self):
+        """导出训练结果（纯数据，用于快照）"""
+        return {name: getattr(self, name) for name in self.STATE_FIELDS}
+
+    @classmethod
+    def from_state(cls, state):
+        """从 to_state() 的结果恢复模型"""
+        model = cls()
+        for name in cls.STATE_FIELDS:
+            setattr(model, name, state[name])
+        model._build_sampling_pools()
+        return model
+
+    # 开篇优先从时间、处所、方式中选择
+    OPENING_TYPES = ("时间", "处所", "方式")
+
+    def generate_opening(self, seed=None):
+        """生成开篇状语短语（seed 同 generate）"""
+        rng = make_rng(seed)
+        for t in self.OPENING_TYPES:
+            if self.phrase_ids[t]:
+                return self.lines[rng.choice(self.phrase_ids[t])]
         
         # 后备：用意象生成
         if self.imagery:
-            img = random.choice(list(self.imagery))
+            img = rng.choice(self.imagery_pool)
             patterns = ["在{}的深处", "当{}沉默", "{}之上"]
-            return random.choice(patterns).format(img)
+            return rng.choice(patterns).format(img)
         
         return "在远方"
     
-    def generate_expansion(self, perspective):
+    def generate_expansion(self, perspective, seed=None):
         """
         生成展开句
         perspective: 展开角度（时间/处所/方式/条件/程度/范围/肯定/否定/对象/情况）
+        seed: 同 generate
         """
+        rng = make_rng(seed)
         # 优先使用学习到的短语
-        if self.learned_phrases[perspective]:
-            return random.choice(self.learned_phrases[perspective])
+        if self.phrase_ids[perspective]:
+            return self.lines[rng.choice(self.phrase_ids[perspective])]
         
         # 后备：用意象 + 连接词生成
         if self.imagery and self.connectors:
-            img1 = random.choice(list(self.imagery))
-            img2 = random.choice(list(self.imagery))
-            conn = random.choice(list(self.connectors))
+            img1 = rng.choice(self.imagery_pool)
+            img2 = rng.choice(self.imagery_pool)
+            conn = rng.choice(self.connector_pool)
             
             templates = {
                 "时间": "{}的时候，{}{}",
@@ -446,13 +1242,14 @@ class StructuredPoemGenerator:
         
         return ""
     
-    def generate_ending(self):
-        """生成结尾句"""
-        if self.endings:
-            return random.choice(self.endings)
+    def generate_ending(self, seed=None):
+        """生成结尾句（seed 同 generate）"""
+        rng = make_rng(seed)
+        if self.ending_ids:
+            return self.lines[rng.choice(self.ending_ids)]
         
         if self.imagery:
-            img = random.choice(list(self.imagery))
+            img = rng.choice(self.imagery_pool)
             patterns = [
                 "而我只有{}",
                 "只剩下{}在远方",
@@ -460,56 +1257,103 @@ class StructuredPoemGenerator:
                 "从此与{}为伴",
                 "永远属于{}",
             ]
-            return random.choice(patterns).format(img)
+            return rng.choice(patterns).format(img)
         
         return "而我沉默"
     
-    def generate(self, expansion_count=4):
+    def iter_lines(self, expansion_count=4, seed=None):
         """
-        生成结构化诗歌
-        
-        结构：
-        - 开篇（状语短语）
-        - 展开 × expansion_count（从不同角度）
-        - 结尾
+        逐行生成结构化诗歌：开篇、各展开句、结尾依次产出（段落之间产出空行）
+        参数与结果同 generate
         """
-        poem_lines = []
+        rng = make_rng(seed)
         
         # 1. 开篇
-        opening = self.generate_opening()
-        poem_lines.append(opening)
-        poem_lines.append("")  # 空行分隔
+        yield self.generate_opening(rng)
+        yield ""  # 空行分隔
         
         # 2. 展开（从不同角度选择）
-        perspectives = list(self.learned_phrases.keys())
-        random.shuffle(perspectives)
+        perspectives = list(self.phrase_ids)
+        rng.shuffle(perspectives)
         
-        used_perspectives = []
         for i in range(expansion_count):
             # 选择一个未用过的角度
             perspective = perspectives[i % len(perspectives)]
-            used_perspectives.append(perspective)
-            
-            expansion = self.generate_expansion(perspective)
+            expansion = self.generate_expansion(perspective, rng)
             if expansion:
-                poem_lines.append(expansion)
+                yield expansion
         
-        poem_lines.append("")  # 空行分隔
+        yield ""  # 空行分隔
         
         # 3. 结尾
-        ending = self.generate_ending()
-        poem_lines.append(ending)
+        yield self.generate_ending(rng)
+
+    def generate(self, expansion_count=4, seed=None):
+        """
+        生成结构化诗歌
         
-        return "\n".join(poem_lines)
-    
+        结构：
+        - 开篇（状语短语）
+        - 展开 × expansion_count（从不同角度）
+        - 结尾
+
+        seed: 整数或 random.Random，相同的种子生成相同的诗
+        """
+        return "\n".join(self.iter_lines(expansion_count, seed))
+
+    def generate_batch(self, n, expansion_count=4, seed=None):
+        """
+        一次生成 n 首结构化诗歌，返回列表
+        学到的短语按类别用 numpy 一次抽取所有下标，角度顺序用 rng.permuted 批量打乱；
+        短语库为空时的后备模板用同一种子派生的 random.Random 生成
+        """
+        rng = make_numpy_rng(seed)
+        fallback_rng = random.Random(int(rng.integers(2**63)))
+
+        lines = self.lines
+
+        def pick(ids, count, fallback):
+            """从短语库（行表下标）中批量随机抽取 count 个，短语库为空时逐个调用 fallback()"""
+            if ids:
+                return [lines[i] for i in as_numpy(ids)[rng.integers(0, len(ids), count)].tolist()]
+            return [fallback() for _ in range(count)]
+
+        # 1. 开篇
+        opening_type = next((t for t in self.OPENING_TYPES if self.phrase_ids[t]), None)
+        openings = pick(
+            self.phrase_ids[opening_type] if opening_type else (), n,
+            lambda: self.generate_opening(fallback_rng),
+        )
+
+        # 2. 展开（每首诗独立打乱角度顺序）
+        perspectives = list(self.phrase_ids)
+        shuffled = rng.permuted(np.tile(np.arange(len(perspectives)), (n, 1)), axis=1)
+        slots = shuffled[:, np.arange(expansion_count) % len(perspectives)]
+        expansions = np.empty(slots.shape, dtype=object)
+        for k, perspective in enumerate(perspectives):
+            mask = slots == k
+            expansions[mask] = pick(
+                self.phrase_ids[perspective], int(mask.sum()),
+                lambda p=perspective: self.generate_expansion(p, fallback_rng),
+            )
+
+        # 3. 结尾
+        endings = pick(self.ending_ids, n, lambda: self.generate_ending(fallback_rng))
+
+        poems = []
+        for opening, row, ending in zip(openings, expansions.tolist(), endings):
+            poem_lines = [opening, ""] + [line for line in row if line] + ["", ending]
+            poems.append("\n".join(poem_lines))
+        return poems
+
     def get_stats(self):
         """返回统计信息"""
-        phrase_counts = {k: len(v) for k, v in self.learned_phrases.items()}
+        phrase_counts = {k: len(v) for k, v in self.phrase_ids.items()}
         return {
             "意象词数量": len(self.imagery),
             "连接词数量": len(self.connectors),
             "学习的短语": phrase_counts,
-            "结尾句数量": len(self.endings),
+            "结尾句数量": len(self.ending_ids),
             "意象组合数量": len(self.imagery_combinations),
         }
 
@@ -0,0 +1,369 @@
+"""
+语料 -> 模型 的完整流程：分词、训练三个模型，或直接加载预先构建的快照
+web_app / main / gui 共用
+"""
+
+import os
+import copy
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from src.utils import (
+    corpus_digest,
+    iter_corpus,
+    load_corpus,
+    process_context,
+    resolve_workers,
+    segment_corpus,
+    split_on_blank_lines,
+    token_words,
+)
+from src.model import MarkovChain, ImageryChain, StructuredPoemGenerator
+from src.flatmodel import FLAT_MAGIC, flat_path, load_flat, save_flat
+from src.snapshot import (
+    MODEL_CLASSES,
+    SnapshotError,
+    load_snapshot,
+    save_snapshot,
+    snapshot_path,
+)
+
+
+def _report(progress, stage, fraction=0.0):
+    if progress:
+        progress(stage, fraction)
+
+
+def train_models(text, order=2, workers=1, progress=None, use_cache=True):
+    """
+    对语料文本分词并训练三个模型
+    progress: 可选的回调 progress(stage, fraction)，stage 为当前阶段名，fraction 为该阶段的完成比例
+    use_cache: 是否使用磁盘分词缓存（语料的分片 / 分块应传 False：切分位置一变缓存就用不上，
+        只会不断堆积新文件）
+    返回 {"markov", "imagery", "structured"}，语料为空时返回 None
+    """
+    # 保存原始诗行（用于结构化模型）
+    raw_lines = [line.strip() for line in text.split("\n") if line.strip()]
+
+    # 单次分词 + 词性标注，三个模型共用
+    _report(progress, "分词")
+    token_data = segment_corpus(
+        text, use_cache=use_cache, workers=workers,
+        progress=(lambda fraction: progress("分词", fraction)) if progress else None,
+    )
+    tokens = token_words(token_data)
+    if not tokens:
+        return None
+
+    _report(progress, "训练马尔可夫模型")
+    markov = MarkovChain(order=order)
+    markov.train(tokens)
+
+    _report(progress, "训练意象链模型")
+    imagery = ImageryChain()
+    imagery.train(token_data)
+
+    _report(progress, "训练结构化模型")
+    structured = StructuredPoemGenerator()
+    structured.train(token_data, raw_lines)
+
+    return {"markov": markov, "imagery": imagery, "structured": structured}
+
+
+def merge_models(shards):
+    """
+    归并在语料的连续分片上分别训练出的多组模型（按分片顺序），
+    结果与在拼接后的整个语料上一次训练相同
+    shards: [{"markov", "imagery", "structured"}, ...]
+    """
+    return {
+        name: cls.merge([models[name] for models in shards])
+        for name, cls in MODEL_CLASSES.items()
+    }
+
+
+def _train_shard(task):
+    """分片训练的进程入口，返回各模型的 to_state()（语料为空时返回 None）；分片不写分词缓存"""
+    text, order = task
+    models = train_models(text, order, use_cache=False)
+    if models is None:
+        return None
+    return {name: model.to_state() for name, model in models.items()}
+
+
+def train_sharded(text, order=2, shards=2, workers=1):
+    """
+    map-reduce 训练：在诗与诗之间的空行处把语料切成约 shards 片，各片在进程池中独立分词、
+    训练（map），再用 merge_models 归并（reduce）；结果与 train_models(text, order) 相同
+    workers: 进程数，1 为单进程，<= 0 表示使用全部 CPU 核心
+    返回 {"markov", "imagery", "structured"}，语料为空时返回 None
+    """
+    tasks = [(chunk, order) for chunk in split_on_blank_lines(text, shards)]
+    workers = min(resolve_workers(workers), len(tasks))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=process_context()) as pool:
+            states = list(pool.map(_train_shard, tasks))
+    else:
+        states = list(map(_train_shard, tasks))
+
+    results = [
+        {name: MODEL_CLASSES[name].from_state(state[name]) for name in MODEL_CLASSES}
+        for state in states if state is not None
+    ]
+    if not results:
+        return None
+    return merge_models(results)
+
+
+def _map_ordered(fn, items, workers):
+    """
+    按顺序产出 fn(item)：workers > 1 时在进程池中计算，最多同时提交 2 * workers 个任务，
+    items 是生成器时也只会预先读取这么多项（内存有界）
+    """
+    if workers <= 1:
+        yield from map(fn, items)
+        return
+
+    # 不从当前（可能是多线程的）进程 fork，词典由 forkserver 预先加载（见 utils.process_context）
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=process_context()) as pool:
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def train_stream(chunks, order=2, workers=1, progress=None, total=None):
+    """
+    流式训练：逐块分词、训练（chunks 为按顺序产出语料文本块的可迭代对象，如 iter_corpus），
+    各块的模型像二进制计数器一样两两归并（大小相同的两组才归并），
+    结果与 train_models("".join(chunks), order) 相同。
+    峰值内存约为模型大小的常数倍，而不是语料文本大小的倍数：
+    同时存在的只有正在训练的几块文本与 O(log 块数) 组模型
+    workers: 训练进程数，1 为单进程，<= 0 表示使用全部 CPU 核心。
+        块数不少于 workers 时各块在进程池中并行训练；不足 workers 块时（例如不到
+        CORPUS_CHUNK_LINES 行、只有一块的语料）各块依次在本进程中训练，进程都用于块内的并行分词
+    progress: 同 train_models；total 为语料的总字节数（如文件大小），给出时按已处理的比例汇报进度，
+        在本进程中训练时还按各块的分词进度汇报（块数不足 workers 时不需要 total）
+    各块不写分词缓存（块的边界随语料变化，缓存会不断堆积却用不上）；只有一块时这一块就是整个语料，
+    照常使用缓存，与一次分词整个语料相同
+    返回 {"markov", "imagery", "structured"}，语料为空时返回 None
+    """
+    stage = "分块训练"
+    _report(progress, stage)
+    workers = resolve_workers(workers)
+    chunks = iter(chunks)
+    # 最多预读 workers 块（至少 2 块，与进程池中同时处理的块数相当），据此决定怎样并行、是否只有一块
+    head = list(itertools.islice(chunks, max(workers, 2)))
+    if len(head) < workers:
+        total = sum(len(chunk.encode("utf-8")) for chunk in head)
+    use_cache = len(head) == 1
+    chunks = itertools.chain(head, chunks)
+
+    def serial():
+        done = 0
+        for chunk in chunks:
+            size = len(chunk.encode("utf-8"))
+
+            def chunk_progress(chunk_stage, fraction, done=done, size=size):
+                if chunk_stage == "分词" and total:
+                    _report(progress, stage, min(1.0, (done + size * fraction) / total))
+
+            yield done + size, train_models(
+                chunk, order, workers, progress=chunk_progress if progress else None,
+                use_cache=use_cache,
+            )
+            done += size
+
+    def parallel():
+        sizes = deque()
+
+        def tasks():
+            for chunk in chunks:
+                sizes.append(len(chunk.encode("utf-8")))
+                yield chunk, order
+
+        done = 0
+        for state in _map_ordered(_train_shard, tasks(), workers):
+            done += sizes.popleft()
+            if state is None:
+                yield done, None
+            else:
+                yield done, {
+                    name: MODEL_CLASSES[name].from_state(state[name]) for name in MODEL_CLASSES
+                }
+
+    stack = []   # [(models, 块数)]，块数自底向上严格递减
+    for done, models in (serial() if len(head) < workers or workers == 1 else parallel()):
+        if total:
+            _report(progress, stage, min(1.0, done / total))
+        if models is None:
+            continue
+        stack.append((models, 1))
+        while len(stack) > 1 and stack[-1][1] == stack[-2][1]:
+            right, n = stack.pop()
+            left, _ = stack.pop()
+            stack.append((merge_models([left, right]), 2 * n))
+
+    if not stack:
+        return None
+    if len(stack) == 1:
+        return stack[0][0]
+    return merge_models([models for models, _ in stack])
+
+
+def load_model_file(path, expected_digest=None):
+    """按文件头识别 pickle 快照或扁平模型文件并加载，返回 (models, meta)，出错时抛出 SnapshotError"""
+    try:
+        with open(path, "rb") as f:
+            magic = f.read(len(FLAT_MAGIC))
+    except OSError as e:
+        raise SnapshotError(f"无法读取快照: {e}") from e
+    loader = load_flat if magic == FLAT_MAGIC else load_snapshot
+    return loader(path, expected_digest=expected_digest)
+
+
+def merge_snapshots(paths, out_path, corpus_path=None, flat=False):
+    """
+    把各分片的快照（pickle 或扁平格式均可，按分片顺序给出）归并成一个快照
+    corpus_path: 分片拼接成的完整语料文件，给出时记录其内容哈希，load_models 加载该语料时即可直接使用
+    返回快照路径，快照无效或阶数不一致时抛出 SnapshotError
+    """
+    shards, metas = [], []
+    for path in paths:
+        models, meta = load_model_file(path)
+        shards.append(models)
+        metas.append(meta)
+    try:
+        models = merge_models(shards)
+    except ValueError as e:
+        raise SnapshotError(f"无法合并快照: {e}") from e
+
+    meta = {
+        "corpus": os.path.basename(corpus_path) if corpus_path else None,
+        "corpus_sha256": None,
+        "markov_order": models["markov"].order,
+        "shards": [meta.get("corpus") for meta in metas],
+    }
+    if corpus_path:
+        meta["corpus_sha256"] = corpus_digest(corpus_path)
+        if meta["corpus_sha256"] is None:
+            raise SnapshotError(f"无法加载语料库: {corpus_path}")
+    (save_flat if flat else save_snapshot)(out_path, models, meta)
+    return out_path
+
+
+def append_models(models, new_text, workers=1, token_data=None):
+    """
+    把新文本增量训练进已有的三个模型（只对新文本分词一次，三个模型共用）
+    token_data: 已分好词的新文本，可省去分词
+    返回新的模型字典；原来的模型不受影响，更新期间可以继续提供服务
+    """
+    if token_data is None:
+        token_data = segment_corpus(new_text, use_cache=False, workers=workers)
+    updated = {}
+    for name, model in models.items():
+        updated[name] = copy.copy(model).train_incremental(new_text, token_data)
+    return updated
+
+
+def load_models(corpus_path, order=2, workers=1, use_snapshot=True, snapshot_dir=None,
+                progress=None):
+    """
+    加载语料对应的模型
+    use_snapshot 为真且存在与语料内容一致的快照时直接加载快照，否则重新训练；
+    扁平模型文件（mmap）优先于 pickle 快照
+    progress: 同 train_models
+    返回 (models, source, error)，source 为 "mmap"、"snapshot" 或 "trained"
+    """
+    _report(progress, "读取语料")
+    digest = corpus_digest(corpus_path)
+    if digest is None:
+        return None, None, "无法加载语料库"
+
+    if use_snapshot:
+        for path, loader, source in (
+            (flat_path(corpus_path, order, snapshot_dir), load_flat, "mmap"),
+            (snapshot_path(corpus_path, order, snapshot_dir), load_snapshot, "snapshot"),
+        ):
+            if not os.path.exists(path):
+                continue
+            _report(progress, "加载快照")
+            try:
+                models, _ = loader(path, expected_digest=digest)
+                return models, source, None
+            except SnapshotError:
+                pass  # 快照无效或已过期时退回到下一种快照或重新训练
+
+    # 逐块读取、训练，不把整个语料读入内存
+    try:
+        models = train_stream(
+            iter_corpus(corpus_path), order, workers, progress,
+            total=os.path.getsize(corpus_path),
+        )
+    except OSError:
+        return None, None, "无法加载语料库"
+    if models is None:
+        return None, None, "语料库为空或分词失败"
+    return models, "trained", None
+
+
+def build_snapshot(corpus_path, order=2, workers=1, out_path=None, flat=False, shards=1):
+    """
+    离线训练并保存快照
+    flat 为真时保存为可 mmap 的扁平模型文件（src/flatmodel.py），否则为 pickle 快照
+    shards > 1 时用 train_sharded 分片训练后归并（workers 为训练进程数），
+    否则用 train_stream 逐块读取、训练，不把整个语料读入内存
+    返回快照路径，语料无法加载时抛出 SnapshotError
+    """
+    digest = corpus_digest(corpus_path)
+    if digest is None:
+        raise SnapshotError(f"无法加载语料库: {corpus_path}")
+
+    if shards > 1:
+        models = train_sharded(load_corpus(corpus_path), order, shards, workers)
+    else:
+        models = train_stream(iter_corpus(corpus_path), order, workers)
+    if models is None:
+        raise SnapshotError(f"语料库为空或分词失败: {corpus_path}")
+
+    if flat:
+        path, save = out_path or flat_path(corpus_path, order), save_flat
+    else:
+        path, save = out_path or snapshot_path(corpus_path, order), save_snapshot
+    save(path, models, {
+        "corpus": os.path.basename(corpus_path),
+        "corpus_sha256": digest,
+        "markov_order": order,
+    })
+    return path
+
+
+def generate_poem(models, mode, num_lines, seed=None):
+    """
+    按模式生成一首诗（web_app 和命令行共用，保证相同的参数和种子得到相同的诗）
+    models: {"markov", "imagery", "structured"} 或 ModelBundle
+    mode: structured / imagery / backoff / markov
+    """
+    if mode == "structured":
+        return models["structured"].generate(expansion_count=num_lines, seed=seed)
+    if mode == "imagery":
+        return models["imagery"].generate(num_lines, max_imagery_per_line=3, seed=seed)
+    if mode == "backoff":
+        # 变阶马尔可夫：上下文没见过（或太少见）时退到更短的上下文
+        return models["markov"].generate(num_lines, seed=seed, backoff=True)
+    return models["markov"].generate(num_lines, seed=seed)
+
+
+def generate_poems(models, mode, num_lines, n):
+    """一次生成 n 首诗（不指定种子，能向量化的模式用 generate_batch），参数同 generate_poem"""
+    if mode == "structured":
+        return models["structured"].generate_batch(n, expansion_count=num_lines)
+    if mode == "imagery":
+        return models["imagery"].generate_batch(n, num_lines, max_imagery_per_line=3)
+    if mode == "backoff":
+        return [models["markov"].generate(num_lines, backoff=True) for _ in range(n)]
+    return models["markov"].generate_batch(n, num_lines)
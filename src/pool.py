@@ -0,0 +1,135 @@
+"""
+预生成诗歌池：按 (语料, 阶数, 模式, 行数) 缓存一批已生成好的诗，/api/generate 直接取出一首
+
+后台线程用 generate_batch 把池补到 high_water 首，取到低于 low_water 时触发补充。
+池记录生成它的 ModelBundle，模型组被替换后旧的诗不会再被取出。
+指定了种子的请求需要可复现的结果，不走诗歌池
+"""
+
+import queue
+import logging
+import threading
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class _PoolEntry:
+    """某一组 (模型组, 模式, 行数) 的诗歌队列"""
+
+    def __init__(self, bundle):
+        self.bundle = bundle
+        self.poems = deque()
+        self.refilling = False
+
+
+class PoemPool:
+    """
+    generate: generate(bundle, mode, num_lines, n) -> n 首诗的列表，在后台线程中调用
+    high_water: 每个池补充到的数量
+    low_water: 取出后剩余数量低于它时触发补充（默认为 high_water 的四分之一）
+    max_pools: 最多同时保留的池数，超出时丢弃最久未使用的
+    """
+
+    def __init__(self, generate, high_water=64, low_water=None, max_pools=32):
+        self.generate = generate
+        self.high_water = high_water
+        self.low_water = high_water // 4 if low_water is None else low_water
+        self.max_pools = max_pools
+        self._entries = OrderedDict()   # (语料, 阶数, 模式, 行数) -> _PoolEntry
+        self._lock = threading.Lock()
+        self._refill_queue = queue.Queue()
+        self._worker = None
+        self.metrics = {"hits": 0, "misses": 0, "refills": 0, "generated": 0, "invalidations": 0,
+                        "errors": 0}
+        self.last_error = None      # 最近一次补充失败的原因（stats() 中返回）
+
+    @staticmethod
+    def key(bundle, mode, num_lines):
+        return (bundle.corpus, bundle.markov_order, mode, num_lines)
+
+    def get(self, bundle, mode, num_lines):
+        """取出一首预生成的诗，池为空时返回 None（由调用方直接生成）"""
+        key = self.key(bundle, mode, num_lines)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.bundle is not bundle:
+                if entry is not None:
+                    self.metrics["invalidations"] += 1
+                entry = self._entries[key] = _PoolEntry(bundle)
+                while len(self._entries) > self.max_pools:
+                    self._entries.popitem(last=False)
+            self._entries.move_to_end(key)
+
+            try:
+                poem = entry.poems.popleft()
+                self.metrics["hits"] += 1
+            except IndexError:
+                poem = None
+                self.metrics["misses"] += 1
+
+            if len(entry.poems) < self.low_water and not entry.refilling:
+                entry.refilling = True
+                self._refill_queue.put((key, entry))
+                self._ensure_worker()
+        return poem
+
+    def invalidate(self, bundle=None):
+        """
+        丢弃预生成的诗
+        bundle 为 None 时清空全部；否则清空同一语料中不是由这组模型生成的池（模型组被替换时调用）
+        """
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if bundle is None or (
+                    entry.bundle.corpus == bundle.corpus
+                    and entry.bundle.variants is not bundle.variants
+                ):
+                    del self._entries[key]
+                    self.metrics["invalidations"] += 1
+
+    def stats(self):
+        """命中 / 未命中 / 补充 / 补充失败次数、最近一次失败的原因，以及各池当前的数量"""
+        with self._lock:
+            stats = dict(self.metrics, last_error=self.last_error)
+            stats["pools"] = [
+                {
+                    "corpus": corpus,
+                    "markov_order": order,
+                    "mode": mode,
+                    "num_lines": num_lines,
+                    "size": len(entry.poems),
+                }
+                for (corpus, order, mode, num_lines), entry in self._entries.items()
+            ]
+        return stats
+
+    def _ensure_worker(self):
+        """启动后台补充线程（调用方需持有 self._lock）"""
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._refill_loop, name="poem-pool", daemon=True)
+            self._worker.start()
+
+    def _refill_loop(self):
+        while True:
+            key, entry = self._refill_queue.get()
+            try:
+                count = self.high_water - len(entry.poems)
+                _, mode, num_lines = key[1:]
+                poems = self.generate(entry.bundle, mode, num_lines, count) if count > 0 else []
+            except Exception as e:
+                logger.exception("预生成诗歌失败 %s", key)
+                error = f"{key}: {e}"
+                poems = []
+            else:
+                error = None
+            with self._lock:
+                entry.refilling = False
+                if error is not None:
+                    self.metrics["errors"] += 1
+                    self.last_error = error
+                # 补充期间池已被替换或丢弃时，生成的诗直接丢弃
+                if self._entries.get(key) is entry and poems:
+                    entry.poems.extend(poems)
+                    self.metrics["refills"] += 1
+                    self.metrics["generated"] += len(poems)
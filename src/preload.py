@@ -0,0 +1,11 @@
+"""
+forkserver 进程预先导入的模块（见 utils.process_context）：
+导入训练代码并加载 jieba 词典，之后从 forkserver fork 出的训练、分词和生成进程直接继承，
+不必各自重新导入和加载
+"""
+
+import jieba
+
+from src import pipeline  # 训练代码（连同模型、快照模块）
+
+jieba.initialize()
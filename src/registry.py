@@ -0,0 +1,330 @@
+"""
+模型注册表：把三个模型打包成不可变的 ModelBundle，通过一次引用替换发布
+
+读取方（生成诗歌的请求）只需取一次 registry.current 或 registry.get()，之后使用的
+三个模型一定来自同一份语料，整个过程不加锁；训练在后台线程中进行，完成后才替换
+引用，训练期间旧的模型照常提供服务
+
+注册表同时缓存多组模型（按语料路径区分），总内存超出预算时按最近最少使用（LRU）
+淘汰，当前默认模型组不会被淘汰。马尔可夫模型的 n 元组树包含 1..max_order 的所有阶数，
+切换阶数只需 ModelBundle.with_order()，不重新训练，也不额外占用内存
+"""
+
+import os
+import dataclasses
+import sys
+import time
+import threading
+from array import array
+from dataclasses import dataclass, field
+
+from src import pipeline
+from src.flatmodel import flat_path
+from src.utils import segment_corpus
+
+
+def estimate_bytes(obj, seen=None):
+    """粗略估计对象（模型的 to_state() 结果）占用的内存，共享的对象只计一次"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, array):
+        return size
+    if isinstance(obj, dict):
+        return size + sum(
+            estimate_bytes(k, seen) + estimate_bytes(v, seen) for k, v in obj.items()
+        )
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return size + sum(estimate_bytes(item, seen) for item in obj)
+    return size
+
+
+@dataclass(frozen=True)
+class ModelBundle:
+    """同一份语料训练出的一组模型（发布后不再修改）"""
+
+    markov: object
+    imagery: object
+    structured: object
+    corpus: str                 # 语料文件名
+    markov_order: int
+    source: str = "trained"     # "trained"、"snapshot" 或 "mmap"
+    size_bytes: int = 0         # 估计的内存占用
+    created_at: float = field(default_factory=time.time)
+    # mmap 加载时为 (扁平模型文件路径, 文件修改时间)，生成进程据此映射同一个文件
+    model_file: tuple = None
+    # 阶数 -> 同一组模型在该阶数下的 ModelBundle（各阶数共享这个字典和模型的内存）
+    variants: dict = field(default_factory=dict, repr=False, compare=False)
+
+    def __post_init__(self):
+        # 新建的模型组登记为自身阶数的变体；with_order 创建的变体共享同一字典，由 with_order 登记
+        if not self.variants:
+            self.variants[self.markov_order] = self
+
+    @classmethod
+    def from_models(cls, models, corpus_path, order, source="trained", size_bytes=None):
+        """
+        source 为 "mmap" 时记录 load_models 所映射的扁平模型文件（默认快照目录）
+        size_bytes: 已知的内存占用（如增量训练时由旧模型组推算），给出时不再遍历全部模型估计
+        """
+        model_file = None
+        if source == "mmap":
+            path = flat_path(corpus_path, order)
+            try:
+                model_file = (path, os.stat(path).st_mtime_ns)
+            except OSError:
+                pass    # 文件已被删除：生成进程改为接收 to_state()
+        if size_bytes is None:
+            seen = set()
+            size_bytes = sum(estimate_bytes(model.to_state(), seen) for model in models.values())
+        return cls(
+            markov=models["markov"],
+            imagery=models["imagery"],
+            structured=models["structured"],
+            corpus=os.path.basename(corpus_path),
+            markov_order=order,
+            source=source,
+            size_bytes=size_bytes,
+            model_file=model_file,
+        )
+
+    def __getitem__(self, name):
+        """bundle["markov"] 等同于 bundle.markov：模型组可以当作模型字典使用（如 pipeline.generate_poem）"""
+        if name not in ("markov", "imagery", "structured"):
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def appended(self, new_text, corpus_path, workers=1):
+        """
+        把新文本增量训练进这组模型，返回新的 ModelBundle；本组不受影响，可以继续提供服务
+        新增的计数与新文本的词数成正比，内存占用按本组的大小加上新文本分词结果的大小推算，
+        不再遍历整个模型估计
+        """
+        token_data = segment_corpus(new_text, use_cache=False, workers=workers)
+        models = pipeline.append_models(
+            {name: self[name] for name in ("markov", "imagery", "structured")},
+            new_text, token_data=token_data,
+        )
+        return ModelBundle.from_models(
+            models, corpus_path, self.markov_order,
+            size_bytes=self.size_bytes + estimate_bytes(token_data),
+        )
+
+    @property
+    def max_order(self):
+        """不重新训练即可切换到的最高阶数"""
+        return self.markov.max_order
+
+    def with_order(self, order):
+        """
+        同一组模型在另一阶数下的 ModelBundle，共享词表与 n 元组树，不重新训练
+        order 超出 1..max_order 时抛出 ValueError
+        """
+        bundle = self.variants.get(order)
+        if bundle is None:
+            # 变体与本组模型共享模型和 variants 字典；并发创建时以先登记的为准
+            variant = dataclasses.replace(self, markov=self.markov.with_order(order), markov_order=order)
+            bundle = self.variants.setdefault(order, variant)
+        return bundle
+
+    def get_stats(self):
+        """结构化模型的统计信息 + 语料名与阶数"""
+        stats = self.structured.get_stats()
+        stats["current_corpus"] = self.corpus
+        stats["markov_order"] = self.markov_order
+        stats["max_order"] = self.max_order
+        return stats
+
+
+class ModelRegistry:
+    """
+    缓存多组 ModelBundle，并记录当前默认的一组
+
+    写入（加载、淘汰）在锁内完成，且总是构建新的字典再整体替换 self._bundles，
+    因此读取 current / get() 不加锁也只会看到完整的状态；
+    最近使用时间单独记录在 self._last_used 中，读取时更新它也不需要锁
+    max_bytes: 缓存的内存预算（字节），None 表示不限制
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._current = None
+        self._current_key = None
+        self._bundles = {}       # 语料路径 -> ModelBundle
+        self._last_used = {}     # 语料路径 -> 最近使用时间
+        self._lock = threading.Lock()
+        self._loading = {}       # 语料路径 -> 正在加载该组模型时持有的锁
+        self._version = 0        # 每次设置默认模型组时递增，只有最新一次的结果会被发布
+        self._listeners = []     # 默认模型组被替换后调用的回调 callback(bundle)
+
+    @staticmethod
+    def key(corpus_path):
+        return os.path.abspath(corpus_path)
+
+    @property
+    def current(self):
+        """当前默认的 ModelBundle（尚未加载时为 None）"""
+        return self._current
+
+    def get(self, corpus_path, order):
+        """取已缓存的模型组（切换到所需阶数），不存在或阶数超出 max_order 时返回 None"""
+        key = self.key(corpus_path)
+        bundle = self._bundles.get(key)
+        if bundle is None or not 1 <= order <= bundle.max_order:
+            return None
+        self._last_used[key] = time.monotonic()
+        return bundle.with_order(order)
+
+    def cached(self):
+        """已缓存的模型组列表（最近使用的在前）"""
+        bundles = self._bundles
+        last_used = self._last_used
+        keys = sorted(bundles, key=lambda k: last_used.get(k, 0), reverse=True)
+        return [bundles[k] for k in keys]
+
+    def add_listener(self, callback):
+        """注册回调 callback(bundle)，每次设置新的默认模型组后（在锁外）调用"""
+        self._listeners.append(callback)
+
+    def _notify(self, bundle):
+        for callback in self._listeners:
+            callback(bundle)
+
+    def total_bytes(self):
+        return sum(bundle.size_bytes for bundle in self._bundles.values())
+
+    def publish(self, bundle, corpus_path):
+        """直接发布一组模型并设为默认"""
+        key = self.key(corpus_path)
+        with self._lock:
+            self._version += 1
+            self._store(key, bundle)
+            self._current = bundle
+            self._current_key = key
+        self._notify(bundle)
+
+    def replace(self, corpus_path, bundle):
+        """
+        替换缓存中某一语料的模型组（例如增量训练之后）
+        该语料是当前默认模型组时同时替换默认模型组并通知回调；不打断正在进行的加载
+        """
+        key = self.key(corpus_path)
+        with self._lock:
+            self._store(key, bundle)
+            is_current = key == self._current_key
+            if is_current:
+                self._current = bundle
+        if is_current:
+            self._notify(bundle)
+
+    def _store(self, key, bundle):
+        """放入缓存并按预算淘汰（调用方需持有 self._lock）"""
+        bundles = dict(self._bundles)
+        bundles[key] = bundle
+        self._last_used[key] = time.monotonic()
+
+        if self.max_bytes is not None:
+            total = sum(b.size_bytes for b in bundles.values())
+            # 从最久未使用的开始淘汰，跳过刚放入的和当前默认的
+            for old_key in sorted(bundles, key=lambda k: self._last_used.get(k, 0)):
+                if total <= self.max_bytes:
+                    break
+                old = bundles[old_key]
+                if old_key == key or old_key == self._current_key:
+                    continue
+                del bundles[old_key]
+                self._last_used.pop(old_key, None)
+                total -= old.size_bytes
+
+        self._bundles = bundles
+
+    def get_or_load(self, corpus_path, order=2, workers=1, use_snapshot=True):
+        """
+        取缓存的模型组，没有时加载并放入缓存（不改变默认模型组）
+        同一组模型同时只会加载一次，其余请求等待它完成
+        返回 (bundle, error)
+        """
+        bundle = self.get(corpus_path, order)
+        if bundle is not None:
+            return bundle, None
+
+        key = self.key(corpus_path)
+        with self._lock:
+            loading = self._loading.setdefault(key, threading.Lock())
+        with loading:
+            bundle = self.get(corpus_path, order)
+            if bundle is not None:
+                return bundle, None
+            models, source, error = pipeline.load_models(
+                corpus_path, order, workers=workers, use_snapshot=use_snapshot
+            )
+            with self._lock:
+                self._loading.pop(key, None)
+                if error:
+                    return None, error
+                bundle = ModelBundle.from_models(models, corpus_path, order, source)
+                self._store(key, bundle)
+        return bundle, None
+
+    def begin_load(self):
+        """开始一次设置默认模型组的加载，返回版本号，交给 finish_load()"""
+        with self._lock:
+            self._version += 1
+            return self._version
+
+    def finish_load(self, version, corpus_path, bundle):
+        """
+        加载完成：放入缓存，且期间没有更新的加载时设为默认模型组
+        返回 (bundle, error)
+        """
+        key = self.key(corpus_path)
+        with self._lock:
+            self._store(key, bundle)
+            if version != self._version:
+                return None, "加载已被更新的加载请求取代"
+            self._current = bundle
+            self._current_key = key
+        self._notify(bundle)
+        return bundle, None
+
+    def load(self, corpus_path, order=2, workers=1, use_snapshot=True, progress=None):
+        """
+        加载语料并在完成后设为默认模型组
+        use_snapshot 为真且已缓存时直接复用（只切换阶数时无需重新训练），否则重新加载
+        progress: 同 pipeline.load_models
+        返回 (bundle, error)；若加载期间又发起了更新的加载，本次结果不设为默认并返回错误
+        """
+        version = self.begin_load()
+
+        bundle = self.get(corpus_path, order) if use_snapshot else None
+        if bundle is None:
+            models, source, error = pipeline.load_models(
+                corpus_path, order, workers=workers, use_snapshot=use_snapshot,
+                progress=progress,
+            )
+            if error:
+                return None, error
+            bundle = ModelBundle.from_models(models, corpus_path, order, source)
+
+        return self.finish_load(version, corpus_path, bundle)
+
+    def load_in_background(self, corpus_path, order=2, workers=1, use_snapshot=True, callback=None):
+        """
+        在后台线程中加载，立即返回线程对象
+        callback(bundle, error) 在加载结束后于后台线程中调用
+        """
+        def run():
+            try:
+                bundle, error = self.load(corpus_path, order, workers, use_snapshot)
+            except Exception as e:
+                bundle, error = None, f"加载失败: {str(e)}"
+            if callback:
+                callback(bundle, error)
+
+        thread = threading.Thread(target=run, name="model-loader", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,97 @@
+"""
+模型快照：把训练好的三个模型保存到磁盘，启动时直接加载，免去分词和训练
+
+文件布局:
+    魔数 SNAPSHOT_MAGIC
+    格式版本 (uint16, little-endian)
+    pickle 数据: meta 字典（语料名、内容哈希、阶数等）
+    pickle 数据: {"markov": state, "imagery": state, "structured": state}
+
+模型结构变化时递增 SNAPSHOT_VERSION，旧快照会被拒绝并需要重新构建
+"""
+
+import os
+import time
+import pickle
+import struct
+import hashlib
+
+from src.model import MarkovChain, ImageryChain, StructuredPoemGenerator
+
+SNAPSHOT_MAGIC = b"MPGSNAP\n"
+SNAPSHOT_VERSION = 5
+
+# 默认快照目录
+SNAPSHOT_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache", "snapshots"
+)
+
+# 快照中的模型名 -> 模型类
+MODEL_CLASSES = {
+    "markov": MarkovChain,
+    "imagery": ImageryChain,
+    "structured": StructuredPoemGenerator,
+}
+
+
+class SnapshotError(Exception):
+    """快照文件不存在、已损坏或版本不兼容"""
+
+
+def text_digest(text):
+    """语料文本的内容哈希，用于判断快照是否过期"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def snapshot_path(corpus_file, order, snapshot_dir=None):
+    """语料文件 + 马尔可夫阶数对应的默认快照路径"""
+    name = os.path.splitext(os.path.basename(corpus_file))[0]
+    return os.path.join(snapshot_dir or SNAPSHOT_DIR, f"{name}.order{order}.snap")
+
+
+def save_snapshot(path, models, meta):
+    """
+    保存快照
+    models: {"markov": MarkovChain, "imagery": ImageryChain, "structured": StructuredPoemGenerator}
+    meta: 附加信息（语料名、内容哈希、阶数等）
+    """
+    meta = dict(meta, created_at=time.time())
+    payload = {name: models[name].to_state() for name in MODEL_CLASSES}
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack("<H", SNAPSHOT_VERSION))
+        pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path, expected_digest=None):
+    """
+    加载快照
+    expected_digest: 语料当前的内容哈希，与快照记录不一致时视为过期
+    返回 (models, meta)，出错时抛出 SnapshotError
+    """
+    try:
+        with open(path, "rb") as f:
+            magic = f.read(len(SNAPSHOT_MAGIC))
+            if magic != SNAPSHOT_MAGIC:
+                raise SnapshotError(f"不是快照文件: {path}")
+            (version,) = struct.unpack("<H", f.read(2))
+            if version != SNAPSHOT_VERSION:
+                raise SnapshotError(
+                    f"快照版本不兼容: {version} (当前 {SNAPSHOT_VERSION})，请重新构建"
+                )
+            meta = pickle.load(f)
+            if expected_digest is not None and meta.get("corpus_sha256") != expected_digest:
+                raise SnapshotError(f"快照已过期（语料已修改）: {path}")
+            payload = pickle.load(f)
+    except OSError as e:
+        raise SnapshotError(f"无法读取快照: {e}") from e
+    except (pickle.UnpicklingError, EOFError, struct.error) as e:
+        raise SnapshotError(f"快照已损坏: {e}") from e
+
+    models = {name: cls.from_state(payload[name]) for name, cls in MODEL_CLASSES.items()}
+    return models, meta
@@ -0,0 +1,597 @@
+"""
+紧凑的模型存储结构：词表（词语 <-> 整数编号）与按层存放的 n 元组计数树
+所有计数表都是连续的整数数组（array.array），构建时用 numpy 排序计数，
+批量生成时通过 np.frombuffer 零拷贝地当作 numpy 数组做向量化抽样
+
+从扁平模型文件（src/flatmodel.py）加载时，这些数组是 mmap 上的 memoryview，
+字符串列表是 StringTable，用法与 array.array / list 相同，但都是只读的
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Sequence
+
+import numpy as np
+
+
+def _to_array(typecode, values):
+    """numpy 数组 -> array.array（逐元素访问比 numpy 标量快得多）"""
+    result = array(typecode)
+    result.frombytes(np.ascontiguousarray(values, dtype=np.dtype(typecode)).tobytes())
+    return result
+
+
+def _count_unique(keys):
+    """返回 (升序去重后的值, 各值出现次数, 每个元素对应的去重下标)"""
+    perm = np.argsort(keys)
+    sorted_keys = keys[perm]
+    is_first = np.empty(len(keys), dtype=bool)
+    is_first[:1] = True
+    np.not_equal(sorted_keys[1:], sorted_keys[:-1], out=is_first[1:])
+    starts = np.flatnonzero(is_first)
+    counts = np.diff(np.append(starts, len(keys)))
+    inverse = np.empty(len(keys), dtype=np.int64)
+    inverse[perm] = np.cumsum(is_first) - 1
+    return sorted_keys[starts], counts, inverse
+
+
+def _sum_counts(keys, counts):
+    """相同的键计数相加：返回 (升序去重后的键, 计数之和, 每个元素对应的去重下标)"""
+    unique, _, inverse = _count_unique(keys)
+    totals = np.bincount(inverse, weights=counts, minlength=len(unique)).astype(np.int64)
+    return unique, totals, inverse
+
+
+def _level_counts(cum):
+    """累积计数 -> 各项计数"""
+    return np.diff(as_numpy(cum), prepend=0)
+
+
+def as_numpy(values):
+    """array.array / memoryview -> 共享内存的 numpy 数组（不拷贝）"""
+    typecode = values.typecode if isinstance(values, array) else values.format
+    return np.frombuffer(values, dtype=np.dtype(typecode))
+
+
+def sample_ranges(lo, hi, cum, rng):
+    """
+    向量化抽样：对每个区间 [lo[k], hi[k]) 按累积计数 cum 抽取一个下标
+    调用方需保证所有区间非空；rng 为 numpy.random.Generator
+    """
+    base = np.where(lo > 0, cum[np.maximum(lo - 1, 0)], 0)
+    return np.searchsorted(cum, base + rng.integers(0, cum[hi - 1] - base), side="right")
+
+
+class StringTable(Sequence):
+    """
+    只读字符串列表：所有字符串的 UTF-8 编码拼成一块字节 blob，offsets[i] 为第 i 个字符串的
+    起始字节偏移（共 n + 1 项），order 为按字符串排序后的下标（用于二分查找）
+    三者可以直接是 mmap 上的视图，取出某一项时才解码成 str
+    """
+
+    def __init__(self, blob, offsets, order):
+        self.blob = blob        # 字节（bytes / memoryview）
+        self.offsets = offsets  # int64 数组
+        self.order = order      # int32 数组
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(data) for data in encoded], out=offsets[1:])
+        # UTF-8 字节序与 str 的码位顺序一致
+        order = sorted(range(len(encoded)), key=encoded.__getitem__)
+        return cls(b"".join(encoded), _to_array("q", offsets), array("i", order))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        offsets = self.offsets
+        return str(self.blob[offsets[i]:offsets[i + 1]], "utf-8")
+
+    def find(self, string):
+        """二分查找字符串的下标，不存在时返回 -1"""
+        order = self.order
+        k = bisect_left(order, string, key=self.__getitem__)
+        if k < len(order) and self[order[k]] == string:
+            return order[k]
+        return -1
+
+    def __contains__(self, string):
+        return self.find(string) >= 0
+
+    def __reduce__(self):
+        # 序列化（例如保存快照）时按普通列表处理
+        return list, (list(self),)
+
+
+class Vocabulary:
+    """
+    词表：词语 <-> 整数编号（按首次出现的顺序编号）
+    words 可以是只读的 StringTable（来自扁平模型文件），此时按需二分查找，
+    需要添加新词时才转成列表并建立 ids 字典
+    """
+
+    def __init__(self, words=None):
+        if isinstance(words, StringTable):
+            self.words = words
+            self._ids = None
+        else:
+            self.words = list(words) if words else []
+            self._ids = {word: i for i, word in enumerate(self.words)}
+        self._decode = None  # 批量解码用的查找表，按需构建
+
+    @property
+    def ids(self):
+        """词语 -> 编号"""
+        if self._ids is None:
+            self.words = list(self.words)
+            self._ids = {word: i for i, word in enumerate(self.words)}
+        return self._ids
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, word_id):
+        return self.words[word_id]
+
+    def get(self, word, default=None):
+        if self._ids is None:
+            word_id = self.words.find(word)
+            return default if word_id < 0 else word_id
+        return self._ids.get(word, default)
+
+    def add(self, word):
+        """返回词语编号，新词追加到词表末尾"""
+        word_id = self.ids.get(word)
+        if word_id is None:
+            word_id = self.ids[word] = len(self.words)
+            self.words.append(word)
+        return word_id
+
+    def merge(self, words):
+        """并入另一份词表（新词按其顺序追加），返回 numpy 数组：对方的编号 -> 本词表的编号"""
+        return np.asarray(self.encode(list(words)), dtype=np.int64)
+
+    def encode(self, tokens):
+        """把词语序列编码为编号列表（遇到新词自动加入词表）"""
+        ids = self.ids
+        words = self.words
+        for token in dict.fromkeys(tokens):
+            if token not in ids:
+                ids[token] = len(words)
+                words.append(token)
+        return list(map(ids.__getitem__, tokens))
+
+    def _decode_table(self):
+        """
+        批量解码用的查找表（词表变化后重建），最后一项对应编号 -1，即换行符:
+            blob     所有词语 UTF-8 编码拼成的字节数组
+            offsets  每个词在 blob 中的字节偏移
+            chars    每个词的字符数
+            visible  每个词是否含非空白字符
+        """
+        if self._decode is None or self._decode[-1] != len(self.words):
+            words = list(self.words) + ["\n"]
+            encoded = [word.encode("utf-8") for word in words]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(data) for data in encoded], out=offsets[1:])
+            if offsets[-1] < 2 ** 31:
+                offsets = offsets.astype(np.int32)  # 下标数组减半，拼接更快
+            chars = np.array([len(word) for word in words], dtype=np.int64)
+            visible = np.array([bool(word.strip()) for word in words])
+            blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+            self._decode = (blob, offsets, chars, visible, len(self.words))
+        return self._decode[:-1]
+
+    def visible_mask(self):
+        """布尔数组：词编号 -> 是否含非空白字符（最后一项对应编号 -1，即换行符）"""
+        return self._decode_table()[3]
+
+    def join_rows(self, ids, bounds):
+        """
+        批量解码：ids 为词编号数组（-1 解码为换行符），bounds 为长度 k + 1 的切分位置，
+        返回 k 个字符串，第 r 个是 ids[bounds[r]:bounds[r + 1]] 的词语拼接。
+        在字节层面用 numpy 一次拼好、整体解码后再按字符位置切分，避免逐词的 Python 操作
+        """
+        blob, offsets, chars, _ = self._decode_table()
+        ids = np.where(ids < 0, len(chars) - 1, ids)
+        starts = offsets[ids]
+        lengths = offsets[ids + 1] - starts
+        ends = np.cumsum(lengths)
+        total = int(ends[-1]) if len(ends) else 0
+        positions = np.repeat(starts - ends + lengths, lengths) + np.arange(total, dtype=offsets.dtype)
+        text = blob[positions].tobytes().decode("utf-8")
+
+        char_bounds = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(chars[ids], out=char_bounds[1:])
+        char_bounds = char_bounds[bounds].tolist()
+        return [text[a:b] for a, b in zip(char_bounds, char_bounds[1:])]
+
+
+class NGramTrie:
+    """
+    n 元组计数树，每一层是几条平行的数组:
+        tokens[d][j]       第 d 层节点 j 的最后一个词编号（对应语料中出现过的一个 d 元组）
+        cum[d][j]          第 d 层节点计数的全局累积和，节点计数 = cum[d][j] - cum[d][j - 1]
+        first_child[d][j]  节点 j 的子节点在第 d + 1 层的起始下标（长度为节点数 + 1）
+        suffix_link[d][j]  去掉首词后的 (d - 1) 元组在第 d - 1 层的下标（d >= 2）
+    第 0 层只有一个根节点。同一父节点的子节点按词编号升序连续存放，
+    因此查找子节点是一次二分，按计数抽样是在累积和上的一次二分；
+    沿后缀链接可以在 O(1) 内从 (w1..wn, w) 走到下一个上下文 (w2..wn, w)
+    """
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.tokens = [array("i") for _ in range(depth + 1)]
+        self.cum = [array("q") for _ in range(depth + 1)]
+        self.first_child = [array("q", [0]) for _ in range(depth)]
+        self.first_child[0].append(0)
+        self.suffix_link = [array("q") for _ in range(depth + 1)]
+
+    @classmethod
+    def build(cls, ids, depth):
+        """
+        从词编号序列统计所有长度 1..depth 的 n 元组
+        第 d 层中位置 i 的 d 元组 = (位置 i 的 d-1 元组节点, 位置 i+d-1 的词)，
+        把这一对编码成一个整数后排序去重，即得到按字典序排好的节点、计数
+        以及每个位置所属的节点，供下一层使用
+        """
+        trie = cls(depth)
+        seq = np.asarray(ids, dtype=np.int64)
+        n = len(seq)
+        vocab_size = int(seq.max()) + 1 if n else 1
+
+        pos_nodes = np.zeros(n, dtype=np.int64)  # 各位置所属的上一层节点（根）
+        n_prev = 1
+        for d in range(1, depth + 1):
+            m = n - d + 1
+            if m <= 0:
+                trie.first_child[d - 1] = array("q", [0] * (n_prev + 1))
+                n_prev = 0
+                pos_nodes = pos_nodes[:0]
+                continue
+
+            keys = pos_nodes[:m] * vocab_size + seq[d - 1:]
+            level_keys, counts, inverse = _count_unique(keys)
+            parents = level_keys // vocab_size
+
+            trie.tokens[d] = _to_array("i", level_keys % vocab_size)
+            trie.cum[d] = _to_array("q", np.cumsum(counts))
+            trie.first_child[d - 1] = _to_array(
+                "q", np.searchsorted(parents, np.arange(n_prev + 1))
+            )
+            if d > 1:
+                # 位置 i 的 d 元组去掉首词后，就是位置 i + 1 的 (d - 1) 元组
+                links = np.empty(len(level_keys), dtype=np.int64)
+                links[inverse] = pos_nodes[1:m + 1]
+                trie.suffix_link[d] = _to_array("q", links)
+
+            pos_nodes = inverse
+            n_prev = len(level_keys)
+
+        return trie
+
+    @classmethod
+    def merge(cls, parts):
+        """
+        合并多棵深度相同的计数树，parts 为 (trie, remap, weight) 的列表:
+            remap   numpy 数组，把该树的词编号映射到合并后的编号（None 表示不变）
+            weight  计数的系数，1 为相加，-1 为扣除（扣除的 n 元组必须包含在其余的树中）
+        逐层把 (合并后的父节点, 词编号) 编码成整数后相加计数，计数降为 0 的节点连同子树删除。
+        节点的排列方式与 build() 相同，因此结果与对拼接后的语料一次性 build() 得到的树一致
+        """
+        depth = parts[0][0].depth
+        trie = cls(depth)
+        n_cols = 1
+        for tree, remap, _ in parts:
+            tokens = as_numpy(tree.tokens[1]).astype(np.int64)
+            if len(tokens):
+                n_cols = max(n_cols, int((remap[tokens] if remap is not None else tokens).max()) + 1)
+
+        # 各树上一层的节点 -> 合并后的节点（-1 表示已删除）
+        node_maps = [np.zeros(1, dtype=np.int64) for _ in parts]
+        n_prev = 1
+        for d in range(1, depth + 1):
+            keys, counts = [], []
+            for (tree, remap, weight), node_map in zip(parts, node_maps):
+                parents = node_map[np.repeat(
+                    np.arange(len(node_map)), np.diff(as_numpy(tree.first_child[d - 1]))
+                )]
+                tokens = as_numpy(tree.tokens[d]).astype(np.int64)
+                if remap is not None:
+                    tokens = remap[tokens]
+                keys.append(np.where(parents >= 0, parents * n_cols + tokens, -1))
+                counts.append(weight * _level_counts(tree.cum[d]))
+            sizes = [len(k) for k in keys]
+            level_keys, totals, inverse = _sum_counts(np.concatenate(keys), np.concatenate(counts))
+
+            keep = (level_keys >= 0) & (totals > 0)
+            new_index = np.where(keep, np.cumsum(keep) - 1, -1)
+            level_keys, totals = level_keys[keep], totals[keep]
+            parents = level_keys // n_cols
+
+            trie.tokens[d] = _to_array("i", level_keys % n_cols)
+            trie.cum[d] = _to_array("q", np.cumsum(totals))
+            trie.first_child[d - 1] = _to_array(
+                "q", np.searchsorted(parents, np.arange(n_prev + 1))
+            )
+
+            maps = np.split(new_index[inverse], np.cumsum(sizes)[:-1])
+            if d > 1:
+                # 后缀链接指向上一层，换算成合并后的编号
+                links = np.zeros(len(level_keys), dtype=np.int64)
+                for (tree, _, _), old_map, new_map in zip(parts, node_maps, maps):
+                    valid = new_map >= 0
+                    links[new_map[valid]] = old_map[as_numpy(tree.suffix_link[d])[valid]]
+                trie.suffix_link[d] = _to_array("q", links)
+
+            node_maps = maps
+            n_prev = len(level_keys)
+
+        return trie
+
+    def num_nodes(self, d):
+        """第 d 层的节点数"""
+        return 1 if d == 0 else len(self.tokens[d])
+
+    def count(self, d, j):
+        """第 d 层节点 j 的计数"""
+        cum = self.cum[d]
+        return cum[j] - (cum[j - 1] if j > 0 else 0)
+
+    def child_range(self, d, node):
+        """第 d 层节点的子节点在第 d + 1 层的下标范围 [lo, hi)"""
+        offsets = self.first_child[d]
+        return offsets[node], offsets[node + 1]
+
+    def find_child(self, d, node, token):
+        """在第 d 层节点的子节点中查找词编号 token，找不到返回 -1"""
+        offsets = self.first_child[d]
+        lo, hi = offsets[node], offsets[node + 1]
+        tokens = self.tokens[d + 1]
+        j = bisect_left(tokens, token, lo, hi)
+        if j < hi and tokens[j] == token:
+            return j
+        return -1
+
+    def find(self, context):
+        """查找词编号序列对应的节点（位于第 len(context) 层），找不到返回 -1"""
+        node = 0
+        for d, token in enumerate(context):
+            node = self.find_child(d, node, token)
+            if node < 0:
+                return -1
+        return node
+
+    def sample_child(self, d, node, rng):
+        """按计数随机选取第 d 层节点的一个子节点，没有子节点时返回 -1"""
+        offsets = self.first_child[d]
+        lo, hi = offsets[node], offsets[node + 1]
+        if lo == hi:
+            return -1
+        cum = self.cum[d + 1]
+        base = cum[lo - 1] if lo > 0 else 0
+        x = base + rng.randrange(cum[hi - 1] - base)
+        return bisect_right(cum, x, lo, hi)
+
+    def sample_child_array(self, d, nodes, rng):
+        """sample_child() 的向量化版本：nodes 为第 d 层节点数组，没有子节点的对应 -1"""
+        offsets = as_numpy(self.first_child[d])
+        lo = offsets[nodes]
+        hi = offsets[nodes + 1]
+        # 只有一个子节点时不必抽样
+        result = np.where(lo < hi, lo, -1)
+        multi = hi - lo > 1
+        if multi.any():
+            result[multi] = sample_ranges(lo[multi], hi[multi], as_numpy(self.cum[d + 1]), rng)
+        return result
+
+    def iter_nodes(self, d):
+        """深度优先遍历第 d 层的所有节点，产生 (节点下标, 词编号路径)"""
+        path = []
+
+        def walk(level, node):
+            if level == d:
+                yield node, tuple(path)
+                return
+            lo, hi = self.child_range(level, node)
+            for j in range(lo, hi):
+                path.append(self.tokens[level + 1][j])
+                yield from walk(level + 1, j)
+                path.pop()
+
+        yield from walk(0, 0)
+
+    def to_state(self):
+        return {
+            "depth": self.depth,
+            "tokens": self.tokens,
+            "cum": self.cum,
+            "first_child": self.first_child,
+            "suffix_link": self.suffix_link,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        trie = cls(state["depth"])
+        trie.tokens = state["tokens"]
+        trie.cum = state["cum"]
+        trie.first_child = state["first_child"]
+        trie.suffix_link = state["suffix_link"]
+        return trie
+
+
+class TransitionTable:
+    """
+    稠密 CSR 转移表：第 i 行对应源词编号 i，行内是去重后的目标词编号（升序）
+    与目标计数的全局累积和；按计数抽样是一次二分，不分配任何对象
+    """
+
+    def __init__(self):
+        self.offsets = array("q", [0])
+        self.targets = array("i")
+        self.cum = array("q")
+        self.size = 0  # 至少有一个目标的行数
+
+    @classmethod
+    def build(cls, sources, targets, n_rows):
+        """从 (源编号, 目标编号) 序列统计计数"""
+        src = np.asarray(sources, dtype=np.int64)
+        dst = np.asarray(targets, dtype=np.int64)
+        n_cols = max(n_rows, 1)
+        if len(src):
+            keys, counts, _ = _count_unique(src * n_cols + dst)
+        else:
+            keys = counts = np.zeros(0, dtype=np.int64)
+        return cls._from_counts(keys, counts, n_rows)
+
+    @classmethod
+    def merge(cls, parts, n_rows):
+        """
+        合并多张转移表，parts 为 (table, remap, weight) 的列表（含义同 NGramTrie.merge），
+        源编号和目标编号都经 remap 映射；计数降为 0 的转移被删除
+        """
+        n_cols = max(n_rows, 1)
+        keys, counts = [], []
+        for table, remap, weight in parts:
+            offsets = as_numpy(table.offsets)
+            src = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+            dst = as_numpy(table.targets).astype(np.int64)
+            if remap is not None:
+                src, dst = remap[src], remap[dst]
+            keys.append(src * n_cols + dst)
+            counts.append(weight * _level_counts(table.cum))
+        keys, counts, _ = _sum_counts(np.concatenate(keys), np.concatenate(counts))
+        return cls._from_counts(keys[counts > 0], counts[counts > 0], n_rows)
+
+    @classmethod
+    def _from_counts(cls, keys, counts, n_rows):
+        """由升序的 (源 * 列数 + 目标) 键与计数构建"""
+        table = cls()
+        n_cols = max(n_rows, 1)
+        offsets = np.searchsorted(keys // n_cols, np.arange(n_rows + 1))
+        table.offsets = _to_array("q", offsets)
+        table.targets = _to_array("i", keys % n_cols)
+        table.cum = _to_array("q", np.cumsum(counts))
+        table.size = int(np.count_nonzero(np.diff(offsets)))
+        return table
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, source):
+        offsets = self.offsets
+        return 0 <= source < len(offsets) - 1 and offsets[source] < offsets[source + 1]
+
+    def sample(self, source, rng):
+        """按计数随机选取一个目标编号，该行为空时返回 -1"""
+        offsets = self.offsets
+        if not 0 <= source < len(offsets) - 1:
+            return -1
+        lo, hi = offsets[source], offsets[source + 1]
+        if lo == hi:
+            return -1
+        if hi - lo == 1:
+            return self.targets[lo]
+        cum = self.cum
+        base = cum[lo - 1] if lo > 0 else 0
+        return self.targets[bisect_right(cum, base + rng.randrange(cum[hi - 1] - base), lo, hi)]
+
+    def sample_array(self, sources, rng):
+        """sample() 的向量化版本：sources 为源编号数组，空行或无效源对应 -1"""
+        offsets = as_numpy(self.offsets)
+        result = np.full(len(sources), -1, dtype=np.int64)
+        valid = np.flatnonzero((sources >= 0) & (sources < len(offsets) - 1))
+        lo = offsets[sources[valid]]
+        hi = offsets[sources[valid] + 1]
+        j = np.where(lo < hi, lo, -1)
+        multi = hi - lo > 1
+        if multi.any():
+            j[multi] = sample_ranges(lo[multi], hi[multi], as_numpy(self.cum), rng)
+        found = j >= 0
+        result[valid[found]] = as_numpy(self.targets)[j[found]]
+        return result
+
+    def successors(self, source):
+        """返回 {目标编号: 计数}"""
+        if source not in self:
+            return {}
+        lo, hi = self.offsets[source], self.offsets[source + 1]
+        cum = self.cum
+        return {
+            self.targets[j]: cum[j] - (cum[j - 1] if j > 0 else 0) for j in range(lo, hi)
+        }
+
+    def to_state(self):
+        return {"offsets": self.offsets, "targets": self.targets, "cum": self.cum, "size": self.size}
+
+    @classmethod
+    def from_state(cls, state):
+        table = cls()
+        table.offsets = state["offsets"]
+        table.targets = state["targets"]
+        table.cum = state["cum"]
+        table.size = state["size"]
+        return table
+
+
+class Distribution:
+    """离散分布：去重后的取值（升序）与计数累积和，抽样是一次二分"""
+
+    def __init__(self):
+        self.values = array("i")
+        self.cum = array("q")
+
+    @classmethod
+    def build(cls, values):
+        """从带重复的取值序列统计计数"""
+        dist = cls()
+        if len(values):
+            unique, counts, _ = _count_unique(np.asarray(values, dtype=np.int64))
+            dist.values = _to_array("i", unique)
+            dist.cum = _to_array("q", np.cumsum(counts))
+        return dist
+
+    @classmethod
+    def merge(cls, parts):
+        """合并多个分布，parts 为 (dist, remap, weight) 的列表（含义同 NGramTrie.merge）"""
+        values, counts = [], []
+        for dist, remap, weight in parts:
+            dist_values = as_numpy(dist.values).astype(np.int64)
+            values.append(remap[dist_values] if remap is not None else dist_values)
+            counts.append(weight * _level_counts(dist.cum))
+        merged = cls()
+        values, counts, _ = _sum_counts(np.concatenate(values), np.concatenate(counts))
+        if len(values):
+            merged.values = _to_array("i", values[counts > 0])
+            merged.cum = _to_array("q", np.cumsum(counts[counts > 0]))
+        return merged
+
+    def __len__(self):
+        return len(self.values)
+
+    def sample(self, rng):
+        """按计数随机取值（调用方需保证分布非空）"""
+        return self.values[bisect_right(self.cum, rng.randrange(self.cum[-1]))]
+
+    def sample_array(self, size, rng):
+        """sample() 的向量化版本，一次抽取 size 个值"""
+        cum = as_numpy(self.cum)
+        k = np.searchsorted(cum, rng.integers(0, cum[-1], size), side="right")
+        return as_numpy(self.values)[k].astype(np.int64)
+
+    def to_state(self):
+        return {"values": self.values, "cum": self.cum}
+
+    @classmethod
+    def from_state(cls, state):
+        dist = cls()
+        dist.values = state["values"]
+        dist.cum = state["cum"]
+        return dist
@@ -2,6 +2,34 @@ import jieba
 import jieba.posseg as pseg
 import re
 import os
+import sys
+import struct
+import hashlib
+import multiprocessing
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+# 分词缓存目录（按语料内容哈希存放 (word, pos) 序列），可用环境变量 SEGMENT_CACHE_DIR 指定；
+# 子进程（训练任务等）导入本模块时同样读取该环境变量
+SEGMENT_CACHE_DIR = os.environ.get("SEGMENT_CACHE_DIR") or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache", "segments"
+)
+
+# 缓存文件格式: 魔数 + 格式版本 + 字节序（分词或词性标注规则变化时也递增格式版本，使旧缓存失效）
+SEGMENT_CACHE_MAGIC = b"MPGSEG"
+SEGMENT_CACHE_VERSION = 3
+
+# 并行分词时每个进程平均分到的块数（块越多负载越均衡）
+CHUNKS_PER_WORKER = 4
+
+# 单进程分词时每处理多少行汇报一次进度
+PROGRESS_EVERY_LINES = 2000
+
+# 流式读取语料时每块的行数（iter_corpus）
+CORPUS_CHUNK_LINES = 20000
 
 
 def load_corpus(filepath):
@@ -12,6 +40,38 @@ def load_corpus(filepath):
         return f.read()
 
 
+def iter_corpus(filepath, chunk_lines=None):
+    """
+    流式读取语料：逐行读文件，每凑满 chunk_lines 行（默认 CORPUS_CHUNK_LINES）产出一块文本，
+    只在行与行之间切分，所以逐块分词的结果拼起来与整个文件一次分词相同。
+    任何时候内存中只有一块文本；文件不存在时抛出 OSError
+    """
+    chunk_lines = chunk_lines or CORPUS_CHUNK_LINES
+    with open(filepath, "r", encoding="utf-8") as f:
+        lines = []
+        for line in f:
+            lines.append(line)
+            if len(lines) >= chunk_lines:
+                yield "".join(lines)
+                lines = []
+        if lines:
+            yield "".join(lines)
+
+
+def corpus_digest(filepath):
+    """
+    流式计算语料文件的内容哈希（与 snapshot.text_digest(load_corpus(filepath)) 相同），
+    不把整个文件读入内存；文件不存在时返回 None
+    """
+    if not os.path.exists(filepath):
+        return None
+    digest = hashlib.sha256()
+    with open(filepath, "r", encoding="utf-8") as f:
+        for block in iter(lambda: f.read(1 << 20), ""):
+            digest.update(block.encode("utf-8"))
+    return digest.hexdigest()
+
+
 def clean_and_tokenize(text):
     """
     Cleans text and uses jieba to tokenize.
@@ -55,33 +115,328 @@ NOUN_POS_TAGS = {
     't',    # 时间词
 }
 
+# 词典外词语的词性缓存，同一进程内逐块分词时各块共用（词典中新加入的词先查词性表，不受影响）
+_UNKNOWN_POS = {}
 
-def tokenize_with_pos(text):
+
+def _lookup_pos(word, word_tag_tab, unknown_pos):
     """
-    使用词性标注分词，返回 (tokens, pos_tags) 两个列表
-    tokens: 词语列表
-    pos_tags: 对应的词性标记列表
+    查询单个词的词性
+    词典内的词直接查 posseg 的词性表（与 pseg.lcut 对词典词的处理一致），
+    词典外的词（新词、标点等）单独交给 posseg 的 HMM 判断：HMM 也把它当作一个词时用其词性，
+    否则（如 "之唇"、"膝如木" 被拆成几个成分）说明它只是 jieba.lcut 拼出的片段，标为 "x"
+    """
+    pos = word_tag_tab.get(word)
+    if pos is None:
+        pos = unknown_pos.get(word)
+        if pos is None:
+            parts = pseg.lcut(word)
+            pos = parts[0].flag if len(parts) == 1 else "x"
+            unknown_pos[word] = pos
+    return pos
+
+
+_HAN = re.compile(r"[\u4e00-\u9fff]")
+
+
+def _tag_line(line, word_tag_tab, unknown_pos):
+    """
+    切分并标注一行，返回 [(word, pos), ...]，词语与 jieba.lcut(line) 相同
+    行内有词典外的汉字词时，先对整行跑一遍 pseg.lcut，按上下文标注：
+    两种切分中位置相同的词用 pseg 的词性（例如 "爱你成病" 中的 "成病" 是动词），
+    其余的词典外片段才单独判断（_lookup_pos）
+    """
+    words = jieba.lcut(line)
+    if all(word in word_tag_tab or not _HAN.search(word) for word in words):
+        return [(word, _lookup_pos(word, word_tag_tab, unknown_pos)) for word in words]
+
+    in_context = {}
+    start = 0
+    for pair in pseg.lcut(line):
+        in_context[start, start + len(pair.word)] = pair.flag
+        start += len(pair.word)
+
+    tagged = []
+    start = 0
+    for word in words:
+        end = start + len(word)
+        pos = word_tag_tab.get(word) or in_context.get((start, end))
+        tagged.append((word, pos or _lookup_pos(word, word_tag_tab, unknown_pos)))
+        start = end
+    return tagged
+
+
+def segment_corpus(text, use_cache=True, workers=1, progress=None):
+    """
+    单次分词 + 词性标注，三个模型共用同一份结果
+    用 jieba.lcut 切分每一行，再为每个词补上词性；只有含词典外汉字词的行才再跑 pseg.lcut（见 _tag_line）
+    返回 token_data: list of (word, pos, is_imagery)，每行末尾追加 ("\n", "x", False)
+    其中的词语序列与 clean_and_tokenize(text) 完全一致
+
+    词性与逐行 pseg.lcut 并不完全相同：两者对词典外的片段切分不同，这里的词语以 jieba.lcut
+    为准（马尔可夫模型的词语序列不变），能对上 pseg 切分的词用其上下文中的词性（见 _tag_line），
+    意象词集合因此有差异（haizi_full.txt 上为 2406 个意象词，逐行 pseg.lcut 为 2495 个，
+    对称差 181 个词）；分词耗时约为逐行 pseg.lcut 的三分之二（1.80s 对 2.64s）
+
+    use_cache: 是否使用磁盘分词缓存（按文本内容哈希 + jieba 版本/词典区分）
+    workers: 分词进程数，1 为单进程，<= 0 表示使用全部 CPU 核心
+    progress: 可选的回调 progress(fraction)，分词过程中汇报完成比例（0~1）
+    """
+    cache_path = segment_cache_path(text) if use_cache else None
+    if cache_path is not None:
+        token_data = read_segment_cache(cache_path)
+        if token_data is not None:
+            if progress:
+                progress(1.0)
+            return token_data
+
+    workers = resolve_workers(workers)
+    if workers > 1:
+        token_data = _segment_parallel(text, workers, progress)
+    else:
+        token_data = _segment_text(text, progress)
+
+    if cache_path is not None:
+        write_segment_cache(cache_path, token_data)
+    return token_data
+
+
+def resolve_workers(workers):
+    """把 workers 参数换算成实际进程数（<= 0 或 None 表示全部核心）"""
+    if workers is None or workers <= 0:
+        return os.cpu_count() or 1
+    return workers
+
+
+def split_on_blank_lines(text, n_chunks):
+    """
+    在诗与诗之间的空行处把文本切成大约 n_chunks 块（按字符数均分）
+    只在行边界切分，因此逐行分词的结果与不切分时完全相同
     """
     text = text.replace("\r\n", "\n").replace("\r", "\n")
+    target = max(1, len(text) // max(1, n_chunks))
+
+    chunks = []
+    current = []
+    size = 0
+    for line in text.split("\n"):
+        if size >= target and not line.strip():
+            chunks.append("\n".join(current))
+            current = []
+            size = 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def process_context():
+    """
+    进程池和子进程的启动方式（训练任务、生成进程池、并行分词和分块训练共用）
+    Web 服务是多线程的（请求线程、诗歌池补充线程等），在其中 fork 可能继承其他线程持有的锁
+    （jieba、logging 等），因此用 forkserver（不支持时用 spawn）。forkserver 进程预先导入
+    src.preload（训练代码和 jieba 词典），之后的子进程从它 fork，直接继承已加载的词典；
+    forkserver 全局只有一个，所以各处都要用这里的上下文，预先导入的模块才一致
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload(["src.preload"])
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+
+def _segment_parallel(text, workers, progress=None):
+    """按诗切块，在进程池中分别分词，再按原顺序拼接"""
+    chunks = split_on_blank_lines(text, workers * CHUNKS_PER_WORKER)
+    if len(chunks) < 2:
+        return _segment_text(text, progress)
+
+    # 子进程不从当前（可能是多线程的）进程 fork，词典由 forkserver 预先加载（见 process_context）
+    token_data = []
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), mp_context=process_context()) as pool:
+        for done, part in enumerate(pool.map(_segment_text, chunks), 1):
+            token_data.extend(part)
+            if progress:
+                progress(done / len(chunks))
+    return token_data
+
+
+def _segment_text(text, progress=None):
+    """实际执行分词与词性标注"""
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
     lines = text.split("\n")
-    
-    tokens = []
-    pos_tags = []
-    
-    for line in lines:
+
+    pseg.dt.makesure_userdict_loaded()
+    word_tag_tab = pseg.dt.word_tag_tab
+    unknown_pos = _UNKNOWN_POS
+
+    token_data = []
+
+    for i, line in enumerate(lines):
+        if progress and i % PROGRESS_EVERY_LINES == 0:
+            progress(i / len(lines))
         line = line.strip()
         if not line:
             continue
-        
-        # 词性标注分词
-        words = pseg.lcut(line)
-        for word, pos in words:
-            tokens.append(word)
-            pos_tags.append(pos)
-        
-        tokens.append("\n")
-        pos_tags.append("x")  # 标点符号类
-    
+
+        for word, pos in _tag_line(line, word_tag_tab, unknown_pos):
+            token_data.append((word, pos, pos in NOUN_POS_TAGS))
+
+        # 换行符
+        token_data.append(("\n", "x", False))
+
+    if progress:
+        progress(1.0)
+    return token_data
+
+
+def _segmenter_fingerprint():
+    """jieba 版本 + 词典文件信息，任何一项变化都会让旧缓存失效"""
+    dictionary = jieba.dt.dictionary
+    if dictionary is None:
+        dictionary = os.path.join(os.path.dirname(jieba.__file__), jieba.DEFAULT_DICT_NAME)
+    try:
+        st = os.stat(dictionary)
+        dict_info = f"{dictionary}:{st.st_size}:{int(st.st_mtime)}"
+    except OSError:
+        dict_info = str(dictionary)
+    return f"jieba={jieba.__version__};dict={dict_info};fmt={SEGMENT_CACHE_VERSION}"
+
+
+def segment_cache_path(text):
+    """根据文本内容哈希与分词器指纹计算缓存文件路径"""
+    h = hashlib.sha256()
+    h.update(_segmenter_fingerprint().encode("utf-8"))
+    h.update(b"\0")
+    h.update(text.encode("utf-8"))
+    return os.path.join(SEGMENT_CACHE_DIR, h.hexdigest() + ".seg")
+
+
+def _pack_strings(strings):
+    """字符串表: 数量 + 偏移数组 + UTF-8 数据"""
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = array("I", [0])
+    total = 0
+    for b in encoded:
+        total += len(b)
+        offsets.append(total)
+    return struct.pack("<I", len(encoded)) + offsets.tobytes() + b"".join(encoded)
+
+
+def _unpack_strings(buf, pos):
+    """解析 _pack_strings 的结果，返回 (字符串列表, 新位置)"""
+    (count,) = struct.unpack_from("<I", buf, pos)
+    pos += 4
+    offsets = array("I")
+    offsets.frombytes(buf[pos:pos + 4 * (count + 1)])
+    pos += 4 * (count + 1)
+    blob = buf[pos:pos + offsets[-1]]
+    pos += offsets[-1]
+    strings = [blob[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(count)]
+    return strings, pos
+
+
+def write_segment_cache(path, token_data):
+    """
+    把 token_data 写成紧凑的二进制缓存
+    布局: 条目表的词语 + 词性表 + 每个条目的词性编号 + 条目编号序列
+    每个不同的 (词, 词性) 对是一个条目：词典外的词按上下文标注（见 _tag_line），
+    同一个词在不同的行中可能有不同的词性，所以不能按词只存一个词性
+    """
+    entry_ids = {}
+    words = []
+    pos_ids = {}
+    pos_names = []
+    word_pos = array("H")
+    stream = array("I")
+
+    for word, pos, is_imagery in token_data:
+        eid = entry_ids.get((word, pos))
+        if eid is None:
+            eid = entry_ids[word, pos] = len(words)
+            words.append(word)
+            pid = pos_ids.get(pos)
+            if pid is None:
+                pid = pos_ids[pos] = len(pos_names)
+                pos_names.append(pos)
+            word_pos.append(pid)
+        stream.append(eid)
+
+    header = SEGMENT_CACHE_MAGIC + struct.pack(
+        "<HcQ", SEGMENT_CACHE_VERSION, sys.byteorder[0].encode("ascii"), len(stream)
+    )
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            f.write(_pack_strings(words))
+            f.write(_pack_strings(pos_names))
+            f.write(word_pos.tobytes())
+            f.write(stream.tobytes())
+        os.replace(tmp_path, path)
+    except OSError:
+        # 缓存只是加速手段，写入失败（如只读目录）不影响正常使用
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def read_segment_cache(path):
+    """读取分词缓存，文件不存在、版本不符或已损坏时返回 None"""
+    try:
+        with open(path, "rb") as f:
+            buf = f.read()
+    except OSError:
+        return None
+
+    try:
+        pos = len(SEGMENT_CACHE_MAGIC)
+        if buf[:pos] != SEGMENT_CACHE_MAGIC:
+            return None
+        version, byteorder, n_tokens = struct.unpack_from("<HcQ", buf, pos)
+        if version != SEGMENT_CACHE_VERSION or byteorder != sys.byteorder[0].encode("ascii"):
+            return None
+        pos += struct.calcsize("<HcQ")
+
+        words, pos = _unpack_strings(buf, pos)
+        pos_names, pos = _unpack_strings(buf, pos)
+
+        word_pos = array("H")
+        word_pos.frombytes(buf[pos:pos + 2 * len(words)])
+        pos += 2 * len(words)
+
+        stream = array("I")
+        stream.frombytes(buf[pos:pos + 4 * n_tokens])
+        if len(stream) != n_tokens:
+            return None
+    except (struct.error, ValueError, IndexError, UnicodeDecodeError):
+        return None
+
+    # 同一个 (词, 词性) 共用同一个元组对象
+    entries = []
+    for word, pid in zip(words, word_pos):
+        pos_name = pos_names[pid]
+        entries.append((word, pos_name, pos_name in NOUN_POS_TAGS))
+    return [entries[i] for i in stream]
+
+
+def token_words(token_data):
+    """从 token_data 中取出词语序列（即马尔可夫模型的训练 tokens）"""
+    return [word for word, pos, is_imagery in token_data]
+
+
+def tokenize_with_pos(text):
+    """
+    使用词性标注分词，返回 (tokens, pos_tags) 两个列表
+    tokens: 词语列表
+    pos_tags: 对应的词性标记列表
+    """
+    token_data = segment_corpus(text)
+    tokens = [word for word, pos, is_imagery in token_data]
+    pos_tags = [pos for word, pos, is_imagery in token_data]
     return tokens, pos_tags
 
 
@@ -93,32 +448,66 @@ def extract_imagery_and_connectors(text):
         connectors: set of other words (连接词)
         token_data: list of (word, pos, is_imagery) 用于训练
     """
-    text = text.replace("\r\n", "\n").replace("\r", "\n")
-    lines = text.split("\n")
-    
+    token_data = segment_corpus(text)
+    imagery, connectors = collect_imagery_and_connectors(token_data)
+    return imagery, connectors, token_data
+
+
+def collect_imagery_and_connectors(token_data):
+    """从已分词的 token_data 中收集意象词集合与连接词集合"""
     imagery = set()       # 意象词集合
     connectors = set()    # 连接词集合
-    token_data = []       # (word, pos, is_imagery)
-    
-    for line in lines:
-        line = line.strip()
-        if not line:
+
+    for word, pos, is_imagery in token_data:
+        if word == "\n":
             continue
-        
-        words = pseg.lcut(line)
-        for word, pos in words:
-            is_imagery = pos in NOUN_POS_TAGS
-            
-            if is_imagery:
-                imagery.add(word)
-            else:
-                # 过滤掉纯标点
-                if word.strip() and not re.match(r'^[，。、；：？！""''（）\\s]+$', word):
-                    connectors.add(word)
-            
-            token_data.append((word, pos, is_imagery))
-        
-        # 换行符
-        token_data.append(("\n", "x", False))
-    
-    return imagery, connectors, token_data
+        if is_imagery:
+            imagery.add(word)
+        else:
+            # 过滤掉纯标点
+            if word.strip() and not re.match(r'^[，。、；：？！""''（）\\s]+$', word):
+                connectors.add(word)
+
+    return imagery, connectors
+
+
+def keyword_masks(lines, keyword_sets):
+    """
+    一次性给所有诗行打上关键词类别标签
+    keyword_sets: 关键词集合的列表，第 b 个集合中任一关键词出现在某行中时，该行结果的第 b 位为 1
+
+    全部诗行拼成一个 Unicode 码位数组后用 numpy 匹配：单字关键词查表，多字关键词先找首字
+    再逐字筛选，最后按行做 OR 归约，不再对每一行逐个关键词做子串查找
+    返回与 lines 一一对应的 numpy int64 数组
+    """
+    if not lines:
+        return np.zeros(0, dtype=np.int64)
+
+    masks = {}
+    for bit, keywords in enumerate(keyword_sets):
+        for keyword in keywords:
+            masks[keyword] = masks.get(keyword, 0) | (1 << bit)
+
+    # 每行后面跟一个换行符，所以每行至少占一个位置，关键词也不会跨行匹配
+    codes = np.frombuffer("\n".join(lines).encode("utf-32-le") + b"\n\0\0\0", dtype=np.uint32)
+    lengths = np.fromiter(map(len, lines), dtype=np.int64, count=len(lines))
+    starts = np.zeros(len(lines), dtype=np.int64)
+    np.cumsum(lengths[:-1] + 1, out=starts[1:])
+
+    # hits[i]: 从位置 i 开始的关键词的类别位
+    single = {ord(k): m for k, m in masks.items() if len(k) == 1}
+    table = np.zeros(max(single, default=0) + 1, dtype=np.int64)
+    for code, mask in single.items():
+        table[code] = mask
+    hits = np.where(codes < len(table), table[np.minimum(codes, len(table) - 1)], 0)
+
+    for keyword, mask in masks.items():
+        if len(keyword) == 1:
+            continue
+        pos = np.flatnonzero(codes == ord(keyword[0]))
+        pos = pos[pos + len(keyword) <= len(codes)]
+        for i, char in enumerate(keyword[1:], 1):
+            pos = pos[codes[pos + i] == ord(char)]
+        hits[pos] |= mask
+
+    return np.bitwise_or.reduceat(hits, starts)
@@ -0,0 +1,204 @@
+"""
+多进程生成：把生成请求分派到进程池，绕开 GIL，吞吐量随 CPU 核心数增长
+
+Web 服务是多线程的，在其中 fork 可能继承其他线程持有的锁，因此工作进程用 forkserver
+（不支持时用 spawn，见 utils.process_context）创建，创建时把当前默认模型组发给各工作进程（initializer）：
+从扁平模型文件 mmap 加载的模型组只发送文件路径，工作进程自己 mmap 同一个文件，
+与父进程共享操作系统的页缓存；其他模型组发送 to_state()，工作进程重建一份。
+默认模型组被替换后进程池会在后台重建，新进程收到新的模型组；重建把整个模型组发给
+每个工作进程，所以延迟 restart_delay 秒进行，期间的多次替换（如连续追加语料）只重建一次。
+请求的模型组在工作进程中不存在（例如之后才按需加载的语料、等待重建期间的新模型组）时，
+在当前进程中直接生成
+"""
+
+import os
+import logging
+import threading
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from src.utils import process_context
+
+logger = logging.getLogger(__name__)
+
+# 工作进程中由 _init_worker 设置
+_bundles = {}       # (语料, created_at) -> ModelBundle
+_generate = None
+
+
+def _picklable(value):
+    """to_state() 中 mmap 上的 memoryview 换成 array，其余原样（StringTable 等自带 __reduce__）"""
+    if isinstance(value, memoryview):
+        return array(value.format, value)
+    if isinstance(value, dict):
+        return {k: _picklable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_picklable(item) for item in value)
+    return value
+
+
+def bundle_payload(bundle):
+    """把模型组打包成可以发给工作进程的数据"""
+    payload = {
+        "corpus": bundle.corpus,
+        "created_at": bundle.created_at,
+        "markov_order": bundle.markov_order,
+        "source": bundle.source,
+        "size_bytes": bundle.size_bytes,
+        "model_file": bundle.model_file,
+        "states": None,
+    }
+    if bundle.model_file is None:
+        payload["states"] = {
+            name: _picklable(getattr(bundle, name).to_state())
+            for name in ("markov", "imagery", "structured")
+        }
+    return payload
+
+
+def _restore_bundle(payload):
+    """工作进程中重建模型组；扁平模型文件在此期间被重建过时返回 None（交给父进程生成）"""
+    from src.flatmodel import load_flat
+    from src.registry import ModelBundle
+    from src.snapshot import MODEL_CLASSES
+
+    if payload["model_file"] is not None:
+        path, mtime_ns = payload["model_file"]
+        if os.stat(path).st_mtime_ns != mtime_ns:
+            return None
+        models, _ = load_flat(path)
+    else:
+        models = {
+            name: MODEL_CLASSES[name].from_state(state)
+            for name, state in payload["states"].items()
+        }
+    return ModelBundle(
+        markov=models["markov"].with_order(payload["markov_order"]),
+        imagery=models["imagery"],
+        structured=models["structured"],
+        corpus=payload["corpus"],
+        markov_order=payload["markov_order"],
+        source=payload["source"],
+        size_bytes=payload["size_bytes"],
+        created_at=payload["created_at"],
+        model_file=payload["model_file"],
+    )
+
+
+def _init_worker(generate, payloads):
+    """工作进程的 initializer：保存生成函数并重建收到的模型组"""
+    global _generate
+    _generate = generate
+    for payload in payloads:
+        try:
+            bundle = _restore_bundle(payload)
+        except Exception:
+            # 没有这组模型时请求会退回父进程生成，这里只记录原因
+            logger.exception("生成进程无法加载模型组 %s", payload["corpus"])
+            continue
+        if bundle is not None:
+            _bundles[payload["corpus"], payload["created_at"]] = bundle
+
+
+def _find_bundle(corpus, created_at, order):
+    """在工作进程收到的模型组中查找同一组模型，找不到返回 None"""
+    bundle = _bundles.get((corpus, created_at))
+    if bundle is not None and 1 <= order <= bundle.max_order:
+        return bundle.with_order(order)
+    return None
+
+
+def _generate_task(corpus, created_at, order, mode, num_lines, seed):
+    """工作进程入口：返回 (是否有这组模型, 生成的诗)"""
+    bundle = _find_bundle(corpus, created_at, order)
+    if bundle is None:
+        return False, None
+    return True, _generate(bundle, mode, num_lines, seed)
+
+
+def _noop():
+    return None
+
+
+class GenerationPool:
+    """
+    registry: 模型注册表（其默认模型组发给工作进程）
+    generate: generate(bundle, mode, num_lines, seed) -> 诗，必须是可按名字 pickle 的模块级函数
+    workers: 工作进程数
+    restart_delay: 默认模型组被替换后等待多少秒再重建进程池
+    """
+
+    def __init__(self, registry, generate, workers, restart_delay=1.0):
+        self.registry = registry
+        self.generate = generate
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self._executor = None
+        self._timer = None      # 已安排但尚未开始的重建
+        self._lock = threading.Lock()
+        self.available = True
+
+    def start(self):
+        """创建（或重建）进程池，旧进程池中已提交的任务继续完成"""
+        current = self.registry.current
+        payloads = [bundle_payload(current)] if current is not None else []
+        with self._lock:
+            old = self._executor
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=process_context(),
+                initializer=_init_worker, initargs=(self.generate, payloads),
+            )
+            # 立即创建全部工作进程，让它们预先加载模型组
+            for _ in range(self.workers):
+                self._executor.submit(_noop)
+        if old is not None:
+            old.shutdown(wait=False)
+
+    def restart(self, bundle=None):
+        """
+        默认模型组被替换后调用（可注册为 ModelRegistry 的回调）：安排在 restart_delay 秒后
+        于后台线程重建进程池，已安排时不再重复安排，重建时取届时的默认模型组
+        """
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(self.restart_delay, self._restart_now)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _restart_now(self):
+        with self._lock:
+            if self._timer is None:
+                return      # 进程池已关闭
+            self._timer = None
+        self.start()
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def generate_poem(self, bundle, mode, num_lines, seed):
+        """在工作进程中生成一首诗；进程池不可用或工作进程中没有这组模型时在当前进程生成"""
+        executor = self._executor
+        if executor is not None:
+            try:
+                future = executor.submit(
+                    _generate_task, bundle.corpus, bundle.created_at, bundle.markov_order,
+                    mode, num_lines, seed,
+                )
+                found, poem = future.result()
+                if found:
+                    return poem
+            except BrokenProcessPool:
+                # 工作进程异常退出，重建进程池，本次在当前进程生成
+                self.start()
+            except RuntimeError:
+                # 进程池恰好在提交时被重建（旧进程池已关闭）
+                pass
+        return self.generate(bundle, mode, num_lines, seed)
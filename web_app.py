@@ -4,10 +4,18 @@
 """
 
 import os
+import json
 import time
-from flask import Flask, render_template, jsonify, request
-from src.utils import load_corpus, clean_and_tokenize, extract_imagery_and_connectors
-from src.model import MarkovChain, ImageryChain, StructuredPoemGenerator
+import random
+import argparse
+import threading
+from flask import Flask, Response, render_template, jsonify, request, stream_with_context
+from src import pipeline
+from src.model import MarkovChain
+from src.registry import ModelRegistry
+from src.jobs import JobManager
+from src.pool import PoemPool
+from src.workers import GenerationPool
 
 app = Flask(__name__)
 
@@ -17,56 +25,193 @@ CORPUS_DIR = os.path.join(BASE_DIR, "corpus")
 OUTPUT_DIR = os.path.join(BASE_DIR, "output")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-# 全局模型存储
-models = {
-    "markov": None,
-    "imagery": None,
-    "structured": None,
-    "current_corpus": "haizi_full.txt",
-    "markov_order": 2,
-}
+# 分词进程数（1 为单进程，0 表示使用全部核心），可通过 --workers 设置
+SEGMENT_WORKERS = 1
 
+DEFAULT_CORPUS = "haizi_full.txt"
 
-def load_models(corpus_file, order=2):
-    """加载语料并训练所有模型"""
-    try:
-        filepath = os.path.join(CORPUS_DIR, corpus_file)
-        text = load_corpus(filepath)
+# 模型缓存的内存预算（MB），可通过 --cache-mb 设置
+MODEL_CACHE_MB = 1024
+
+# 全局模型注册表：每组模型是不可变的 ModelBundle，加载完成后整体替换，
+# 请求处理时只读取一次 registry.current / registry.get()，不加锁。
+# 按 (语料, 阶数) 缓存多组模型，超出内存预算时按 LRU 淘汰
+registry = ModelRegistry(max_bytes=MODEL_CACHE_MB * 1024 * 1024)
+
+# 后台训练任务：/api/corpus/load 提交后立即返回任务 ID，在子进程中训练
+jobs = JobManager(registry)
+
+# /api/corpus/append 依次执行，每次都在上一次追加的结果上更新
+append_lock = threading.Lock()
 
-        if text is None:
-            return False, "无法加载语料库"
+# 生成模式（未知的模式按马尔可夫处理）
+MODES = ("structured", "imagery", "backoff", "markov")
 
-        # 保存原始诗行
-        raw_lines = [line.strip() for line in text.split("\n") if line.strip()]
+# 预生成诗歌池：每个 (语料, 阶数, 模式, 行数) 预先生成的诗数，0 表示关闭，可通过 --pool-size 设置
+POEM_POOL_SIZE = 0
+poem_pool = None
 
-        # 普通分词
-        tokens = clean_and_tokenize(text)
-        if not tokens:
-            return False, "语料库为空或分词失败"
+# 生成进程池：工作进程数，0 表示在请求线程中直接生成，可通过 --gen-workers 设置
+GENERATION_WORKERS = 0
+generation_pool = None
 
-        # 训练马尔可夫模型
-        models["markov"] = MarkovChain(order=order)
-        models["markov"].train(tokens)
+# 每首诗的行数上限（超出时按上限生成，与网页端的 1～20 一致）
+MAX_NUM_LINES = 20
 
-        # 提取意象和连接词
-        imagery, connectors, token_data = extract_imagery_and_connectors(text)
+# /api/generate/batch：单次请求最多生成的诗数，以及每次生成并写出的诗数（内存上限）
+MAX_BATCH_COUNT = 100000
+BATCH_CHUNK = 256
 
-        # 训练意象模型
-        models["imagery"] = ImageryChain()
-        models["imagery"].train(token_data)
 
-        # 训练结构化模型
-        models["structured"] = StructuredPoemGenerator()
-        models["structured"].train(token_data, raw_lines)
+def corpus_path(corpus_file):
+    """语料文件名 -> 语料库目录中的路径，返回 (path, error)"""
+    if not corpus_file or os.path.basename(corpus_file) != corpus_file:
+        return None, f"无效的语料库: {corpus_file}"
+    path = os.path.join(CORPUS_DIR, corpus_file)
+    if not os.path.isfile(path):
+        return None, f"语料库不存在: {corpus_file}"
+    return path, None
 
-        models["current_corpus"] = corpus_file
-        models["markov_order"] = order
 
+def load_models(corpus_file, order=2, workers=None, use_snapshot=True):
+    """加载语料并训练所有模型（存在有效快照时直接加载快照），完成后设为默认模型组"""
+    if workers is None:
+        workers = SEGMENT_WORKERS
+    try:
+        filepath, error = corpus_path(corpus_file)
+        if error:
+            return False, error
+        bundle, error = registry.load(filepath, order, workers=workers, use_snapshot=use_snapshot)
+        if error:
+            return False, error
+
+        if bundle.source in ("snapshot", "mmap"):
+            return True, "模型加载成功（快照）"
         return True, "模型加载成功"
     except Exception as e:
         return False, f"加载失败: {str(e)}"
 
 
+def submit_load_job(corpus_file, order=2, workers=None, use_snapshot=True):
+    """提交后台训练任务，旧模型在任务完成前继续提供服务，返回 (job, error)"""
+    if workers is None:
+        workers = SEGMENT_WORKERS
+    filepath, error = corpus_path(corpus_file)
+    if error:
+        return None, error
+    return jobs.submit(filepath, order, workers=workers, use_snapshot=use_snapshot), None
+
+
+def parse_order(value):
+    """
+    解析请求中的马尔可夫阶数，返回 (order, error)；未指定（None）时返回 (None, None)
+    只接受 1～MarkovChain.MAX_ORDER：更高的阶数要在请求线程中重新训练一棵更深的 n 元组树
+    """
+    if value is None:
+        return None, None
+    error = f"order 必须是 1～{MarkovChain.MAX_ORDER} 之间的整数"
+    if isinstance(value, (bool, float)):
+        return None, error
+    try:
+        order = int(value)
+    except (TypeError, ValueError):
+        return None, error
+    if not 1 <= order <= MarkovChain.MAX_ORDER:
+        return None, error
+    return order, None
+
+
+def resolve_bundle(corpus_file=None, order=None):
+    """
+    请求使用的模型组，返回 (bundle, error)
+    未指定语料和阶数时使用默认模型组；指定时从缓存中取，没有则加载（不改变默认模型组）
+    """
+    bundle = registry.current
+    if corpus_file is None and order is None:
+        if bundle is None:
+            return None, "模型未加载"
+        return bundle, None
+
+    if corpus_file is None:
+        corpus_file = bundle.corpus if bundle else DEFAULT_CORPUS
+    if order is None:
+        order = bundle.markov_order if bundle else 2
+    order, error = parse_order(order)
+    if error:
+        return None, error
+    filepath, error = corpus_path(corpus_file)
+    if error:
+        return None, error
+    return registry.get_or_load(filepath, order, workers=SEGMENT_WORKERS)
+
+
+def iter_one(bundle, mode, num_lines, seed=None):
+    """逐行生成一首诗（生成器，每生成一行就产出一行），结果与 pipeline.generate_poem 相同"""
+    if mode == "structured":
+        return bundle.structured.iter_lines(expansion_count=num_lines, seed=seed)
+    if mode == "imagery":
+        return bundle.imagery.iter_lines(num_lines, max_imagery_per_line=3, seed=seed)
+    if mode == "backoff":
+        return bundle.markov.iter_lines(num_lines, seed=seed, backoff=True)
+    return bundle.markov.iter_lines(num_lines, seed=seed)
+
+
+def mode_label(bundle, mode):
+    """生成模式的显示名称"""
+    if mode == "structured":
+        return "结构化"
+    if mode == "imagery":
+        return "意象链"
+    if mode == "backoff":
+        return f"马尔可夫回退-{bundle.markov_order}阶"
+    return f"马尔可夫-{bundle.markov_order}阶"
+
+
+def bad_request(error):
+    """请求参数不合法：返回 400 和 {"success": false, "error": ...}"""
+    return jsonify({"success": False, "error": error}), 400
+
+
+def parse_mode(value):
+    """解析请求中的生成模式，返回 (mode, error)；未指定时为 structured"""
+    if value is None:
+        return "structured", None
+    if value not in MODES:
+        return None, f"mode 必须是 {'、'.join(MODES)} 之一"
+    return value, None
+
+
+def parse_seed(value):
+    """
+    解析请求中的随机种子，返回 (seed, error)
+    未指定时随机选一个，随结果一起返回，便于复现同一首诗
+    """
+    if value is None:
+        return random.randrange(2**32), None
+    if isinstance(value, bool):
+        return None, "seed 必须是整数"
+    try:
+        return int(value), None
+    except (TypeError, ValueError):
+        return None, "seed 必须是整数"
+
+
+def parse_num_lines(value):
+    """
+    解析请求中的行数，返回 (num_lines, error)
+    非整数或负数为错误；其余限制在 1～MAX_NUM_LINES 之间
+    """
+    if isinstance(value, bool) or isinstance(value, float):
+        return None, "num_lines 必须是非负整数"
+    try:
+        num_lines = int(value)
+    except (TypeError, ValueError):
+        return None, "num_lines 必须是非负整数"
+    if num_lines < 0:
+        return None, "num_lines 必须是非负整数"
+    return min(max(num_lines, 1), MAX_NUM_LINES), None
+
+
 @app.route("/")
 def index():
     """主页"""
@@ -78,58 +223,151 @@ def list_corpus():
     """获取语料库列表"""
     try:
         files = [f for f in os.listdir(CORPUS_DIR) if f.endswith(".txt")]
-        return jsonify(
-            {"success": True, "corpus_list": files, "current": models["current_corpus"]}
-        )
+        bundle = registry.current
+        current = bundle.corpus if bundle else DEFAULT_CORPUS
+        return jsonify({"success": True, "corpus_list": files, "current": current})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
 
 @app.route("/api/corpus/load", methods=["POST"])
 def load_corpus_api():
-    """加载语料库"""
+    """
+    加载语料库
+    默认提交后台训练任务并立即返回任务 ID，进度通过 /api/corpus/jobs/<id> 查询；
+    传入 "wait": true 时在请求内同步加载
+    """
     data = request.json
-    corpus_file = data.get("corpus", "haizi_full.txt")
-    order = data.get("order", 2)
+    corpus_file = data.get("corpus", DEFAULT_CORPUS)
+    use_snapshot = data.get("snapshot", True)
+    order, error = parse_order(data.get("order", 2))
+    if error:
+        return bad_request(error)
 
-    success, message = load_models(corpus_file, order)
+    if not data.get("wait", False):
+        job, error = submit_load_job(corpus_file, order, use_snapshot=use_snapshot)
+        if error:
+            return jsonify({"success": False, "error": error})
+        return jsonify({"success": True, "job_id": job.id, "job": job.to_dict()})
+
+    success, message = load_models(corpus_file, order, use_snapshot=use_snapshot)
 
     if success:
-        stats = models["structured"].get_stats()
+        stats = registry.current.structured.get_stats()
         return jsonify({"success": True, "message": message, "stats": stats})
     else:
         return jsonify({"success": False, "error": message})
 
 
+def append_to_corpus(path, text):
+    """把新诗歌追加到语料文件末尾（与原有内容之间空一行）"""
+    with open(path, "ab+") as f:
+        f.seek(0, os.SEEK_END)
+        separator = b""
+        if f.tell():
+            f.seek(-1, os.SEEK_END)
+            separator = b"\n" if f.read(1) == b"\n" else b"\n\n"
+        f.write(separator + text.encode("utf-8") + b"\n")
+
+
+@app.route("/api/corpus/append", methods=["POST"])
+def append_corpus_api():
+    """
+    追加诗歌并增量训练：只对新文本分词，把计数合并进模型后整体替换，不重新训练整个语料
+    参数: text（新诗歌），corpus（默认当前语料），order，save（是否写入语料文件，默认 true）
+    """
+    data = request.json
+    text = (data.get("text") or "").strip()
+    if not text:
+        return jsonify({"success": False, "error": "没有诗歌内容"})
+
+    order, error = parse_order(data.get("order"))
+    if error:
+        return bad_request(error)
+
+    with append_lock:
+        current = registry.current
+        corpus_file = data.get("corpus") or (current.corpus if current else DEFAULT_CORPUS)
+        bundle, error = resolve_bundle(corpus_file, order)
+        if error:
+            return jsonify({"success": False, "error": error})
+        filepath, _ = corpus_path(corpus_file)
+
+        start = time.time()
+        try:
+            updated = bundle.appended(text, filepath, workers=SEGMENT_WORKERS)
+            if data.get("save", True):
+                append_to_corpus(filepath, text)
+            registry.replace(filepath, updated)
+        except Exception as e:
+            return jsonify({"success": False, "error": f"追加失败: {str(e)}"})
+
+    lines = sum(1 for line in text.split("\n") if line.strip())
+    return jsonify({
+        "success": True,
+        "message": f"已追加 {lines} 行",
+        "elapsed": round(time.time() - start, 3),
+        "stats": updated.get_stats(),
+    })
+
+
+@app.route("/api/corpus/jobs/<job_id>")
+def get_load_job(job_id):
+    """查询后台训练任务的进度"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": f"任务不存在: {job_id}"})
+    result = {"success": True, "job": job.to_dict()}
+    bundle = registry.current
+    if job.status == "done" and bundle is not None:
+        result["stats"] = bundle.structured.get_stats()
+    return jsonify(result)
+
+
 @app.route("/api/generate", methods=["POST"])
 def generate_poem():
     """生成诗歌"""
     data = request.json
-    mode = data.get("mode", "structured")
-    num_lines = data.get("num_lines", 4)
+    mode, error = parse_mode(data.get("mode"))
+    if error:
+        return bad_request(error)
+    num_lines, error = parse_num_lines(data.get("num_lines", 4))
+    if error:
+        return bad_request(error)
+    # 相同的 (语料, 模式, 参数, seed) 总是生成相同的诗
+    seeded = data.get("seed") is not None
+    seed, error = parse_seed(data.get("seed"))
+    if error:
+        return bad_request(error)
+
+    # 只取一次引用：即使此时有新模型发布，本次请求用到的也是同一组模型。
+    # corpus / order 可选，不同客户端可以同时使用不同的语料
+    order, error = parse_order(data.get("order"))
+    if error:
+        return bad_request(error)
+    bundle, error = resolve_bundle(data.get("corpus"), order)
+    if error:
+        return jsonify({"success": False, "error": error})
 
     try:
-        if mode == "structured":
-            if models["structured"] is None:
-                return jsonify({"success": False, "error": "模型未加载"})
-            poem = models["structured"].generate(expansion_count=num_lines)
-            mode_label = "结构化"
-        elif mode == "imagery":
-            if models["imagery"] is None:
-                return jsonify({"success": False, "error": "模型未加载"})
-            poem = models["imagery"].generate(num_lines, max_imagery_per_line=3)
-            mode_label = "意象链"
-        else:  # markov
-            if models["markov"] is None:
-                return jsonify({"success": False, "error": "模型未加载"})
-            poem = models["markov"].generate(num_lines)
-            mode_label = f"马尔可夫-{models['markov_order']}阶"
+        # 未指定种子时优先取预生成的诗（无法按种子复现，seed 返回 null）
+        poem = None
+        if poem_pool is not None and not seeded:
+            poem = poem_pool.get(bundle, mode, num_lines)
+        if poem is not None:
+            seed = None
+        elif generation_pool is not None:
+            poem = generation_pool.generate_poem(bundle, mode, num_lines, seed)
+        else:
+            poem = pipeline.generate_poem(bundle, mode, num_lines, seed)
 
         return jsonify(
             {
                 "success": True,
                 "poem": poem,
-                "mode_label": mode_label,
+                "mode_label": mode_label(bundle, mode),
+                "corpus": bundle.corpus,
+                "seed": seed,
                 "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
             }
         )
@@ -137,6 +375,119 @@ def generate_poem():
         return jsonify({"success": False, "error": str(e)})
 
 
+def sse_event(event, data):
+    """一条 Server-Sent Events 消息（data 编码为单行 JSON）"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.route("/api/generate/stream")
+def generate_poem_stream():
+    """
+    逐行流式生成诗歌（Server-Sent Events），参数与 /api/generate 相同，通过查询字符串传入
+    依次发送 meta（模式、语料、种子）、每行一条 line、最后 done；出错时发送 error。
+    在请求线程中生成，不走诗歌池和生成进程池
+    """
+    args = request.args
+    num_lines = seed = bundle = None
+    mode, error = parse_mode(args.get("mode"))
+    if not error:
+        num_lines, error = parse_num_lines(args.get("num_lines", 4))
+    if not error:
+        seed, error = parse_seed(args.get("seed"))
+    if not error:
+        order, error = parse_order(args.get("order"))
+    if not error:
+        bundle, error = resolve_bundle(args.get("corpus"), order)
+
+    def events():
+        if error:
+            yield sse_event("error", {"error": error})
+            return
+        yield sse_event("meta", {
+            "mode_label": mode_label(bundle, mode),
+            "corpus": bundle.corpus,
+            "seed": seed,
+        })
+        try:
+            for line in iter_one(bundle, mode, num_lines, seed):
+                yield sse_event("line", {"line": line})
+        except Exception as e:
+            yield sse_event("error", {"error": str(e)})
+            return
+        yield sse_event("done", {"timestamp": time.strftime("%Y-%m-%d %H:%M:%S")})
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        # 禁止缓存和反向代理缓冲，每行生成后立即送达
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def iter_batch(bundle, mode, num_lines, count, base_seed=None):
+    """
+    逐块生成 count 首诗，每块 BATCH_CHUNK 首，产出 NDJSON 文本块
+    指定 base_seed 时第 i 首诗的种子为 base_seed + i（可用 /api/generate 单独复现）；
+    否则用 generate_batch 向量化生成，seed 为 null
+    """
+    for start in range(0, count, BATCH_CHUNK):
+        n = min(BATCH_CHUNK, count - start)
+        if base_seed is None:
+            seeds = [None] * n
+            poems = pipeline.generate_poems(bundle, mode, num_lines, n)
+        else:
+            seeds = range(base_seed + start, base_seed + start + n)
+            poems = [pipeline.generate_poem(bundle, mode, num_lines, seed) for seed in seeds]
+        yield "".join(
+            json.dumps({"index": start + i, "poem": poem, "seed": seed}, ensure_ascii=False) + "\n"
+            for i, (poem, seed) in enumerate(zip(poems, seeds))
+        )
+
+
+@app.route("/api/generate/batch", methods=["POST"])
+def generate_poem_batch():
+    """
+    批量生成诗歌，以 NDJSON（每行一个 JSON）流式返回：{"index", "poem", "seed"}
+    参数同 /api/generate，另加 count（诗数）；seed 为基准种子，第 i 首诗使用 seed + i。
+    诗按块生成，客户端读取后才生成下一块（背压），内存占用与 count 无关；
+    生成中途出错时最后一行为 {"error": ...}
+    """
+    data = request.json
+    mode, error = parse_mode(data.get("mode"))
+    if error:
+        return bad_request(error)
+    num_lines, error = parse_num_lines(data.get("num_lines", 4))
+    if error:
+        return bad_request(error)
+    count = data.get("count", 1)
+    if isinstance(count, bool) or not isinstance(count, int) or not 1 <= count <= MAX_BATCH_COUNT:
+        return bad_request(f"count 必须是 1～{MAX_BATCH_COUNT} 之间的整数")
+    base_seed = None
+    if data.get("seed") is not None:
+        base_seed, error = parse_seed(data.get("seed"))
+        if error:
+            return bad_request(error)
+
+    order, error = parse_order(data.get("order"))
+    if error:
+        return bad_request(error)
+    bundle, error = resolve_bundle(data.get("corpus"), order)
+    if error:
+        return jsonify({"success": False, "error": error})
+
+    def lines():
+        try:
+            yield from iter_batch(bundle, mode, num_lines, count, base_seed)
+        except Exception as e:
+            yield json.dumps({"error": str(e)}, ensure_ascii=False) + "\n"
+
+    return Response(
+        stream_with_context(lines()),
+        mimetype="application/x-ndjson",
+        headers={"X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/api/save", methods=["POST"])
 def save_poem():
     """保存诗歌"""
@@ -146,13 +497,16 @@ def save_poem():
     if not poem:
         return jsonify({"success": False, "error": "没有诗歌内容"})
 
+    bundle = registry.current
+    corpus = bundle.corpus if bundle else DEFAULT_CORPUS
+
     try:
         fname = f"poem_{int(time.time())}.txt"
         fpath = os.path.join(OUTPUT_DIR, fname)
 
         with open(fpath, "w", encoding="utf-8") as f:
             f.write(f"# 生成于 {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"# 风格: {models['current_corpus']}\n\n")
+            f.write(f"# 风格: {corpus}\n\n")
             f.write(poem)
 
         return jsonify({"success": True, "filename": fname, "path": fpath})
@@ -163,24 +517,56 @@ def save_poem():
 @app.route("/api/stats")
 def get_stats():
     """获取统计信息"""
-    if models["structured"]:
-        stats = models["structured"].get_stats()
-        stats["current_corpus"] = models["current_corpus"]
-        stats["markov_order"] = models["markov_order"]
+    bundle = registry.current
+    if bundle:
+        stats = bundle.get_stats()
+        stats["cached_models"] = [
+            {
+                "corpus": cached.corpus,
+                "markov_order": cached.markov_order,
+                "max_order": cached.max_order,
+                "size_mb": round(cached.size_bytes / 1024 / 1024, 1),
+            }
+            for cached in registry.cached()
+        ]
+        if poem_pool is not None:
+            stats["poem_pool"] = poem_pool.stats()
         return jsonify({"success": True, "stats": stats})
     else:
         return jsonify({"success": False, "error": "模型未加载"})
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="现代诗生成器 Web 应用")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="分词进程数（默认 1，0 表示使用全部核心）")
+    parser.add_argument("--cache-mb", type=int, default=MODEL_CACHE_MB,
+                        help=f"模型缓存的内存预算（MB，默认 {MODEL_CACHE_MB}）")
+    parser.add_argument("--pool-size", type=int, default=POEM_POOL_SIZE,
+                        help="每种 (语料, 阶数, 模式, 行数) 预生成的诗数（默认 0，即关闭）")
+    parser.add_argument("--gen-workers", type=int, default=GENERATION_WORKERS,
+                        help="生成进程数（默认 0，即在请求线程中生成）")
+    args = parser.parse_args()
+    SEGMENT_WORKERS = args.workers
+    registry.max_bytes = args.cache_mb * 1024 * 1024
+    if args.pool_size > 0:
+        poem_pool = PoemPool(pipeline.generate_poems, high_water=args.pool_size)
+        registry.add_listener(poem_pool.invalidate)
+
     # 初始化加载默认语料库
     print("正在加载默认语料库...")
-    success, message = load_models("haizi_full.txt", 2)
+    success, message = load_models(DEFAULT_CORPUS, 2)
     if success:
         print(f"✓ {message}")
     else:
         print(f"✗ {message}")
 
+    # 加载默认模型之后再创建生成进程，创建时把默认模型组发给工作进程
+    if args.gen_workers > 0:
+        generation_pool = GenerationPool(registry, pipeline.generate_poem, args.gen_workers)
+        generation_pool.start()
+        registry.add_listener(generation_pool.restart)
+
     print("\n" + "=" * 50)
     print("🎨 现代诗生成器 Web 应用")
     print("=" * 50)